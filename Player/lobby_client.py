@@ -1,24 +1,61 @@
 import os
 import sys
 import json
+import hashlib
+import itertools
+import random
+import shutil
 import socket
+import struct
 import zipfile
+import zlib
 import subprocess
 import threading
 import time
 
+try:
+    import fcntl
+except ImportError:  # Windows：沒有 reflink，view 改用 hardlink / 複製
+    fcntl = None
+
 # --- 路徑設定 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-from common.protocol import send_json, recv_json, recv_file
+from common.protocol import send_json, recv_json
 
 SERVER_IP = '140.113.17.12'
 SERVER_PORT = 18000
+STORE_PAGE_SIZE = 20
+RATE_LIMIT_RETRIES = 3      # 被 server 限流（RATE_LIMITED）或過載（SERVER_BUSY）時最多重試幾次
+RATE_LIMIT_MAX_WAIT = 2.0   # 每次重試最多等幾秒
+CONNECT_TIMEOUT = 5.0       # 單次 TCP 連線的逾時
+RECONNECT_BASE_DELAY = 0.2  # 斷線重連：第一次重試前等多久，之後每次加倍（含少量 jitter）
+RECONNECT_MAX_DELAY = 5.0   # 兩次重試之間最多等幾秒
+RECONNECT_MAX_WAIT = 15.0   # 一次斷線最多花多久重連，超過就讓這個 request 失敗
+RECONNECT_REPLAYS = 2       # 一個 request 因斷線最多重送幾次
+TCP_KEEPALIVE_IDLE = 30     # 連線閒置多久開始送 keepalive probe（偵測半開連線）
+TCP_KEEPALIVE_INTERVAL = 5
+TCP_KEEPALIVE_COUNT = 3
+DOWNLOAD_MAX_PARALLEL = 3   # 背景下載最多同時幾個（各自一條資料連線）
+DOWNLOAD_CHUNK = 64 * 1024
+DOWNLOAD_DATA_TIMEOUT = 15.0  # 資料連線上多久收不到資料就當作斷線（之後從斷點續傳）
+DOWNLOAD_RETRIES = 5        # 斷線後自動續傳幾次才標記為失敗
+DOWNLOAD_WAIT_STALL_SEC = 120  # 前景等待下載時，超過這麼久沒有任何進度就不再等（下載留在背景繼續）
+DOWNLOAD_QUEUE_FILE = "download_queue.json"  # 放在每位玩家的下載目錄，重開 client 登入後接著下載
+
+# 重複執行也沒有副作用的指令：斷線後直接重送；其他指令登入後會帶 req_id，重送時由 server 去重
+# （QUICK_JOIN 會把玩家排進房間 / 推派 host，重做一次可能被配對兩次，所以不在這裡）
+REPLAY_SAFE_COMMANDS = {
+    'PING', 'LOGIN', 'LOGOUT', 'LIST_PUBLIC_GAMES', 'SEARCH_GAMES', 'GET_GAME_DETAIL', 'DOWNLOAD_REQUEST',
+    'LIST_ROOMS', 'HEARTBEAT_SESSION',
+}
 
 DOWNLOADS_DIR = os.path.join(current_dir, "downloads")
+STORE_DIRNAME = ".store"    # DOWNLOADS_DIR 底下整台機器共用的內容快取（依 sha256 定址）
+FICLONE = 0x40049409        # Linux ioctl：reflink（btrfs / xfs 等支援 copy-on-write 的檔案系統）
 
 
 def make_readonly_recursive(path: str):
@@ -37,6 +74,104 @@ def make_readonly_recursive(path: str):
                 pass
 
 
+def link_or_copy(src: str, dst: str) -> str:
+    """建立 dst 指向 src 的內容：優先 hardlink，跨檔案系統等不能 link 時試 reflink，最後才真的複製"""
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError:
+        pass
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class ContentStore:
+    """
+    整台機器共用的內容快取：zips/<sha256>.zip 與解壓好的 trees/<sha256>/。
+    各玩家下載目錄裡的 zip 與 extracted 只是指向這裡的唯讀 view（link_or_copy），
+    同一個版本第二位玩家安裝時不必再下載也不必再解壓。
+    hardlink 和 store 共用 inode，所以 store 與 view 裡的檔案一律唯讀。
+    新增項目都先寫在暫存路徑再 rename，多個 client process 同時安裝同一版本也不會寫壞。
+    """
+
+    def __init__(self, root: str = None):
+        self.root = root or os.path.join(DOWNLOADS_DIR, STORE_DIRNAME)
+        self.zips = os.path.join(self.root, "zips")
+        self.trees = os.path.join(self.root, "trees")
+        os.makedirs(self.zips, exist_ok=True)
+        os.makedirs(self.trees, exist_ok=True)
+
+    def zip_path(self, sha256: str) -> str:
+        return os.path.join(self.zips, f"{sha256}.zip")
+
+    def tree_path(self, sha256: str) -> str:
+        return os.path.join(self.trees, sha256)
+
+    def has_zip(self, sha256: str) -> bool:
+        return os.path.isfile(self.zip_path(sha256))
+
+    def add_zip(self, src: str, sha256: str) -> str:
+        """把已驗證過 sha256 的檔案搬進 store"""
+        path = self.zip_path(sha256)
+        os.replace(src, path)
+        os.chmod(path, 0o444)
+        return path
+
+    def add_tree(self, sha256: str, staged: str = None) -> str:
+        """
+        確保 trees/<sha256> 存在：staged 是下載時已解好的目錄（直接搬進來），
+        None 時從 store 裡的 zip 解壓。別人已經建好時丟掉自己這份。
+        """
+        tree = self.tree_path(sha256)
+        if os.path.isdir(tree):
+            if staged:
+                shutil.rmtree(staged, ignore_errors=True)
+            return tree
+        if staged is None:
+            staged = os.path.join(self.trees, f"{sha256}.{os.getpid()}.{threading.get_ident()}.tmp")
+            shutil.rmtree(staged, ignore_errors=True)
+            with zipfile.ZipFile(self.zip_path(sha256), 'r') as z:
+                z.extractall(staged)
+        try:
+            os.rename(staged, tree)
+        except OSError:
+            if os.path.isdir(tree):
+                shutil.rmtree(staged, ignore_errors=True)
+            else:
+                shutil.move(staged, tree)  # staging 在另一個檔案系統
+        for root, _, files in os.walk(tree):
+            for f in files:
+                os.chmod(os.path.join(root, f), 0o444)
+        return tree
+
+    def link_zip(self, sha256: str, dst: str):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        link_or_copy(self.zip_path(sha256), dst)
+
+    def link_tree(self, sha256: str, dst: str) -> dict:
+        """在 dst 建立 trees/<sha256> 的 view（目錄實際建立，檔案 link），回傳各方式的檔案數"""
+        tree = self.tree_path(sha256)
+        tmp = dst + ".linking"
+        shutil.rmtree(tmp, ignore_errors=True)
+        used = {}
+        for root, _, files in os.walk(tree):
+            target = os.path.join(tmp, os.path.relpath(root, tree))
+            os.makedirs(target, exist_ok=True)
+            for f in files:
+                how = link_or_copy(os.path.join(root, f), os.path.join(target, f))
+                used[how] = used.get(how, 0) + 1
+        os.rename(tmp, dst)
+        return used
+
+
 def get_local_ip_guess() -> str:
     """
     取得本機「可能」對外的 IP（多網卡/校網/VPN 環境不保證 100% 正確）
@@ -52,24 +187,643 @@ def get_local_ip_guess() -> str:
         return ""
 
 
+def pick_bindable_port(preferred: int) -> int:
+    """
+    確認本機能 bind 指定的 port；被占用時改由 OS 挑一個可用的 port。
+    """
+    for port in (int(preferred), 0):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.bind(("0.0.0.0", port))
+            return s.getsockname()[1]
+        except OSError:
+            continue
+        finally:
+            s.close()
+    return int(preferred)
+
+
+def tune_socket(sock):
+    """request/response 都是小封包，關掉 Nagle；開 keepalive 讓閒置時斷掉的連線能被發現"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+    except OSError:
+        pass
+
+
+class StreamingUnzipper:
+    """
+    邊下載邊安裝：依序解析 zip 的 local file header，資料一到就解壓寫進 staging 目錄，
+    每個檔案結束時檢查 CRC32 與大小，下載完再和 central directory 比對一次。
+    遇到沒辦法串流的項目（stored 又用 data descriptor、加密、不支援的壓縮方式）、
+    不安全的路徑或驗證失敗就停下來，error 記錄原因，改由下載完成後用 zipfile 整包解壓。
+    """
+    LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+    DESCRIPTOR_SIG = b'PK\x07\x08'
+
+    def __init__(self, dest: str):
+        self.dest = dest
+        self.buf = bytearray()
+        self.entry = None       # 目前正在解的項目
+        self.entries = {}       # 檔名 -> (crc, size)，已解完且驗證過的檔案
+        self.done = False       # 已讀到 central directory
+        self.error = None
+        shutil.rmtree(dest, ignore_errors=True)
+        os.makedirs(dest)
+
+    def feed(self, data: bytes):
+        if self.error or self.done:
+            return
+        self.buf += data
+        try:
+            while self._step():
+                pass
+        except (ValueError, OSError, UnicodeDecodeError, zlib.error, struct.error) as e:
+            self._close_file()
+            self.error = str(e)
+            self.buf = bytearray()
+
+    def finish(self, zip_path: str) -> bool:
+        """下載完成後呼叫：確認 central directory 裡每個檔案都已解出且 CRC / 大小相符"""
+        if self.error or not self.done:
+            self.error = self.error or "zip 資料不完整"
+            return False
+        try:
+            with zipfile.ZipFile(zip_path) as z:
+                files = [info for info in z.infolist() if not info.is_dir()]
+        except (zipfile.BadZipFile, OSError) as e:
+            self.error = str(e)
+            return False
+        if len(files) != len(self.entries) or any(
+                self.entries.get(info.filename) != (info.CRC, info.file_size) for info in files):
+            self.error = "和 central directory 不一致"
+            return False
+        return True
+
+    def discard(self):
+        self._close_file()
+        shutil.rmtree(self.dest, ignore_errors=True)
+
+    # ---------- 解析 ----------
+    def _step(self) -> bool:
+        """處理 buffer 裡能處理的部分；回傳 True 表示還可以繼續，False 表示要等更多資料"""
+        if self.entry is None:
+            return self._read_header()
+        if self.entry.get('descriptor_left') is not None:
+            return self._read_descriptor()
+        return self._read_data()
+
+    def _read_header(self) -> bool:
+        if len(self.buf) < 4:
+            return False
+        sig = bytes(self.buf[:4])
+        if sig in (b'PK\x01\x02', b'PK\x05\x06', b'PK\x06\x06'):
+            # 後面是 central directory，檔案內容都已經過了
+            self.done = True
+            self.buf = bytearray()
+            return False
+        if sig != b'PK\x03\x04':
+            raise ValueError("找不到 local file header")
+        if len(self.buf) < self.LOCAL_HEADER.size:
+            return False
+        _, _, flags, method, _, _, crc, csize, usize, nlen, xlen = self.LOCAL_HEADER.unpack_from(self.buf)
+        end = self.LOCAL_HEADER.size + nlen + xlen
+        if len(self.buf) < end:
+            return False
+        raw_name = bytes(self.buf[self.LOCAL_HEADER.size:self.LOCAL_HEADER.size + nlen])
+        extra = bytes(self.buf[self.LOCAL_HEADER.size + nlen:end])
+        del self.buf[:end]
+
+        name = raw_name.decode('utf-8' if flags & 0x800 else 'cp437')
+        if flags & 0x1:
+            raise ValueError(f"{name}: 加密的項目")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ValueError(f"{name}: 不支援的壓縮方式 {method}")
+        descriptor = bool(flags & 0x8)
+        if descriptor and method == zipfile.ZIP_STORED and not name.endswith('/'):
+            raise ValueError(f"{name}: stored 項目使用 data descriptor，無法得知長度")
+        zip64 = self._zip64_sizes(extra, usize, csize)
+        if zip64:
+            usize, csize = zip64
+
+        path = self._target(name)
+        entry = {'name': name, 'crc': crc, 'size': usize, 'left': csize, 'descriptor': descriptor,
+                 'zip64': bool(zip64), 'crc_now': 0, 'written': 0, 'file': None, 'descriptor_left': None,
+                 'z': zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None}
+        if name.endswith('/'):
+            os.makedirs(path, exist_ok=True)
+            if descriptor and entry['z'] is None:
+                # 串流寫出的 zip 連目錄也帶 data descriptor；目錄沒有內容，接著就是 descriptor
+                entry['descriptor_left'] = 20 if zip64 else 12
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            entry['file'] = open(path, 'wb')
+        self.entry = entry
+        return True
+
+    def _read_data(self) -> bool:
+        e = self.entry
+        if e['descriptor']:
+            # 長度寫在檔案內容之後：靠 deflate 串流本身的結尾判斷
+            if not self.buf:
+                return False
+            data = bytes(self.buf)
+            self.buf = bytearray()
+            self._write(e['z'].decompress(data))
+            if not e['z'].eof:
+                return False
+            self.buf = bytearray(e['z'].unused_data)
+            e['descriptor_left'] = 20 if e['zip64'] else 12
+            return True
+
+        take = min(e['left'], len(self.buf))
+        if take:
+            data = bytes(self.buf[:take])
+            del self.buf[:take]
+            e['left'] -= take
+            self._write(e['z'].decompress(data) if e['z'] else data)
+        if e['left']:
+            return False
+        if e['z']:
+            self._write(e['z'].flush())
+        self._end_entry(e['crc'], e['size'])
+        return True
+
+    def _read_descriptor(self) -> bool:
+        e = self.entry
+        # signature 是選用的
+        need = e['descriptor_left'] + (4 if self.buf[:4] == self.DESCRIPTOR_SIG else 0)
+        if len(self.buf) < max(need, 4):
+            return False
+        pos = need - e['descriptor_left']
+        crc = struct.unpack_from('<I', self.buf, pos)[0]
+        size = struct.unpack_from('<Q' if e['zip64'] else '<I', self.buf, pos + (12 if e['zip64'] else 8))[0]
+        del self.buf[:need]
+        self._end_entry(crc, size)
+        return True
+
+    def _write(self, data: bytes):
+        e = self.entry
+        if not data:
+            return
+        if e['file'] is None:
+            raise ValueError(f"{e['name']}: 目錄項目帶有資料")
+        e['crc_now'] = zlib.crc32(data, e['crc_now'])
+        e['written'] += len(data)
+        e['file'].write(data)
+
+    def _end_entry(self, crc, size):
+        e = self.entry
+        self._close_file()
+        if e['crc_now'] != crc or e['written'] != size:
+            raise ValueError(f"{e['name']}: CRC 或大小不符")
+        if not e['name'].endswith('/'):
+            self.entries[e['name']] = (crc, size)
+        self.entry = None
+
+    def _close_file(self):
+        if self.entry and self.entry.get('file'):
+            self.entry['file'].close()
+            self.entry['file'] = None
+
+    def _target(self, name: str) -> str:
+        """zip 內路徑 -> staging 目錄下的實際路徑；絕對路徑、.. 與磁碟代號一律拒絕"""
+        parts = name.replace('\\', '/').split('/')
+        if name.startswith(('/', '\\')) or '..' in parts or ':' in parts[0]:
+            raise ValueError(f"不安全的路徑: {name}")
+        root = os.path.realpath(self.dest)
+        path = os.path.realpath(os.path.join(root, *[p for p in parts if p not in ('', '.')]))
+        if path != root and not path.startswith(root + os.sep):
+            raise ValueError(f"不安全的路徑: {name}")
+        return path
+
+    @staticmethod
+    def _zip64_sizes(extra: bytes, usize: int, csize: int):
+        """有 zip64 extra field 時回傳 (解壓後大小, 壓縮後大小)，否則 None"""
+        pos = 0
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, pos)
+            if tag == 0x0001:
+                values = extra[pos + 4:pos + 4 + length]
+                i = 0
+                if usize == 0xFFFFFFFF:
+                    usize = struct.unpack_from('<Q', values, i)[0]
+                    i += 8
+                if csize == 0xFFFFFFFF:
+                    csize = struct.unpack_from('<Q', values, i)[0]
+                return usize, csize
+            pos += 4 + length
+        if usize == 0xFFFFFFFF or csize == 0xFFFFFFFF:
+            raise ValueError("zip64 大小欄位缺失")
+        return None
+
+
+class DownloadManager:
+    """
+    背景下載：每個下載憑 DOWNLOAD_TICKET 另開一條資料連線，不佔用控制連線，
+    最多 DOWNLOAD_MAX_PARALLEL 個同時進行；可暫停 / 繼續 / 取消，斷線或重開 client 後從 .part 斷點續傳。
+    job 是 dict，'_' 開頭的是執行期欄位，不會寫進佇列檔。
+    """
+    ACTIVE = ('QUEUED', 'RUNNING', 'PAUSED')
+
+    def __init__(self, client, username):
+        self.client = client
+        self.username = username
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.jobs = {}  # key -> job，依加入順序排隊
+        self.queue_path = os.path.join(DOWNLOADS_DIR, username, DOWNLOAD_QUEUE_FILE)
+        self.closed = False
+        self._load()
+
+    @staticmethod
+    def job_key(game_name: str, version: str) -> str:
+        return f"{game_name}@{version}"
+
+    # ---------- 佇列檔 ----------
+    def _load(self):
+        try:
+            with open(self.queue_path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = []
+        for job in saved if isinstance(saved, list) else []:
+            if not isinstance(job, dict) or job.get('state') not in self.ACTIVE + ('FAILED',):
+                continue
+            if job['state'] == 'RUNNING':
+                job['state'] = 'QUEUED'
+            job['rate'] = 0.0
+            self.jobs[job['key']] = job
+
+    def _save(self):
+        """呼叫端持有 self.lock；只存還沒結束的下載"""
+        jobs = [{k: v for k, v in job.items() if not k.startswith('_')}
+                for job in self.jobs.values() if job['state'] in self.ACTIVE + ('FAILED',)]
+        tmp = self.queue_path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(jobs, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, self.queue_path)
+        except OSError as e:
+            print(f"[!] 無法寫入下載佇列: {e}")
+
+    # ---------- 操作 ----------
+    def start(self):
+        """登入後呼叫：接著跑上次沒下載完的項目，回傳接續的數量"""
+        with self.lock:
+            pending = sum(1 for job in self.jobs.values() if job['state'] == 'QUEUED')
+        self._pump()
+        return pending
+
+    def enqueue(self, game_name: str, version: str, install: bool = True):
+        """加入下載佇列；同一個版本已在佇列中就沿用（暫停中的會繼續）"""
+        key = self.job_key(game_name, version)
+        _, zip_path, _ = self.client.local_paths(game_name, version)
+        with self.lock:
+            job = self.jobs.get(key)
+            if job and job['state'] in self.ACTIVE:
+                if job['state'] == 'PAUSED':
+                    job['state'] = 'QUEUED'
+                job['install'] = job.get('install') or install
+            else:
+                job = self.jobs[key] = {
+                    'key': key, 'game_name': game_name, 'version': version, 'zip_path': zip_path,
+                    'state': 'QUEUED', 'install': install, 'received': 0, 'total': 0, 'rate': 0.0,
+                    'etag': None, 'sha256': None, 'error': None,
+                }
+            self._save()
+        self._pump()
+        return job
+
+    def pause(self, key: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(key)
+            if not job or job['state'] not in ('QUEUED', 'RUNNING'):
+                return False
+            if job['state'] == 'RUNNING':
+                self._interrupt(job, 'PAUSED')
+            else:
+                job['state'] = 'PAUSED'
+                self._save()
+            return True
+
+    def resume(self, key: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(key)
+            if not job or job['state'] not in ('PAUSED', 'FAILED'):
+                return False
+            job['state'], job['error'] = 'QUEUED', None
+            self._save()
+        self._pump()
+        return True
+
+    def cancel(self, key: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(key)
+            if not job or job['state'] not in self.ACTIVE + ('FAILED',):
+                return False
+            if job['state'] == 'RUNNING':
+                self._interrupt(job, 'CANCELED')
+            else:
+                self._finish(job, 'CANCELED')
+            return True
+
+    def shutdown(self, timeout: float = 3.0):
+        """登出 / 離開時呼叫：進行中的下載停下來，佇列檔裡仍是 QUEUED，下次登入會續傳"""
+        with self.lock:
+            self.closed = True
+            threads = []
+            for job in self.jobs.values():
+                if job['state'] == 'RUNNING':
+                    self._interrupt(job, 'QUEUED')
+                    threads.append(job.get('_thread'))
+        for t in threads:
+            if t is not None:
+                t.join(timeout)
+
+    def wait(self, key: str, show_progress: bool = True, timeout: float = None) -> bool:
+        """
+        等某個下載結束（前景下載用），回傳是否成功。
+        超過 timeout 秒，或連續 DOWNLOAD_WAIT_STALL_SEC 秒沒有進度就不再等，下載本身留在背景繼續。
+        """
+        last = 0.0
+        now = time.monotonic()
+        deadline = None if timeout is None else now + timeout
+        progress, progress_at = None, now
+        with self.lock:
+            while True:
+                job = self.jobs.get(key)
+                if job is None or job['state'] not in ('QUEUED', 'RUNNING'):
+                    break
+                now = time.monotonic()
+                if job['received'] != progress:
+                    progress, progress_at = job['received'], now
+                if (deadline is not None and now >= deadline) or now - progress_at >= DOWNLOAD_WAIT_STALL_SEC:
+                    print(f"[!] 等待逾時，下載改在背景繼續: {self.describe(job)}")
+                    return False
+                if show_progress and now - last >= 1.0:
+                    last = now
+                    print(f"[*] {self.describe(job)}")
+                self.changed.wait(1.0)
+        if job is None:
+            return False
+        if job['state'] != 'DONE':
+            print(f"[!] 下載未完成: {self.describe(job)}")
+        return job['state'] == 'DONE'
+
+    def snapshot(self):
+        with self.lock:
+            return [{k: v for k, v in job.items() if not k.startswith('_')} for job in self.jobs.values()]
+
+    @staticmethod
+    def describe(job) -> str:
+        text = f"{job['game_name']} v{job['version']} [{job['state']}]"
+        total, received = job.get('total') or 0, job.get('received') or 0
+        if total:
+            text += f" {received * 100 // total}% ({received}/{total} bytes)"
+        if job['state'] == 'RUNNING' and job.get('rate'):
+            eta = (total - received) / job['rate'] if total else 0
+            text += f" {job['rate'] / 1024:.0f} KB/s ETA {eta:.0f}s"
+        if job.get('error'):
+            text += f" - {job['error']}"
+        return text
+
+    # ---------- 排程 ----------
+    def _interrupt(self, job, state):
+        """呼叫端持有 self.lock：要求執行中的下載停下，關掉資料連線讓 recv 立刻返回"""
+        job['_stop'] = state
+        sock = job.get('_sock')
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _finish(self, job, state):
+        """呼叫端持有 self.lock"""
+        job['state'] = state
+        job['rate'] = 0.0
+        if state == 'CANCELED':
+            self.jobs.pop(job['key'], None)
+            try:
+                os.remove(job['zip_path'] + '.part')
+            except OSError:
+                pass
+        self._save()
+        self.changed.notify_all()
+
+    def _pump(self):
+        with self.lock:
+            if self.closed:
+                return
+            running = sum(1 for job in self.jobs.values() if job['state'] == 'RUNNING')
+            for job in self.jobs.values():
+                if running >= DOWNLOAD_MAX_PARALLEL:
+                    break
+                if job['state'] != 'QUEUED':
+                    continue
+                job['state'], job['_stop'] = 'RUNNING', None
+                job['_thread'] = threading.Thread(target=self._run, args=(job,), daemon=True)
+                job['_thread'].start()
+                running += 1
+            self._save()
+            self.changed.notify_all()
+
+    def _run(self, job):
+        state, error = 'FAILED', None
+        try:
+            state, error = self._download(job)
+            if state == 'DONE' and job.get('install'):
+                if not self.client.install_game(job['game_name'], job['version'],
+                                                staged=job.pop('_staged', None), sha256=job.get('sha256')):
+                    state, error = 'FAILED', "安裝失敗"
+        except Exception as e:
+            # 任何意外都要讓 job 離開 RUNNING，否則 wait() 與排程會一直卡著
+            state, error = 'FAILED', f"{type(e).__name__}: {e}"
+        finally:
+            with self.lock:
+                job['error'] = error
+                self._finish(job, state)
+            self._pump()
+
+    def _download(self, job):
+        """下載（含斷線重試），回傳 (最終狀態, 錯誤訊息)"""
+        retries = 0
+        while True:
+            try:
+                if self._transfer(job):
+                    return 'DONE', None
+                return job['_stop'], None
+            except ValueError as e:
+                # server 明確拒絕（例如版本已下架），重試也沒用
+                return 'FAILED', str(e)
+            except OSError as e:
+                if job.get('_stop'):
+                    return job['_stop'], None
+                retries += 1
+                if retries > DOWNLOAD_RETRIES:
+                    return 'FAILED', f"連線失敗: {e}"
+                time.sleep(min(0.5 * 2 ** retries, 10.0))
+
+    def _transfer(self, job) -> bool:
+        """
+        下載一次（從 .part 的長度續傳）：先在控制連線上拿 ticket，再開資料連線收檔並邊收邊算 sha256。
+        要安裝的話同時交給 StreamingUnzipper 邊收邊解壓，成功時 job['_staged'] 是解好的目錄。
+        完成回傳 True；被暫停 / 取消回傳 False；連線問題丟 OSError（會重試），server 拒絕丟 ValueError。
+        """
+        zip_path = job['zip_path']
+        part = zip_path + '.part'
+        os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+
+        res = self.client.request({'cmd': 'DOWNLOAD_TICKET', 'game_name': job['game_name'], 'version': job['version']})
+        if res is None:
+            raise ConnectionError("無法連線到 Server")
+        if res.get('status') != 'OK':
+            raise ValueError(res.get('msg') or res.get('status'))
+        if job['sha256'] and res.get('sha256') != job['sha256']:
+            job['etag'] = None  # server 上的檔案換過了，舊的 .part 不能接著用
+        job['sha256'] = res.get('sha256')
+        store = self.client.store
+        if job['sha256'] and store.has_zip(job['sha256']):
+            # 這台機器上已經有人下載過同樣內容：直接建立 view，不開資料連線
+            store.link_zip(job['sha256'], zip_path)
+            job['total'] = job['received'] = os.path.getsize(zip_path)
+            if os.path.exists(part):
+                os.remove(part)
+            return True
+        offset = os.path.getsize(part) if job['etag'] and os.path.exists(part) else 0
+
+        sock = socket.create_connection((SERVER_IP, SERVER_PORT), timeout=CONNECT_TIMEOUT)
+        with self.lock:
+            job['_sock'] = sock
+            if job.get('_stop'):
+                sock.close()
+                return False
+        unzip = None
+        try:
+            sock.settimeout(DOWNLOAD_DATA_TIMEOUT)
+            tune_socket(sock)
+            if not send_json(sock, {'cmd': 'DOWNLOAD_DATA', 'ticket': res['ticket'],
+                                    'offset': offset, 'etag': job['etag']}):
+                raise ConnectionError("資料連線中斷")
+            ready = recv_json(sock)
+            if ready is None or ready.get('status') != 'READY':
+                # ticket 過期、被限流等：下次重試會重新申請 ticket
+                raise ConnectionError((ready or {}).get('msg') or "資料連線中斷")
+            total, offset = int(ready['file_size']), int(ready.get('offset') or 0)
+            job['total'], job['etag'] = total, ready.get('etag')
+
+            digest = hashlib.sha256()
+            if job.get('install'):
+                unzip = StreamingUnzipper(os.path.join(os.path.dirname(zip_path), 'extracted.partial'))
+            with open(part, 'r+b' if offset else 'wb') as f:
+                # 續傳：已收到的部分先算進 sha256（也重新解壓一次）
+                remaining = offset
+                while remaining:
+                    block = f.read(min(1 << 20, remaining))
+                    if not block:
+                        raise ConnectionError(".part 檔比預期短")
+                    digest.update(block)
+                    if unzip:
+                        unzip.feed(block)
+                    remaining -= len(block)
+                f.seek(offset)
+                f.truncate()
+                received = offset
+                self._progress(job, received, reset=True)
+                while received < total:
+                    if job.get('_stop'):
+                        return False
+                    chunk = sock.recv(min(DOWNLOAD_CHUNK, total - received))
+                    if not chunk:
+                        raise ConnectionError("資料連線中斷")
+                    f.write(chunk)
+                    digest.update(chunk)
+                    if unzip:
+                        unzip.feed(chunk)
+                    received += len(chunk)
+                    self._progress(job, received)
+            final = recv_json(sock)
+            if not (final and final.get('status') == 'OK'):
+                raise ConnectionError("下載完成但回應異常")
+            if job['sha256'] and digest.hexdigest() != job['sha256']:
+                job['etag'] = None
+                raise ConnectionError("sha256 不符，重新下載")
+            if job['sha256']:
+                store.add_zip(part, job['sha256'])
+                store.link_zip(job['sha256'], zip_path)
+            else:
+                os.replace(part, zip_path)
+            if unzip and unzip.finish(zip_path):
+                job['_staged'] = unzip.dest
+                unzip = None
+            elif unzip:
+                print(f"[*] {job['game_name']} v{job['version']} 無法邊下載邊解壓（{unzip.error}），改為下載完再解壓")
+            return True
+        finally:
+            with self.lock:
+                job['_sock'] = None
+            sock.close()
+            if unzip:
+                unzip.discard()
+
+    def _progress(self, job, received, reset=False):
+        """更新進度與平滑後的速度（bytes/s）"""
+        now = time.monotonic()
+        job['received'] = received
+        if reset or '_mark' not in job:
+            job['_mark'] = (now, received)
+            return
+        t0, r0 = job['_mark']
+        if now - t0 >= 0.5:
+            rate = (received - r0) / (now - t0)
+            job['rate'] = rate if not job.get('rate') else 0.7 * job['rate'] + 0.3 * rate
+            job['_mark'] = (now, received)
+
+
 class LobbyClient:
     def __init__(self):
         self.sock = None
         self.connected = False
         self.username = None
+        # 斷線重連後接回 session 用：優先用 LOGIN 拿到的 resume token，
+        # server 不認得（例如 server 重開）時才用記在記憶體裡的密碼重新登入
+        self.resume_token = None
+        self.password = None
+        self.req_prefix = os.urandom(4).hex()
+        # heartbeat、背景下載與選單執行緒都會呼叫 request()；itertools.count 的 next() 不會發出重複的號碼
+        self.req_seq = itertools.count(1)
+        self.downloads = None  # 登入後建立的 DownloadManager
+        self.store = ContentStore()
+        self.install_lock = threading.Lock()  # 背景下載完成的自動安裝和前景安裝不要同時解壓同一個版本
+        # heartbeat 執行緒與選單共用同一條連線，一次只能有一個 request 在進行
+        self.req_lock = threading.RLock()
+        self.hosted_rooms = set()
+        self.hosted_lock = threading.Lock()
+        self.heartbeat_thread = None
         os.makedirs(DOWNLOADS_DIR, exist_ok=True)
 
     # ---------- network ----------
-    def connect(self):
+    def connect(self, quiet=False):
         if self.connected:
             return True
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((SERVER_IP, SERVER_PORT))
+            self.sock = socket.create_connection((SERVER_IP, SERVER_PORT), timeout=CONNECT_TIMEOUT)
+            self.sock.settimeout(None)
+            tune_socket(self.sock)
             self.connected = True
             return True
         except Exception as e:
-            print(f"[!] 無法連線到 Server: {e}")
+            if not quiet:
+                print(f"[!] 無法連線到 Server: {e}")
+            self.sock = None
             self.connected = False
             return False
 
@@ -83,20 +837,105 @@ class LobbyClient:
         self.connected = False
 
     def request(self, obj: dict):
-        if not self.connected and not self.connect():
-            return None
-        try:
-            if not send_json(self.sock, obj):
-                self.close()
-                return None
-            res = recv_json(self.sock)
-            if res is None:
+        obj = dict(obj)
+        if self.username and obj.get('cmd') not in REPLAY_SAFE_COMMANDS:
+            obj['req_id'] = f"{self.req_prefix}-{next(self.req_seq)}"
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            with self.req_lock:
+                res = self._request_locked(obj)
+            if not res or res.get('status') not in ('RATE_LIMITED', 'SERVER_BUSY') or attempt == RATE_LIMIT_RETRIES:
+                return res
+            if res.get('status') == 'SERVER_BUSY':
+                # server 回完 SERVER_BUSY 就關閉連線，下次 request 會重新連線並接回 session
                 self.close()
+            # 等待時不佔住 req_lock，heartbeat 執行緒仍可送出
+            time.sleep(min(float(res.get('retry_after') or 0.5), RATE_LIMIT_MAX_WAIT))
+        return res
+
+    def _request_locked(self, obj: dict):
+        """
+        送出並等回應；連線斷了就自動重連、接回 session 後重送。
+        request 已送出才斷線時，只重送 REPLAY_SAFE_COMMANDS 或帶 req_id 的（server 會回上次的結果）。
+        """
+        for _ in range(RECONNECT_REPLAYS + 1):
+            if not self.connected and not self._reconnect():
                 return None
-            return res
+            sent, res = self._exchange(obj)
+            if res is not None:
+                return res
+            if sent and obj.get('cmd') not in REPLAY_SAFE_COMMANDS:
+                if 'req_id' not in obj:
+                    print("[!] 連線中斷，無法確認 request 是否已被處理")
+                    return None
+                obj['replay'] = True
+        return None
+
+    def _exchange(self, obj: dict):
+        """送一個 request 收一個回應，回傳 (是否已送出, 回應)；失敗時關閉連線"""
+        sent = False
+        try:
+            sent = send_json(self.sock, obj)
+            res = recv_json(self.sock) if sent else None
         except Exception:
+            res = None
+        if res is None:
             self.close()
-            return None
+        return sent, res
+
+    def _reconnect(self) -> bool:
+        """以指數退避重連（最多 RECONNECT_MAX_WAIT 秒），連上後接回原本的登入狀態"""
+        deadline = time.monotonic() + RECONNECT_MAX_WAIT
+        delay = RECONNECT_BASE_DELAY
+        announced = False
+        while True:
+            if self.connect(quiet=True):
+                ok = self._restore_session()
+                if ok is not None:
+                    if announced:
+                        print("[*] 已重新連線到 Server")
+                    return True
+            if not announced:
+                print("[*] 與 Server 的連線中斷，重新連線中...")
+                announced = True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print("[!] 無法連線到 Server")
+                return False
+            time.sleep(min(delay * random.uniform(0.8, 1.2), remaining))
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _restore_session(self):
+        """
+        新連線上恢復登入：先 RESUME，失敗再用密碼 LOGIN。
+        回傳 True 已恢復（或本來就沒登入）、False 無法恢復（已改為登出狀態）、None 過程中又斷線。
+        """
+        if not self.username:
+            return True
+        attempts = []
+        if self.resume_token:
+            attempts.append({'cmd': 'RESUME', 'user': self.username, 'role': 'player', 'token': self.resume_token})
+        if self.password is not None:
+            attempts.append({'cmd': 'LOGIN', 'user': self.username, 'pwd': self.password, 'role': 'player'})
+        for obj in attempts:
+            _, res = self._exchange(obj)
+            if res is None:
+                return None
+            if res.get('status') == 'OK':
+                self.resume_token = res.get('resume_token')
+                return True
+        print("[!] 重新連線後無法恢復登入狀態，請重新登入")
+        self._forget_session()
+        return False
+
+    def _stop_downloads(self):
+        if self.downloads is not None:
+            self.downloads.shutdown()
+            self.downloads = None
+
+    def _forget_session(self):
+        self.username = None
+        self.resume_token = None
+        self.password = None
 
     # ---------- utils ----------
     def _probe_tcp(self, ip: str, port: int, timeout: float = 1.0) -> bool:
@@ -160,31 +999,72 @@ class LobbyClient:
             return False
 
         self.username = u
+        self.password = p
+        self.resume_token = res.get('resume_token')
         os.makedirs(os.path.join(DOWNLOADS_DIR, self.username), exist_ok=True)
         print("[OK] 登入成功")
+        self.downloads = DownloadManager(self, u)
+        pending = self.downloads.start()
+        if pending:
+            print(f"[*] 接續 {pending} 個未完成的下載（主選單的「下載管理」可查看）")
         return True
 
     def logout(self):
+        self._stop_downloads()
         self.request({'cmd': 'LOGOUT'})
-        self.username = None
+        self._forget_session()
         print("[*] 已登出")
 
     # ---------- store ----------
-    def list_store(self):
-        res = self.request({'cmd': 'LIST_PUBLIC_GAMES'})
+    def list_store(self, cursor=None, filters=None):
+        """
+        取得商城的一頁（server 端分頁/篩選/排序）。
+        回傳 (games, next_cursor)；失敗或沒有遊戲時 games 為 None。
+        """
+        req = {'cmd': 'LIST_PUBLIC_GAMES', 'limit': STORE_PAGE_SIZE}
+        if cursor:
+            req['cursor'] = cursor
+        req.update(filters or {})
+        res = self.request(req)
         if res is None:
             print("[!] 列表載入失敗（連線失敗）")
-            return None
+            return None, None
         if res.get('status') != 'OK':
             print(f"[!] 列表載入失敗: {res.get('msg')}")
+            return None, None
+
+        games = res.get('games', [])
+        if not games:
+            if filters:
+                print("\n[提示] 沒有符合條件的遊戲。")
+            else:
+                print("\n[提示] 目前沒有可遊玩的遊戲。")
+            return None, None
+
+        print("\n--- 遊戲商城（可下載/可遊玩）---")
+        print(f"{'No.':<5} {'Game Name':<18} {'Author':<12} {'Latest':<8} Description")
+        print("-" * 90)
+        for i, g in enumerate(games):
+            desc = g.get('description') or "尚未提供簡介"
+            print(f"{i+1:<5} {g.get('name',''):<18} {g.get('uploader',''):<12} {g.get('latest_version',''):<8} {desc}")
+        print("-" * 90)
+        return games, res.get('next_cursor')
+
+    def search_store(self, query: str):
+        res = self.request({'cmd': 'SEARCH_GAMES', 'query': query})
+        if res is None:
+            print("[!] 搜尋失敗（連線失敗）")
+            return None
+        if res.get('status') != 'OK':
+            print(f"[!] 搜尋失敗: {res.get('msg')}")
             return None
 
         games = res.get('games', [])
         if not games:
-            print("\n[提示] 目前沒有可遊玩的遊戲。")
+            print(f"\n[提示] 找不到符合「{query}」的遊戲。")
             return None
 
-        print("\n--- 遊戲商城（可下載/可遊玩）---")
+        print(f"\n--- 搜尋結果：{query} ---")
         print(f"{'No.':<5} {'Game Name':<18} {'Author':<12} {'Latest':<8} Description")
         print("-" * 90)
         for i, g in enumerate(games):
@@ -193,6 +1073,24 @@ class LobbyClient:
         print("-" * 90)
         return games
 
+    def _ask_store_filters(self):
+        print("\n--- 篩選 / 排序（Enter 表示不限）---")
+        filters = {}
+        prefix = input("名稱開頭: ").strip()
+        if prefix:
+            filters['prefix'] = prefix
+        uploader = input("作者: ").strip()
+        if uploader:
+            filters['uploader'] = uploader
+        if input("只顯示有開房的遊戲？(y/N): ").strip().lower() == 'y':
+            filters['has_rooms'] = True
+        sort = input("排序 1) 名稱 2) 名稱反序 3) 最近更新（預設 1）: ").strip()
+        if sort == '2':
+            filters['sort'] = 'name_desc'
+        elif sort == '3':
+            filters['sort'] = 'updated'
+        return filters
+
     def game_detail(self, game_name: str):
         res = self.request({'cmd': 'GET_GAME_DETAIL', 'game_name': game_name})
         if res is None:
@@ -216,73 +1114,49 @@ class LobbyClient:
 
     # ---------- download/install ----------
     def download_game(self, game_name: str, version: str):
-        res = self.request({'cmd': 'DOWNLOAD_REQUEST', 'game_name': game_name, 'version': version})
-        if res is None:
-            print("[!] 下載失敗（連線失敗）")
-            return False
-        if res.get('status') != 'READY':
-            print(f"[!] 下載失敗: {res.get('msg')}")
-            return False
-
-        file_size = int(res.get('file_size', 0))
-        if file_size <= 0:
-            print("[!] Server 回傳檔案大小異常")
+        # 走 DownloadManager 的資料連線：控制連線（heartbeat 等）不會被大檔卡住，斷線會自動續傳
+        job = self.downloads.enqueue(game_name, version, install=False)
+        if not self.downloads.wait(job['key']):
             return False
-
-        base, zip_path, _ = self.local_paths(game_name, version)
-        os.makedirs(base, exist_ok=True)
-
-        tmp_path = zip_path + ".part"
-        if os.path.exists(tmp_path):
-            try:
-                os.remove(tmp_path)
-            except:
-                pass
-
-        print(f"[*] 下載中... ({file_size} bytes)")
-        ok = recv_file(self.sock, tmp_path, file_size)
-        if not ok:
-            print("[!] 下載中斷（不會把半套檔案當成功）")
-            try:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-            except:
-                pass
-            return False
-
-        final = recv_json(self.sock)
-        if not (final and final.get('status') == 'OK'):
-            print(f"[!] 下載完成但回應異常: {final}")
-            try:
-                if os.path.exists(tmp_path):
-                    os.remove(tmp_path)
-            except:
-                pass
-            return False
-
-        os.replace(tmp_path, zip_path)
-        print(f"[成功] 已下載到: {zip_path}")
+        print(f"[成功] 已下載到: {job['zip_path']}")
         return True
 
-    def install_game(self, game_name: str, version: str):
+    def install_game(self, game_name: str, version: str, staged: str = None, sha256: str = None):
+        """
+        staged：下載時已邊收邊解壓並驗證好的目錄，不必再解壓一次。
+        有 sha256 且 zip 在 ContentStore 裡時，安裝目錄是共用解壓結果的 view（第二位玩家幾乎不花 I/O）。
+        """
         base, zip_path, extracted = self.local_paths(game_name, version)
         if not os.path.exists(zip_path):
             print("[!] 找不到 zip，請先下載")
             return False
 
-        if os.path.exists(extracted):
-            print("[OK] 已安裝過（同版本），略過解壓")
-            return True
-
-        os.makedirs(extracted, exist_ok=True)
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as z:
-                z.extractall(extracted)
-        except Exception as e:
-            print(f"[!] 解壓失敗: {e}")
-            return False
+        with self.install_lock:
+            if os.path.exists(extracted):
+                if staged:
+                    shutil.rmtree(staged, ignore_errors=True)
+                print("[OK] 已安裝過（同版本），略過解壓")
+                return True
 
-        make_readonly_recursive(extracted)
+            if sha256 and self.store.has_zip(sha256):
+                try:
+                    self.store.add_tree(sha256, staged)
+                    self.store.link_tree(sha256, extracted)
+                except (OSError, zipfile.BadZipFile) as e:
+                    print(f"[!] 解壓失敗: {e}")
+                    return False
+            elif staged:
+                os.replace(staged, extracted)
+            else:
+                os.makedirs(extracted, exist_ok=True)
+                try:
+                    with zipfile.ZipFile(zip_path, 'r') as z:
+                        z.extractall(extracted)
+                except Exception as e:
+                    print(f"[!] 解壓失敗: {e}")
+                    return False
+
+            make_readonly_recursive(extracted)
         print(f"[成功] 已安裝（解壓）到: {extracted}")
         return True
 
@@ -292,9 +1166,9 @@ class LobbyClient:
             return True
 
         print("[*] 開始下載並安裝...")
-        if not self.download_game(game_name, version):
-            return False
-        if not self.install_game(game_name, version):
+        # 邊下載邊解壓：下載完成時通常也已經裝好
+        job = self.downloads.enqueue(game_name, version, install=True)
+        if not self.downloads.wait(job['key']) or not self.is_installed(game_name, version):
             return False
         print("[成功] 下載並安裝完成")
         return True
@@ -322,8 +1196,15 @@ class LobbyClient:
             return None
         return res.get('room')
 
-    def list_rooms(self):
-        res = self.request({'cmd': 'LIST_ROOMS'})
+    def list_rooms(self, game_name: str = None, version: str = None, has_free_slot: bool = False):
+        req = {'cmd': 'LIST_ROOMS'}
+        if game_name:
+            req['game_name'] = game_name
+        if version:
+            req['version'] = version
+        if has_free_slot:
+            req['has_free_slot'] = True
+        res = self.request(req)
         if not res:
             print("[!] 取得房間列表失敗（連線失敗）")
             return None
@@ -342,30 +1223,117 @@ class LobbyClient:
             return None
         return res.get('room')
 
+    def report_room_port(self, room_id: int, port: int):
+        res = self.request({'cmd': 'REPORT_ROOM_PORT', 'room_id': room_id, 'port': port})
+        if not res:
+            print("[!] 回報 port 失敗（連線失敗）")
+            return None
+        if res.get('status') != 'OK':
+            print(f"[!] 回報 port 失敗: {res.get('msg')}")
+            return None
+        return res.get('room')
+
+    def quick_join(self, game_name: str, version: str, max_players: int = 3, max_wait: float = 120):
+        """
+        QUICK_JOIN 配對：每秒輪詢一次直到被放進房間或被推派為 host。
+        回傳 (action, room)；取消/失敗時回傳 (None, None)。
+        """
+        print("[*] 配對中...（Ctrl+C 取消）")
+        req = {
+            'cmd': 'QUICK_JOIN',
+            'game_name': game_name,
+            'version': version,
+            'max_players': max_players,
+            'host_ip': get_local_ip_guess(),
+        }
+        deadline = time.time() + max_wait
+        try:
+            while time.time() < deadline:
+                res = self.request(req)
+                if not res:
+                    print("[!] 配對失敗（連線失敗）")
+                    return None, None
+                status = res.get('status')
+                if status == 'OK':
+                    print(f"[OK] 配對成功（等待 {res.get('wait_sec', 0)} 秒）")
+                    return res.get('action'), res.get('room')
+                if status != 'WAITING':
+                    print(f"[!] 配對失敗: {res.get('msg')}")
+                    return None, None
+                print(f"    排隊中：第 {res.get('position')} / {res.get('waiting')} 位", end="\r")
+                time.sleep(1)
+            print("\n[提示] 等太久了，已取消配對")
+        except KeyboardInterrupt:
+            print("\n[*] 已取消配對")
+        self.request({'cmd': 'QUICK_JOIN_CANCEL'})
+        return None, None
+
     def close_room(self, room_id: int):
         self.request({'cmd': 'CLOSE_ROOM', 'room_id': room_id})
 
-    def _start_room_guard(self, room_id: int, proc: subprocess.Popen):
-        stop_flag = {'stop': False}
+    def _session_heartbeat_loop(self):
+        """
+        整個 session 只有一條 heartbeat：一次 HEARTBEAT_SESSION 續約所有自己當 host 的房間，
+        間隔依 server 回報的 next_heartbeat_sec 調整，失敗時縮短間隔重試。
+        """
+        interval = 2.0
+        while True:
+            with self.hosted_lock:
+                if not self.hosted_rooms:
+                    self.heartbeat_thread = None
+                    return
+            res = self.request({'cmd': 'HEARTBEAT_SESSION'})
+            if res and res.get('status') == 'OK':
+                alive = set(res.get('rooms', []))
+                with self.hosted_lock:
+                    # server 已經不認得的房間（過期/關閉）就不再續約
+                    self.hosted_rooms &= alive
+                interval = max(0.5, float(res.get('next_heartbeat_sec', interval)))
+            else:
+                interval = 1.0
+            time.sleep(interval)
 
-        def heartbeat_loop():
-            while not stop_flag['stop']:
-                res = self.request({'cmd': 'HEARTBEAT_ROOM', 'room_id': room_id})
-                if not res or res.get('status') != 'OK':
-                    break
-                time.sleep(2)
+    def _start_room_guard(self, room_id: int, proc: subprocess.Popen):
+        with self.hosted_lock:
+            self.hosted_rooms.add(room_id)
+            if self.heartbeat_thread is None:
+                self.heartbeat_thread = threading.Thread(target=self._session_heartbeat_loop, daemon=True)
+                self.heartbeat_thread.start()
 
         def watch_proc_loop():
             while True:
                 if proc.poll() is not None:
+                    with self.hosted_lock:
+                        self.hosted_rooms.discard(room_id)
                     self.close_room(room_id)
-                    stop_flag['stop'] = True
                     break
                 time.sleep(1)
 
-        threading.Thread(target=heartbeat_loop, daemon=True).start()
         threading.Thread(target=watch_proc_loop, daemon=True).start()
 
+    def _launch_host(self, game_name: str, version: str, room: dict):
+        rid = int(room.get('room_id'))
+        rport = int(room.get('port'))
+        bound = pick_bindable_port(rport)
+        if bound != rport:
+            print(f"[*] port {rport} 在本機被占用，改用 {bound}")
+            if not self.report_room_port(rid, bound):
+                self.close_room(rid)
+                return False
+            rport = bound
+        players_now = len(room.get('players', []))
+        players_max = int(room.get('max_players', 3))
+
+        print(f"[OK] 已建立房間 RoomID={rid}  Ver={version}  {players_now}/{players_max}")
+        print(f"     host_ip={room.get('host_ip')}  observed={room.get('observed_host_ip')}  reported={room.get('reported_host_ip')}")
+
+        proc = self.run_game_host(game_name, version, room_port=rport, players_min=3)
+        if not proc:
+            self.close_room(rid)
+            return False
+        self._start_room_guard(rid, proc)
+        return True
+
     # ---------- run game ----------
     def run_game_host(self, game_name: str, version: str, room_port: int, players_min: int = 3):
         _, _, extracted = self.local_paths(game_name, version)
@@ -437,14 +1405,51 @@ class LobbyClient:
 
     # ---------- UI ----------
     def store_flow(self):
-        games = self.list_store()
+        filters = {}
+        cursors = [None]  # 每一頁的起始 cursor，用來回上一頁
+        games, next_cursor = self.list_store()
         if not games:
             return
 
         while True:
-            s = input("\n輸入遊戲編號查看詳細（0 返回）: ").strip()
+            s = input("\n輸入遊戲編號查看詳細（n 下一頁 / p 上一頁 / f 篩選排序 / s 搜尋 / 0 返回）: ").strip().lower()
             if s == '0':
                 return
+            if s == 's':
+                query = input("搜尋關鍵字（名稱/簡介）: ").strip()
+                if not query:
+                    continue
+                found = self.search_store(query)
+                if found:
+                    # 搜尋結果不分頁；n/p/f 會回到一般列表
+                    games, next_cursor = found, None
+                continue
+            if s in {'n', 'p', 'f'}:
+                if s == 'n':
+                    if not next_cursor:
+                        print("[提示] 已經是最後一頁")
+                        continue
+                    cursors.append(next_cursor)
+                elif s == 'p':
+                    if len(cursors) <= 1:
+                        print("[提示] 已經是第一頁")
+                        continue
+                    cursors.pop()
+                else:
+                    filters = self._ask_store_filters()
+                    cursors = [None]
+                page, page_cursor = self.list_store(cursors[-1], filters)
+                if page:
+                    games, next_cursor = page, page_cursor
+                elif s == 'f':
+                    # 篩選沒結果：回到不篩選的第一頁
+                    filters = {}
+                    games, next_cursor = self.list_store()
+                    if not games:
+                        return
+                elif s == 'n':
+                    cursors.pop()
+                continue
             if not s.isdigit():
                 print("[!] 請輸入數字")
                 continue
@@ -474,9 +1479,17 @@ class LobbyClient:
 
             while True:
                 print("\n1) 一鍵下載/更新到最新（下載並安裝）  2) 啟動遊戲（永遠最新 + host建房/join加房）  3) 返回列表")
+                print("4) 背景下載最新版（下載完自動安裝，可繼續瀏覽）")
                 c = input("選擇: ").strip()
                 if c == '3':
                     break
+                if c == '4':
+                    if self.is_installed(name, latest):
+                        print(f"[OK] 最新版本 v{latest} 已就緒")
+                    else:
+                        self.downloads.enqueue(name, latest)
+                        print("[*] 已加入背景下載（主選單的「下載管理」可查看進度）")
+                    continue
                 if c not in {'1', '2'}:
                     print("[!] 輸入錯誤")
                     continue
@@ -487,8 +1500,8 @@ class LobbyClient:
                 if c == '1':
                     continue
 
-                mode = input("啟動模式 host/join（預設host）: ").strip().lower()
-                if mode not in {'host', 'join', ''}:
+                mode = input("啟動模式 host/join/quick（預設host）: ").strip().lower()
+                if mode not in {'host', 'join', 'quick', ''}:
                     print("[!] 模式錯誤")
                     continue
                 if mode == '':
@@ -498,23 +1511,31 @@ class LobbyClient:
                     room = self.create_room(name, latest, max_players=3)
                     if not room:
                         continue
+                    self._launch_host(name, latest, room)
 
-                    rid = int(room.get('room_id'))
-                    rport = int(room.get('port'))
-                    players_now = len(room.get('players', []))
-                    players_max = int(room.get('max_players', 3))
-
-                    print(f"[OK] 已建立房間 RoomID={rid}  Ver={latest}  {players_now}/{players_max}")
-                    print(f"     host_ip={room.get('host_ip')}  observed={room.get('observed_host_ip')}  reported={room.get('reported_host_ip')}")
+                elif mode == 'quick':
+                    action, room = self.quick_join(name, latest, max_players=3)
+                    if not room:
+                        continue
+                    if action == 'HOST':
+                        print("[*] 被推派為 host，正在開房...")
+                        self._launch_host(name, latest, room)
+                        continue
 
-                    proc = self.run_game_host(name, latest, room_port=rport, players_min=3)
-                    if not proc:
-                        self.close_room(rid)
+                    rport = int(room.get('port') or 0)
+                    # host 可能剛被推派、遊戲還在啟動，多試幾次
+                    chosen_ip = ""
+                    for _ in range(5):
+                        chosen_ip = self._choose_connect_ip(room, rport)
+                        if chosen_ip:
+                            break
+                        time.sleep(2)
+                    if not chosen_ip:
                         continue
-                    self._start_room_guard(rid, proc)
+                    self.run_game_join(name, latest, host_ip=chosen_ip, room_port=rport)
 
                 else:
-                    rooms = self.list_rooms()
+                    rooms = self.list_rooms(name, latest, has_free_slot=True)
                     if rooms is None:
                         continue
 
@@ -579,9 +1600,35 @@ class LobbyClient:
 
                     self.run_game_join(name, latest, host_ip=chosen_ip, room_port=rport)
 
-            games = self.list_store()
-            if not games:
+            page, page_cursor = self.list_store(cursors[-1], filters)
+            if not page:
                 return
+            games, next_cursor = page, page_cursor
+
+    def downloads_menu(self):
+        while True:
+            jobs = self.downloads.snapshot()
+            print("\n=== 下載管理 ===")
+            if not jobs:
+                print("（目前沒有下載）")
+            for i, job in enumerate(jobs):
+                print(f"{i+1}. {DownloadManager.describe(job)}")
+            s = input("p 編號 暫停 / r 編號 繼續 / c 編號 取消 / Enter 重新整理 / 0 返回: ").strip().lower()
+            if s == '0':
+                return
+            if not s:
+                continue
+            parts = s.split()
+            if len(parts) != 2 or parts[0] not in {'p', 'r', 'c'} or not parts[1].isdigit():
+                print("[!] 輸入錯誤")
+                continue
+            idx = int(parts[1]) - 1
+            if not (0 <= idx < len(jobs)):
+                print("[!] 編號錯誤")
+                continue
+            action = {'p': self.downloads.pause, 'r': self.downloads.resume, 'c': self.downloads.cancel}[parts[0]]
+            if not action(jobs[idx]['key']):
+                print("[!] 目前狀態無法這樣操作")
 
     def main_menu(self):
         self.connect()
@@ -605,15 +1652,19 @@ class LobbyClient:
                 else:
                     print(f"目前玩家：{self.username}")
                     print("1. 瀏覽商城 / 查看詳細 / 一鍵更新 / host建房 / join加房")
-                    print("2. 登出")
+                    print("2. 下載管理（進度 / 暫停 / 繼續 / 取消）")
+                    print("3. 登出")
                     c = input("選擇: ").strip()
                     if c == '1':
                         self.store_flow()
                     elif c == '2':
+                        self.downloads_menu()
+                    elif c == '3':
                         self.logout()
                     else:
                         print("[!] 輸入錯誤")
         finally:
+            self._stop_downloads()
             self.close()
 
 
@@ -30,10 +30,11 @@ def send_json(sock: socket.socket, data: dict):
         print(f"[Protocol] Send Error: {e}")
         return False
 
-def recv_json(sock: socket.socket) -> dict:
+def recv_json(sock: socket.socket, body_timeout: float = None) -> dict:
     """
     從 socket 接收完整的 JSON 封包。
     這是一個 blocking call，會等到收到完整封包或連線中斷。
+    body_timeout：收到 Header 之後，Body 必須在這個秒數內收完（None 表示沿用 socket 原本的 timeout）。
     """
     try:
         # 1. 先接收 4 bytes 的 Header (長度)
@@ -45,7 +46,15 @@ def recv_json(sock: socket.socket) -> dict:
         length = HEADER_STRUCT.unpack(header_bytes)[0]
         
         # 3. 根據長度接收 JSON Body
-        body_bytes = _recv_all(sock, length)
+        if body_timeout is None:
+            body_bytes = _recv_all(sock, length)
+        else:
+            prev_timeout = sock.gettimeout()
+            sock.settimeout(body_timeout)
+            try:
+                body_bytes = _recv_all(sock, length)
+            finally:
+                sock.settimeout(prev_timeout)
         if not body_bytes:
             return None
             
@@ -77,19 +86,27 @@ def _recv_all(sock: socket.socket, n: int) -> bytes:
 
 # --- 加分題：檔案傳輸輔助函式 (預留給 Level 2) ---
 
-def send_file(sock: socket.socket, file_path: str):
+def _send_stream(sock: socket.socket, f):
+    while True:
+        # 分塊讀取，避免一次讀入大檔案吃光記憶體
+        chunk = f.read(4096)
+        if not chunk:
+            break
+        sock.sendall(chunk)
+
+
+def send_file(sock: socket.socket, file_path):
     """
     傳送二進位檔案 (不經過 JSON 封裝，直接送 Raw Bytes)。
     通常在 send_json 發送完 metadata (檔名、大小) 後呼叫。
+    file_path 也可以是已開啟的二進位檔案：先用 fstat 取大小再送，檔案中途被替換也不會大小對不上。
     """
     try:
-        with open(file_path, 'rb') as f:
-            while True:
-                # 分塊讀取，避免一次讀入大檔案吃光記憶體
-                chunk = f.read(4096)
-                if not chunk:
-                    break
-                sock.sendall(chunk)
+        if hasattr(file_path, 'read'):
+            _send_stream(sock, file_path)
+        else:
+            with open(file_path, 'rb') as f:
+                _send_stream(sock, f)
         return True
     except IOError as e:
         print(f"[Protocol] File Send Error: {e}")
@@ -1,6 +1,17 @@
 import os
 import zipfile
 
+def check_game_config(config):
+    """
+    檢查 game_config.json 的內容，回傳 (ok, msg)。
+    開發者端上傳前與 server 收到上傳後用同一套規則。
+    """
+    if not isinstance(config, dict):
+        return False, "設定檔格式錯誤 (必須是 JSON 物件)"
+    if 'exe_cmd' not in config and ('exe_cmd_host' not in config or 'exe_cmd_join' not in config):
+        return False, "設定檔缺少必要欄位: exe_cmd（或 exe_cmd_host + exe_cmd_join）"
+    return True, "驗證通過"
+
 def zip_dir(folder_path, output_path):
     """
     將指定資料夾 (folder_path) 壓縮成 zip 檔案 (output_path)
@@ -2,6 +2,7 @@ import socket
 import sys
 import os
 import json
+import time
 
 # --- 路徑設定 ---
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -10,6 +11,7 @@ if project_root not in sys.path:
     sys.path.append(project_root)
 
 from common.protocol import send_json, recv_json, send_file
+from common.utils import check_game_config
 
 try:
     from common.utils import zip_dir
@@ -20,6 +22,11 @@ except ImportError:
 
 SERVER_IP = '140.113.17.12'
 SERVER_PORT = 18000
+RATE_LIMIT_RETRIES = 3      # 被 server 限流（RATE_LIMITED）或過載（SERVER_BUSY）時最多重試幾次
+RATE_LIMIT_MAX_WAIT = 2.0   # 每次重試最多等幾秒
+UPLOAD_STATUS_POLL_SEC = 0.5   # 上傳後查詢 server 處理進度的間隔
+UPLOAD_STATUS_TIMEOUT = 120    # 最多等 server 處理這麼久
+UPLOAD_RETRIES = 2             # 上傳被 server 重新啟動中斷時，接回 session 後最多重傳幾次
 
 
 class DeveloperClient:
@@ -27,6 +34,7 @@ class DeveloperClient:
         self.sock = None
         self.is_connected = False
         self.username = None
+        self.resume_token = None  # LOGIN 拿到的 resume token，連線被中斷後用來接回 session
 
     def connect(self):
         if self.is_connected:
@@ -54,6 +62,16 @@ class DeveloperClient:
         self.is_connected = False
 
     def send_request(self, data):
+        for attempt in range(RATE_LIMIT_RETRIES + 1):
+            response = self._send_request_once(data)
+            if not response or response.get('status') not in ('RATE_LIMITED', 'SERVER_BUSY') or attempt == RATE_LIMIT_RETRIES:
+                return response
+            if response.get('status') == 'SERVER_BUSY':
+                self.close()
+            time.sleep(min(float(response.get('retry_after') or 0.5), RATE_LIMIT_MAX_WAIT))
+        return response
+
+    def _send_request_once(self, data):
         if not self.sock or not self.is_connected:
             if not self.connect():
                 return None
@@ -75,6 +93,18 @@ class DeveloperClient:
             self.close()
             return None
 
+    def _resume_session(self):
+        """重新連線並用 resume token 接回登入狀態（server graceful restart 後也有效），成功回傳 True"""
+        if not self.username or not self.resume_token:
+            return False
+        self.close()
+        res = self.send_request({'cmd': 'RESUME', 'user': self.username, 'role': 'developer',
+                                 'token': self.resume_token})
+        if not res or res.get('status') != 'OK':
+            return False
+        self.resume_token = res.get('resume_token')
+        return True
+
     def ping_server(self):
         res = self.send_request({'cmd': 'PING'})
         return bool(res and res.get('status') == 'OK')
@@ -132,6 +162,7 @@ class DeveloperClient:
             if res.get('status') == 'OK':
                 print(f"[成功] {res.get('msg')}")
                 self.username = user
+                self.resume_token = res.get('resume_token')
                 self.dashboard()
             else:
                 print(f"[失敗] {res.get('msg')}")
@@ -164,6 +195,7 @@ class DeveloperClient:
             elif choice == '5':
                 self.send_request({'cmd': 'LOGOUT'})
                 self.username = None
+                self.resume_token = None
                 print("已登出")
                 break
             else:
@@ -176,9 +208,7 @@ class DeveloperClient:
         try:
             with open(config_path, 'r', encoding='utf-8') as f:
                 config = json.load(f)
-            if 'exe_cmd' not in config and ('exe_cmd_host' not in config or 'exe_cmd_join' not in config):
-                return False, "設定檔缺少必要欄位: exe_cmd（或 exe_cmd_host + exe_cmd_join）"
-            return True, "驗證通過"
+            return check_game_config(config)
         except json.JSONDecodeError:
             return False, "設定檔格式錯誤 (非有效 JSON)"
         except Exception as e:
@@ -319,6 +349,29 @@ class DeveloperClient:
             else:
                 print(f"[失敗] {None if res is None else res.get('msg')}")
 
+    def _wait_upload_processed(self, upload_id):
+        """server 收檔後還要驗證 / 建清單 / 算雜湊才會上架，這裡輪詢處理進度"""
+        deadline = time.monotonic() + UPLOAD_STATUS_TIMEOUT
+        last_stage = None
+        while time.monotonic() < deadline:
+            res = self.send_request({'cmd': 'UPLOAD_STATUS', 'upload_id': upload_id})
+            if res is None or res.get('status') != 'OK':
+                print(f"[!] 無法取得處理進度: {None if res is None else res.get('msg')}")
+                return
+            job = res['upload']
+            if job['state'] == 'DONE':
+                timings = ', '.join(f"{k} {v}ms" for k, v in job.get('timings_ms', {}).items())
+                print(f"[成功] 已上架 {job['game_name']} {job['version']}（{timings}）")
+                return
+            if job['state'] == 'FAILED':
+                print(f"[失敗] Server 驗證未通過: {job.get('error')}")
+                return
+            if job.get('stage') and job['stage'] != last_stage:
+                last_stage = job['stage']
+                print(f"[*] 處理中: {last_stage}...")
+            time.sleep(UPLOAD_STATUS_POLL_SEC)
+        print("[!] Server 仍在處理中，請稍後再確認")
+
     def _upload_flow(self, is_update=False, game_data=None):
         if is_update:
             game_name = game_data['name']
@@ -396,23 +449,38 @@ class DeveloperClient:
         }
 
         print(f"[*] 發送請求 (Size: {file_size} bytes)...")
-        res = self.send_request(req)
+        for attempt in range(UPLOAD_RETRIES + 1):
+            res = self.send_request(req)
+            if res is None:
+                print("[!] 連線失敗")
+                break
+            if res.get('status') != 'READY':
+                print(f"[失敗] {res.get('msg', 'Unknown error')}")
+                break
 
-        if res is None:
-            print("[!] 連線失敗")
-        elif res.get('status') == 'READY':
             print("[*] 傳輸檔案...")
             ok = send_file(self.sock, temp_zip)
-            if ok:
-                final = recv_json(self.sock)
-                if final and final.get('status') == 'OK':
-                    print(f"[成功] {final.get('msg')}")
+            # server 中途停止接收時會先回覆原因（例如重新啟動中的 SERVER_BUSY），傳送失敗也讀讀看
+            final = recv_json(self.sock)
+            if final and final.get('status') == 'OK':
+                print(f"[*] {final.get('msg')}")
+                if final.get('upload_id'):
+                    self._wait_upload_processed(final['upload_id'])
                 else:
-                    print(f"[失敗] Server: {final}")
-            else:
+                    print("[成功] 上傳完成")
+                break
+            if final is None or final.get('status') == 'SERVER_BUSY':
+                self.close()
+                if attempt < UPLOAD_RETRIES:
+                    time.sleep(min(float((final or {}).get('retry_after') or 1), RATE_LIMIT_MAX_WAIT))
+                    if self._resume_session():
+                        print("[*] 上傳被中斷（Server 可能正在重新啟動），重新上傳...")
+                        continue
+            if final is None or not ok:
                 print("[!] 傳輸中斷")
-        else:
-            print(f"[失敗] {res.get('msg', 'Unknown error')}")
+            else:
+                print(f"[失敗] Server: {final}")
+            break
 
         if os.path.exists(temp_zip):
             try:
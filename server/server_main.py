@@ -1,9 +1,40 @@
+import argparse
+import base64
+import bisect
+import collections
+import collections.abc
+import contextlib
+import functools
+import hashlib
+import heapq
+import hmac
+import multiprocessing
 import socket
+import stat
+import tempfile
 import threading
 import json
+import math
+import mmap
 import os
+import re
+import secrets
+import select
+import signal
+import struct
+import subprocess
 import sys
 import time
+import tracemalloc
+import unicodedata
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+
+try:
+    import fcntl
+except ImportError:  # Windows：沒有 flock，多 process 模式本來就不支援
+    fcntl = None
 
 SERVER_BUILD = "SERVER_BUILD=2025-12-18 ipfix-v2"
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -12,6 +43,7 @@ if project_root not in sys.path:
     sys.path.append(project_root)
 
 from common.protocol import send_json, recv_json, recv_file, send_file
+from common.utils import check_game_config
 
 HOST = '0.0.0.0'
 PORT = 18000
@@ -21,6 +53,118 @@ PLAYER_DB_PATH = os.path.join(current_dir, 'players.json')
 GAMES_DB_PATH = os.path.join(current_dir, 'games.json')
 OLD_DB_PATH = os.path.join(current_dir, 'database.json')
 STORAGE_DIR = os.path.join(current_dir, 'storage')
+# 資料檔的 schema 版本標記：記錄已跑過的遷移，啟動時已是最新版本就不再讀舊檔/掃描
+SCHEMA_MARKER_PATH = os.path.join(current_dir, 'schema_version.json')
+SCHEMA_VERSION = 2  # 1: database.json 拆成三個檔；2: games.json 多版本格式 + published / latest_version
+
+# 選用的二進位快照格式（--convert 轉出同名 *.snap 後優先使用，見 SnapshotStore）
+SNAPSHOT_MAGIC = b'NPSNAP1\n'
+SNAPSHOT_INDEX_MAGIC = b'NPSIDX1\n'
+SNAPSHOT_TOMBSTONE = 0xFFFFFFFF   # value 長度欄位為此值表示該 key 已刪除
+SNAPSHOT_COMPACT_MIN = 1 << 20    # 失效記錄超過這麼多 bytes（且多於有效記錄）才整份重寫
+
+STORE_PAGE_SIZE = 20
+STORE_PAGE_SIZE_MAX = 100
+STORE_SORT_ORDERS = ('name', 'name_desc', 'updated')
+SEARCH_LIMIT_DEFAULT = 20
+SEARCH_LIMIT_MAX = 100
+
+ROOM_TTL_SEC = 10           # host 超過這麼久沒有 heartbeat，房間就會被回收
+ROOM_PORT_RANGE = (50000, 51000)  # 房間 port 的分配範圍 [start, end)
+
+MATCH_MIN_PLAYERS = 2      # QUICK_JOIN 佇列湊滿幾人就推派一位 host 開新房
+MATCH_POLL_TIMEOUT = 10    # 排隊者超過這麼久沒再送 QUICK_JOIN 就視為離開
+
+CATALOG_REFRESH_SEC = 0.5  # 多 process 模式下，worker 檢查 games.json 是否被其他 worker 改過的間隔
+
+CLIENT_IDLE_TIMEOUT = 300     # 尚未登入的連線超過這麼久沒有任何 request 就關閉；已登入的不因閒置回收，斷線靠 TCP keepalive / heartbeat 偵測
+CLIENT_READ_TIMEOUT = 15      # 收到封包 header 後，body 必須在這時間內收完；送資料單次等待上限也用它
+CLIENT_BUSY_TIMEOUT = 1800    # 單一 request（例如大檔下載）處理超過這麼久視為卡死
+REAPER_INTERVAL = 5           # reaper 掃描間隔
+TCP_KEEPALIVE_IDLE = 60       # 連線閒置多久開始送 keepalive probe
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 5
+LISTEN_BACKLOG = 128          # listen() 的 accept backlog（--backlog）
+MAX_CLIENT_HANDLERS = 2048    # 同時在線的連線數上限（--max-handlers）：每條連線（含閒置中的已登入玩家）整段期間佔一個執行緒
+HANDLER_QUEUE_MAX = 64        # handler 都忙時最多再排隊幾條連線，超過直接回 SERVER_BUSY
+HANDLER_QUEUE_TIMEOUT = 10    # 排隊超過這麼久還沒輪到就主動回 SERVER_BUSY（accept 與 reaper 時檢查）
+SESSION_RESUME_GRACE_SEC = 120  # 連線斷掉後，client 在這段時間內可用 resume token 接回原本的登入狀態
+REPLY_CACHE_SIZE = 32           # 每個 session 記住最近幾個帶 req_id 的回應，重送同一個 request 時直接回舊結果
+
+# 管理指令（STATS 等）需要的 token；沒設定時管理指令一律拒絕
+ADMIN_TOKEN = os.environ.get('LOBBY_ADMIN_TOKEN', '')
+# 下載 ticket 的簽章金鑰：沒設定時每次啟動隨機產生（多 process 模式由 parent 經環境變數傳給 worker），
+# 重啟後舊 ticket 失效，client 會重新申請
+DOWNLOAD_TICKET_KEY = (os.environ.get('LOBBY_TICKET_KEY') or os.urandom(32).hex()).encode('utf-8')
+DOWNLOAD_TICKET_TTL = 600  # ticket 有效秒數（client 暫停太久再續傳時會重新申請）
+STATS_DUMP_PATH = os.environ.get('LOBBY_STATS_FILE', '')  # 設定後定期把統計寫到這個檔案
+STATS_DUMP_INTERVAL = 60
+DIAG_DIR = os.path.join(current_dir, 'diagnostics')  # profiler / tracemalloc 輸出目錄
+PROFILE_INTERVAL_MS = 10       # sampling profiler 預設取樣間隔
+PROFILE_MAX_SEC = 300          # 忘記停止時，最多取樣這麼久就自動結束
+
+# 指令 executor：名稱 -> worker 數（'inline' 直接在連線執行緒上跑，不在此表）
+COMMAND_EXECUTORS = {
+    'pool': 8,   # CPU 較重的查詢（搜尋、tracemalloc）
+    'disk': 4,   # 讀寫磁碟（註冊寫檔、RELOAD）；收送檔案受網路速度影響，不放這裡，在連線自己的執行緒上跑
+}
+TRACE_COMMANDS = bool(os.environ.get('LOBBY_TRACE'))  # 設定後每個指令印一行 trace
+
+# token bucket 限流：指令類別 -> {'session' / 'ip': (每秒補充 token 數, bucket 容量)}
+RATE_LIMITS = {
+    'auth':      {'session': (1, 5),   'ip': (2, 20)},     # REGISTER / LOGIN / RESUME 與 admin 指令（寫檔、防暴力嘗試）
+    'query':     {'session': (10, 30), 'ip': (50, 200)},   # 商城 / 房間列表
+    'room':      {'session': (5, 20),  'ip': (20, 100)},   # 建房、加入、配對
+    'heartbeat': {'session': (5, 20),  'ip': (50, 200)},
+    'download':  {'session': (1, 5),   'ip': (2, 10)},
+    'upload':    {'session': (1, 5),   'ip': (2, 10)},
+    'default':   {'session': (20, 50), 'ip': (100, 300)},  # 其他（含未知指令）
+}
+RATE_LIMIT_IDLE_SEC = 600  # 閒置這麼久的 per-IP bucket 會被清掉
+
+# 選用的設定檔：啟動時讀一次，RELOAD 指令 / SIGHUP 時重新讀
+SERVER_CONFIG_PATH = os.environ.get('LOBBY_CONFIG') or os.path.join(current_dir, 'server_config.json')
+RELOADABLE_SETTINGS = (
+    'STORAGE_DIR', 'STORE_PAGE_SIZE', 'STORE_PAGE_SIZE_MAX', 'SEARCH_LIMIT_DEFAULT', 'SEARCH_LIMIT_MAX',
+    'MATCH_POLL_TIMEOUT', 'CLIENT_IDLE_TIMEOUT', 'CLIENT_READ_TIMEOUT', 'CLIENT_BUSY_TIMEOUT',
+    'HANDLER_QUEUE_TIMEOUT', 'RATE_LIMITS',
+    'STORAGE_GC_INTERVAL', 'STORAGE_GC_FILES_PER_SEC', 'STORAGE_GC_GRACE_SEC', 'STORAGE_GC_RECLAIM',
+    'TIERING_INTERVAL', 'TIERING_COLD_SEC', 'TIERING_IDLE_SEC', 'TIERING_MAX_LOAD', 'TIERING_CPU_BUDGET',
+)
+RESTART_SETTINGS = ('HOST', 'PORT')  # 要 graceful restart（RESTART / SIGUSR2）重新 bind 才會生效
+
+HANDOFF_DRAIN_SEC = 30     # graceful restart 時最多等處理中的 request 這麼久，之後還在傳檔的連線改成可續傳地中斷，其餘的會被中斷
+HANDOFF_CUT_GRACE_SEC = 2  # drain 時間到後中斷仍在傳檔的連線，再等它們回完可續傳的錯誤並關閉的上限
+HANDOFF_CONNECT_SEC = 30   # 等新 process 連上交接 socket 並回覆的上限
+HANDOFF_FDS_PER_MSG = 200  # 每個 SCM_RIGHTS 訊息帶的 fd 數（Linux 上限 253）
+
+# storage/ 背景一致性檢查與回收（StorageGC）
+STORAGE_GC_INTERVAL = 3600       # 兩次完整掃描的間隔
+STORAGE_GC_FIRST_DELAY = 60      # 啟動後多久做第一次掃描（避開啟動時的負載）
+STORAGE_GC_FILES_PER_SEC = 500   # 每秒最多檢查幾個檔案
+STORAGE_GC_GRACE_SEC = 3600      # 孤兒檔 / 暫存檔至少這麼久沒動過才回收
+STORAGE_GC_RECLAIM = True        # False 時只回報、不刪檔
+STORAGE_GC_REPORT_MAX = 50       # 報告中每類問題最多列幾筆
+STORAGE_TEMP_SUFFIXES = ('.part', '.tmp', '.upload')  # 上傳 / 寫入中的暫存檔
+
+# 冷版本分級（ColdTiering）：很久沒被下載的版本在閒置時以最高壓縮率重新壓縮
+DOWNLOAD_STATS_PATH = os.path.join(current_dir, 'download_stats.json')  # 各版本最後下載時間
+DOWNLOAD_STATS_FLUSH_SEC = 60    # 下載紀錄寫回檔案的間隔
+TIERING_INTERVAL = 3600          # 多久找一次冷版本
+TIERING_COLD_SEC = 30 * 86400    # 這麼久沒被下載（沒下載過則以上傳時間算）就算冷版本
+TIERING_IDLE_SEC = 30            # 最近這麼久內有下載就先暫停重新壓縮
+TIERING_MAX_LOAD = 0.5           # 1 分鐘 load average 超過「CPU 數 × 此值」也暫停
+TIERING_CPU_BUDGET = 0.25        # 重新壓縮執行緒最多使用的 CPU 時間比例
+TIERING_COMPRESS_LEVEL = 9
+TIERING_CHUNK = 1 << 20
+
+# 上傳後處理流程（UploadPipeline）
+UPLOAD_MAX_BYTES = 2 << 30        # 單一上傳 zip 的大小上限
+UPLOAD_MAX_MEMBERS = 20000        # zip 內最多幾個檔案
+UPLOAD_MAX_UNPACKED = 8 << 30     # 解壓後總大小上限（防 zip bomb）
+UPLOAD_STAGE_WORKERS = {'integrity': 2, 'hash': 2}  # 其他 stage 各 1 個 worker（catalog 必須循序）
+UPLOAD_JOBS_KEEP = 200            # UPLOAD_STATUS 可查詢的最近上傳筆數
+MANIFEST_DIR = os.path.join(current_dir, 'manifests')  # 各版本的檔案清單（以內容 sha256 命名）
 
 
 def load_json(path, default):
@@ -40,31 +184,652 @@ def save_json(path, obj):
     os.replace(tmp, path)
 
 
+def file_sha256(path, chunk=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size)
+    except OSError:
+        return None
+
+
+def read_server_config(path=None):
+    """
+    讀取並檢查 server_config.json，回傳 {key: 新值}（檔案不存在時為空）。
+    只做檢查、不動任何設定；格式錯誤時丟 ValueError。
+    """
+    path = path or SERVER_CONFIG_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+    if not isinstance(cfg, dict):
+        raise ValueError("server config must be a JSON object")
+
+    g = globals()
+    updates = {}
+    for key, value in cfg.items():
+        if key not in RELOADABLE_SETTINGS and key not in RESTART_SETTINGS:
+            raise ValueError(f"unknown setting: {key}")
+        current = g[key]
+        if isinstance(current, dict):
+            if not isinstance(value, dict):
+                raise ValueError(f"{key} must be an object")
+            value = dict(current, **value)
+        elif isinstance(current, bool):
+            if not isinstance(value, bool):
+                raise ValueError(f"{key} must be true or false")
+        elif isinstance(current, (int, float)):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"{key} must be a number")
+        elif not isinstance(value, str):
+            raise ValueError(f"{key} must be a string")
+        if key == 'STORAGE_DIR':
+            value = os.path.join(current_dir, value)
+        updates[key] = value
+    return updates
+
+
+def apply_server_config(updates, startup=False):
+    """把 read_server_config() 的結果寫回模組設定，回傳 (已套用的 key, 需要重啟才會生效的 key)"""
+    g = globals()
+    applied, pending = [], []
+    for key, value in updates.items():
+        if g[key] == value:
+            continue
+        if key in RESTART_SETTINGS and not startup:
+            pending.append(key)
+            continue
+        g[key] = value
+        applied.append(key)
+    return applied, pending
+
+
+def load_server_config(path=None, startup=False):
+    """
+    讀 server_config.json 覆寫模組設定（檔案不存在就維持預設）。
+    回傳 (已套用的 key, 需要重啟才會生效的 key)；格式錯誤時丟 ValueError，原設定完全不變。
+    """
+    return apply_server_config(read_server_config(path), startup)
+
+
+@contextlib.contextmanager
+def interprocess_lock(path, enabled=True):
+    """多個 worker process 寫同一個 JSON 檔時用的檔案鎖（path + '.lock'）"""
+    if not enabled or fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@functools.total_ordering
+class Version:
+    """
+    已解析的版本號（semver 排序規則）：
+    - core 為任意段數的數字（1.0 與 1.0.0 視為同一順序位置）
+    - pre-release（1.2.0-beta.1）排在正式版之前，識別字數字 < 英數字
+    - build metadata（+build.5）不影響先後，只用原字串做穩定的 tie-break
+    - 無法解析的版本號一律排在所有合法版本之後，依字串排序
+    """
+    __slots__ = ('raw', 'core', 'prerelease', 'build', 'valid', 'key')
+
+    def __init__(self, raw: str):
+        self.raw = str(raw).strip()
+        self.core = ()
+        self.prerelease = ()
+        self.build = ''
+        self.valid = False
+
+        text = self.raw[1:] if self.raw[:1] in ('v', 'V') else self.raw
+        text, _, self.build = text.partition('+')
+        core, dash, pre = text.partition('-')
+        parts = core.split('.')
+        if all(p.isdigit() for p in parts) and (not dash or pre):
+            pre_ids = pre.split('.') if dash else []
+            if all(pre_ids):
+                self.core = tuple(int(p) for p in parts)
+                self.prerelease = tuple(pre_ids)
+                self.valid = True
+
+        if self.valid:
+            norm = list(self.core)
+            while len(norm) > 1 and norm[-1] == 0:
+                norm.pop()
+            if self.prerelease:
+                pre_key = (0, tuple((0, int(p), '') if p.isdigit() else (1, 0, p) for p in self.prerelease))
+            else:
+                pre_key = (1, ())
+            self.key = (0, tuple(norm), pre_key, self.raw)
+        else:
+            self.key = (1, self.raw)
+
+    @property
+    def is_prerelease(self) -> bool:
+        return bool(self.prerelease)
+
+    def __eq__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key == other.key
+
+    def __lt__(self, other):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f"Version({self.raw!r})"
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_version(v) -> Version:
+    return Version(v)
+
+
 def version_key(v: str):
-    v = str(v).strip()
-    parts = v.split(".")
-    out = []
-    ok = True
-    for p in parts:
-        if p.isdigit():
-            out.append(int(p))
+    return parse_version(str(v).strip()).key
+
+
+def version_matches(v: Version, spec: str) -> bool:
+    """
+    版本範圍判斷，spec 以空白分隔多個條件（全部成立才算符合）：
+    - "1.x" / "1.*" / "1"：core 前綴相同
+    - ">=1.0" / ">1.0" / "<=2" / "<2.0" / "=1.1"：比較運算
+    spec 本身未出現 pre-release（沒有 "-"）時，pre-release 版本不會被選中。
+    """
+    if not v.valid:
+        return False
+    if v.is_prerelease and '-' not in (spec or ''):
+        return False
+    for cond in (spec or '').split():
+        op = ''
+        for cand in ('>=', '<=', '>', '<', '='):
+            if cond.startswith(cand):
+                op = cand
+                cond = cond[len(cand):]
+                break
+        if not op:
+            prefix = []
+            for p in cond.split('.'):
+                if p in ('x', 'X', '*', ''):
+                    break
+                if not p.isdigit():
+                    return False
+                prefix.append(int(p))
+            core = v.core + (0,) * (len(prefix) - len(v.core))
+            if core[:len(prefix)] != tuple(prefix):
+                return False
+            continue
+
+        bound = parse_version(cond)
+        if not bound.valid:
+            return False
+        a, b = v.key[1:3], bound.key[1:3]
+        if op == '>=' and not a >= b:
+            return False
+        if op == '>' and not a > b:
+            return False
+        if op == '<=' and not a <= b:
+            return False
+        if op == '<' and not a < b:
+            return False
+        if op == '=' and a != b:
+            return False
+    return True
+
+
+_WORD_RE = re.compile(r'[0-9a-z]+')
+_CJK_RE = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+
+def tokenize(text: str, *, for_query: bool = False):
+    """
+    斷詞：英數字以連續字元為一個 token；中日韓文字沒有空白分詞，
+    建索引時同時放入單字（unigram）與相鄰兩字（bigram），
+    查詢時長度 >= 2 的中文片段只用 bigram，避免「遊戲」也命中只含「遊」的文章。
+    """
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    tokens = _WORD_RE.findall(text)
+    for run in _CJK_RE.findall(text):
+        bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+        if for_query:
+            tokens.extend(bigrams if bigrams else [run])
         else:
-            ok = False
-            break
-    if ok:
-        return (0, tuple(out), v)
-    return (1, v)
+            tokens.extend(run)
+            tokens.extend(bigrams)
+    return tokens
 
 
-class AccountDB:
-    def __init__(self, path, role_name):
+class SearchIndex:
+    """
+    記憶體內的倒排索引（token -> {doc_id: 加權詞頻}），支援增量新增/移除。
+    查詢為 AND 語意，以 BM25 風格的 tf 飽和 * idf 排序。
+    """
+    FIELD_WEIGHTS = {'name': 3.0, 'description': 1.0}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.postings = {}
+        self.doc_tokens = {}
+
+    def add(self, doc_id: str, fields: dict):
+        weights = {}
+        for field, text in fields.items():
+            w = self.FIELD_WEIGHTS.get(field, 1.0)
+            for tok in tokenize(text):
+                weights[tok] = weights.get(tok, 0.0) + w
+        with self.lock:
+            self._remove_locked(doc_id)
+            for tok, w in weights.items():
+                self.postings.setdefault(tok, {})[doc_id] = w
+            self.doc_tokens[doc_id] = tuple(weights.keys())
+
+    def remove(self, doc_id: str):
+        with self.lock:
+            self._remove_locked(doc_id)
+
+    def _remove_locked(self, doc_id: str):
+        for tok in self.doc_tokens.pop(doc_id, ()):
+            docs = self.postings.get(tok)
+            if docs is None:
+                continue
+            docs.pop(doc_id, None)
+            if not docs:
+                del self.postings[tok]
+
+    def search(self, query: str, limit: int = SEARCH_LIMIT_DEFAULT):
+        terms = list(dict.fromkeys(tokenize(query, for_query=True)))
+        if not terms:
+            return []
+        with self.lock:
+            lists = []
+            for t in terms:
+                docs = self.postings.get(t)
+                if not docs:
+                    return []
+                lists.append(docs)
+            lists.sort(key=len)
+            n_docs = len(self.doc_tokens)
+            scores = {}
+            for doc_id in lists[0]:
+                total = 0.0
+                for docs in lists:
+                    tf = docs.get(doc_id)
+                    if tf is None:
+                        break
+                    idf = math.log(1.0 + n_docs / len(docs))
+                    total += idf * tf / (tf + 1.0)
+                else:
+                    scores[doc_id] = total
+        ranked = sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))
+        return ranked[:limit]
+
+
+class SnapshotStore(collections.abc.MutableMapping):
+    """
+    JSON 資料庫的二進位快照格式（AccountDB / GameDB 可選用，檔名 *.snap）：
+    - 資料檔：magic 後接一筆筆 [u32 key 長度][u32 value 長度][key][value JSON]，只會 append；
+      value 長度為 SNAPSHOT_TOMBSTONE 表示刪除
+    - 索引 sidecar（*.snap.idx）：每次寫入 append 一段 [u32 筆數][u32 key 區長度][u32 flags]
+      [(u64 value offset, u32 value 長度) * 筆數][key 區：JSON 字串陣列]；
+      開檔時只讀索引，value 以 mmap 存取、第一次用到才 json 解析
+    - flush 只 append 有變動的記錄；失效的舊記錄多於有效記錄時才整份重寫（compaction）
+    value 多半是會被就地修改的 dict，所以 flush 時把用過（解碼過）的記錄重新編碼，和檔案內容不同才寫。
+    """
+
+    _SEGMENT = struct.Struct('<III')
+    _ENTRY = struct.Struct('<QI')
+    _RECORD = struct.Struct('<II')
+    _PLAIN = 1  # 索引段 flag：沒有刪除記錄、key 不重複（write 整份寫出的段）
+
+    def __init__(self, path):
         self.path = path
+        self.index_path = path + '.idx'
+        self.lock = threading.RLock()
+        self._offsets = {}          # key -> (value offset, value 長度)，只含檔案裡還有效的記錄
+        self._cache = {}            # key -> 已解碼（或新寫入）的 value
+        self._new = set()           # 還沒寫進檔案的 key
+        self._deleted = set()       # 還沒寫進檔案的刪除
+        self._dead = 0              # 檔案裡已失效的 bytes（compaction 判斷用）
+        self._file = None
+        self._mm = None
+        if not os.path.exists(path):
+            self.write(path, {})
+        self._open()
+
+    # ---------- 檔案 ----------
+    def _open(self):
+        self._file = open(self.path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            self._close()
+            raise ValueError(f"{self.path} is not a snapshot file")
+        self._offsets = {}
+        self._dead = 0
+        if not self._load_index():
+            self._scan()
+
+    def _close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _apply(self, keys, entries, flags=0):
+        """把一段索引套用到 _offsets；同一個 key 較早的記錄算作失效 bytes"""
+        if flags & self._PLAIN and not self._offsets:
+            # 常見情況（剛轉檔 / compaction 後的第一段）：整段直接建 dict
+            self._offsets = dict(zip(keys, entries))
+            return
+        for key, (offset, length) in zip(keys, entries):
+            old = self._offsets.pop(key, None)
+            header = self._RECORD.size + len(key.encode('utf-8'))
+            if old is not None:
+                self._dead += header + old[1]
+            if length == SNAPSHOT_TOMBSTONE:
+                self._dead += header
+            else:
+                self._offsets[key] = (offset, length)
+
+    def _load_index(self) -> bool:
+        """讀 sidecar 索引；索引不存在、壞掉或沒涵蓋整個資料檔（例如寫到一半 crash）時回傳 False"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                buf = f.read()
+        except OSError:
+            return False
+        if buf[:len(SNAPSHOT_INDEX_MAGIC)] != SNAPSHOT_INDEX_MAGIC:
+            return False
+        pos, end = len(SNAPSHOT_INDEX_MAGIC), len(SNAPSHOT_MAGIC)
+        try:
+            while pos < len(buf):
+                count, keys_len, flags = self._SEGMENT.unpack_from(buf, pos)
+                pos += self._SEGMENT.size
+                table_end = pos + count * self._ENTRY.size
+                if table_end + keys_len > len(buf):
+                    raise ValueError("truncated index segment")
+                entries = list(self._ENTRY.iter_unpack(buf[pos:table_end]))
+                keys = json.loads(buf[table_end:table_end + keys_len])
+                if len(keys) != count:
+                    raise ValueError("corrupt index segment")
+                pos = table_end + keys_len
+                self._apply(keys, entries, flags)
+                if entries:
+                    offset, length = entries[-1]
+                    end = offset + (0 if length == SNAPSHOT_TOMBSTONE else length)
+        except (struct.error, ValueError):
+            self._offsets, self._dead = {}, 0
+            return False
+        if end != len(self._mm):
+            self._offsets, self._dead = {}, 0
+            return False
+        return True
+
+    def _scan(self):
+        """
+        沒有可用的索引時掃一次資料檔（只讀 header、跳過 value）並重建索引。
+        append 到一半 crash 會在檔尾留下不完整的記錄：掃到超出檔案長度的記錄就停下，把殘缺的尾巴截掉。
+        """
+        mm, pos = self._mm, len(SNAPSHOT_MAGIC)
+        keys, entries = [], []
+        while pos + self._RECORD.size <= len(mm):
+            klen, vlen = self._RECORD.unpack_from(mm, pos)
+            offset = pos + self._RECORD.size + klen
+            end = offset + (0 if vlen == SNAPSHOT_TOMBSTONE else vlen)
+            if end > len(mm):
+                break
+            try:
+                key = mm[offset - klen:offset].decode('utf-8')
+            except UnicodeDecodeError:
+                break
+            keys.append(key)
+            entries.append((offset, vlen))
+            pos = end
+        if pos < len(mm):
+            print(f"[!] {self.path}: dropping {len(mm) - pos} byte(s) of incomplete records at the end")
+            self._close()
+            os.truncate(self.path, pos)
+            self._file = open(self.path, 'rb')
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._apply(keys, entries)
+        with open(self.index_path + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_INDEX_MAGIC + self._segment(keys, entries))
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    @classmethod
+    def _segment(cls, keys, entries, flags=0):
+        blob = json.dumps(keys, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return (cls._SEGMENT.pack(len(entries), len(blob), flags)
+                + b''.join(cls._ENTRY.pack(*e) for e in entries) + blob)
+
+    @classmethod
+    def _records(cls, items, start):
+        """把 (key, value bytes 或 None=刪除) 編成資料檔記錄；回傳 (資料, keys, 索引 entries)"""
+        data, keys, entries = [], [], []
+        pos = start
+        for key, v in items:
+            k = key.encode('utf-8')
+            vlen = SNAPSHOT_TOMBSTONE if v is None else len(v)
+            data.append(cls._RECORD.pack(len(k), vlen) + k + (v or b''))
+            pos += cls._RECORD.size + len(k)
+            keys.append(key)
+            entries.append((pos, vlen))
+            pos += 0 if v is None else len(v)
+        return b''.join(data), keys, entries
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def write(cls, path, mapping):
+        """把整份 mapping 寫成新的快照（轉檔與 compaction 用）；raw bytes 的 value 直接寫入"""
+        items = ((key, value if isinstance(value, bytes) else cls._encode(value)) for key, value in mapping.items())
+        data, keys, entries = cls._records(items, len(SNAPSHOT_MAGIC))
+        for target, content in ((path, SNAPSHOT_MAGIC + data),
+                                (path + '.idx', SNAPSHOT_INDEX_MAGIC + cls._segment(keys, entries, cls._PLAIN))):
+            with open(target + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(target + '.tmp', target)
+
+    def _raw(self, key):
+        offset, length = self._offsets[key]
+        return self._mm[offset:offset + length]
+
+    # ---------- mapping ----------
+    def __getitem__(self, key):
+        with self.lock:
+            if key in self._cache:
+                return self._cache[key]
+            if key not in self._offsets:
+                raise KeyError(key)
+            value = self._cache[key] = json.loads(self._raw(key))
+            return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self._cache[key] = value
+            self._deleted.discard(key)
+            if key not in self._offsets:
+                self._new.add(key)
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self._offsets and key not in self._cache:
+                raise KeyError(key)
+            self._cache.pop(key, None)
+            self._new.discard(key)
+            if key in self._offsets:
+                self._deleted.add(key)
+                del self._offsets[key]
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self._offsets or key in self._cache
+
+    def __iter__(self):
+        with self.lock:
+            keys = list(self._offsets) + [k for k in self._new if k not in self._offsets]
+        return iter(keys)
+
+    def __len__(self):
+        with self.lock:
+            return len(self._offsets) + len(self._new)
+
+    # ---------- 寫回 ----------
+    def flush(self):
+        with self.lock:
+            changed = []
+            for key, value in self._cache.items():
+                enc = self._encode(value)
+                if key in self._offsets and self._offsets[key][1] == len(enc) and self._raw(key) == enc:
+                    continue
+                changed.append((key, enc))
+            changed.extend((key, None) for key in self._deleted)
+            if not changed:
+                return
+
+            data, keys, entries = self._records(changed, len(self._mm))
+            # 先寫資料再寫索引：中途 crash 時索引對不上資料檔長度，下次開檔會自動重掃
+            with open(self.path, 'ab') as f:
+                f.write(data)
+            with open(self.index_path, 'ab') as f:
+                f.write(self._segment(keys, entries))
+            self._close()
+            self._open()
+            self._new.clear()
+            self._deleted.clear()
+            if self._dead > max(len(self._mm) - self._dead, SNAPSHOT_COMPACT_MIN):
+                self.compact()
+
+    def compact(self):
+        """整份重寫，丟掉被覆蓋或刪除的舊記錄；沒解碼過的 value 直接搬 raw bytes"""
+        with self.lock:
+            merged = {}
+            for key in self._offsets:
+                merged[key] = self._cache[key] if key in self._cache else bytes(self._raw(key))
+            for key in self._new:
+                merged[key] = self._cache[key]
+            self._close()
+            self.write(self.path, merged)
+            self._open()
+            self._new.clear()
+            self._deleted.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'records': len(self), 'decoded': len(self._cache),
+                    'file_bytes': len(self._mm), 'dead_bytes': self._dead}
+
+
+def snapshot_path_for(path):
+    return os.path.splitext(path)[0] + '.snap'
+
+
+def resolve_db_path(path):
+    """同名的 .snap 快照存在時優先使用（用 --convert 轉出來的）"""
+    snap = snapshot_path_for(path)
+    return snap if os.path.exists(snap) else path
+
+
+def load_store(path, default):
+    """依副檔名載入資料庫：.snap 用 SnapshotStore（逐筆 lazy 解碼），其他照舊讀 JSON"""
+    if path.endswith('.snap'):
+        return SnapshotStore(path)
+    return load_json(path, default)
+
+
+def save_store(path, data):
+    if isinstance(data, SnapshotStore):
+        data.flush()
+    else:
+        save_json(path, data)
+
+
+def convert_store(src, dst):
+    """JSON 與快照互轉，例如 players.json -> players.snap，或反過來"""
+    data = load_store(src, None)
+    if data is None:
+        raise ValueError(f"cannot read {src}")
+    if dst.endswith('.snap'):
+        SnapshotStore.write(dst, data)
+    else:
+        save_json(dst, dict(data.items()))
+    return len(data)
+
+
+class AccountDB:
+    def __init__(self, path, role_name, *, shared=False, lazy=False):
+        """
+        lazy=True 時在背景執行緒載入帳號檔，server 不必等大檔解析完才開始 listen；
+        載入完成前的 register / login 會等它載完。
+        """
+        self.path = resolve_db_path(path)
         self.role_name = role_name
+        self.shared = shared  # 多 process 模式：其他 worker 也會寫這個檔
         self.lock = threading.RLock()
-        self.data = load_json(self.path, {})
-        if not isinstance(self.data, dict):
-            self.data = {}
-            save_json(self.path, self.data)
+        self.data = {}
+        self.disk_sig = None
+        self.load_ms = None
+        self._loaded = threading.Event()
+        if lazy:
+            threading.Thread(target=self._load, name=f"load-{role_name}", daemon=True).start()
+        else:
+            self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            data = load_store(self.path, {})
+            if not isinstance(data, collections.abc.MutableMapping):
+                data = {}
+                save_store(self.path, data)
+            with self.lock:
+                self.data = data
+                self.disk_sig = file_signature(self.path)
+        finally:
+            self.load_ms = round((time.perf_counter() - started) * 1000, 1)
+            self._loaded.set()
+
+    def wait_loaded(self, timeout=None) -> bool:
+        return self._loaded.wait(timeout)
+
+    def reload(self):
+        """重新讀整個帳號檔（RELOAD 用，例如手動改過檔案）"""
+        self._loaded.wait()
+        with self.lock:
+            data = load_store(self.path, None)
+            if isinstance(data, collections.abc.MutableMapping):
+                self.data = data
+                self.disk_sig = file_signature(self.path)
+
+    def _reload_if_changed(self):
+        if not self.shared:
+            return
+        sig = file_signature(self.path)
+        if sig == self.disk_sig:
+            return
+        data = load_store(self.path, {})
+        if isinstance(data, collections.abc.MutableMapping):
+            self.data = data
+        self.disk_sig = sig
 
     def register(self, username, password):
         username = (username or "").strip()
@@ -72,17 +837,26 @@ class AccountDB:
         if not username or not password:
             return False, "Bad username/password."
 
-        with self.lock:
+        self._loaded.wait()
+        with self.lock, interprocess_lock(self.path, self.shared):
+            self._reload_if_changed()
             if username in self.data:
                 return False, "Username already exists."
             self.data[username] = {'password': password, 'role': self.role_name, 'history': []}
-            save_json(self.path, self.data)
+            save_store(self.path, self.data)
+            self.disk_sig = file_signature(self.path)
         return True, "Registration successful."
 
     def login(self, username, password):
         username = (username or "").strip()
         password = (password or "").strip()
+        self._loaded.wait()
         user = self.data.get(username)
+        if not user and self.shared:
+            # 可能是在別的 worker 註冊的
+            with self.lock:
+                self._reload_if_changed()
+            user = self.data.get(username)
         if not user:
             return False, "User not found."
         if user.get('password') != password:
@@ -91,68 +865,116 @@ class AccountDB:
 
 
 class GameDB:
-    def __init__(self, path):
-        self.path = path
+    def __init__(self, path, *, shared=False, migrate=False):
+        """migrate=True 時順便把舊的單版本格式轉成多版本格式（只在 schema 遷移時需要）"""
+        self.path = resolve_db_path(path)
+        self.shared = shared  # 多 process 模式：每個 worker 有自己的快照，定期檢查檔案是否被改過
         self.lock = threading.RLock()
-        self.games = load_json(self.path, {})
-        if not isinstance(self.games, dict):
+        self.games = load_store(self.path, {})
+        if not isinstance(self.games, collections.abc.MutableMapping):
             self.games = {}
-            save_json(self.path, self.games)
+            save_store(self.path, self.games)
+        self.disk_sig = file_signature(self.path)
+        self.last_refresh_check = time.monotonic()
+
+        # game_name -> 已排序的 [Version, ...]，新增版本時以 insort 維護，不再每次重排
+        self._versions = {}
 
-        self._migrate_legacy_format_if_needed()
-        self._ensure_published_flag()
-        self._ensure_latest_version()
+        # 商城列表索引（只含已上架且有版本的遊戲），異動時增量維護
+        self._public_rows = {}       # game_name -> 列表用的 row
+        self._public_names = []      # 依名稱排序
+        self._public_by_uploader = {}  # uploader -> 依名稱排序的 game_name list
+        self._public_by_updated = []   # 依 (-updated_at, name) 排序
+        self._public_by_uploader_updated = {}  # uploader -> 依 (-updated_at, name) 排序的 key list
+        self.search_index = SearchIndex()  # 只索引已上架的遊戲
+
+        self._normalize(migrate)
+        self._build_public_index()
 
     def _save(self):
         with self.lock:
-            save_json(self.path, self.games)
+            save_store(self.path, self.games)
+            self.disk_sig = file_signature(self.path)
+
+    def _reload_locked(self):
+        games = load_store(self.path, {})
+        if not isinstance(games, collections.abc.MutableMapping):
+            return
+        self.games = games
+        self.disk_sig = file_signature(self.path)
+        for gname in self.games.keys():
+            self._index_versions(gname)
+        for gname in [g for g in self._versions if g not in self.games]:
+            del self._versions[gname]
+        self._build_public_index()
+
+    def refresh_if_stale(self, force=False):
+        """
+        檔案被其他 worker 改過時重新載入整份快照（只在 shared 模式下作用）。
+        回傳是否有重新載入。
+        """
+        if not self.shared:
+            return False
+        now = time.monotonic()
+        if not force and now - self.last_refresh_check < CATALOG_REFRESH_SEC:
+            return False
+        self.last_refresh_check = now
+        if file_signature(self.path) == self.disk_sig:
+            return False
+        with self.lock:
+            self._reload_locked()
+        return True
+
+    @contextlib.contextmanager
+    def _mutation(self):
+        # 寫入前拿 process 間的檔案鎖並確認手上是最新版本，避免蓋掉別的 worker 的修改
+        with self.lock, interprocess_lock(self.path, self.shared):
+            if self.shared and file_signature(self.path) != self.disk_sig:
+                self._reload_locked()
+            yield
+
+    def _index_versions(self, game_name: str):
+        ginfo = self.games.get(game_name)
+        versions = ginfo.get('versions', {}) if isinstance(ginfo, dict) else {}
+        if not isinstance(versions, dict):
+            versions = {}
+        self._versions[game_name] = sorted(parse_version(v) for v in versions.keys())
+        return self._versions[game_name]
+
+    @staticmethod
+    def _convert_legacy(gname, ginfo):
+        v = str(ginfo.get('version'))
+        return {
+            'name': ginfo.get('name', gname),
+            'uploader': ginfo.get('uploader', ''),
+            'description': ginfo.get('description', ''),
+            'published': True,
+            'latest_version': v,
+            'versions': {
+                v: {'version': v, 'file_path': ginfo.get('file_path', ''), 'description': ginfo.get('description', '')}
+            }
+        }
 
-    def _migrate_legacy_format_if_needed(self):
+    def _normalize(self, migrate=False):
+        """
+        載入時的單次掃描：建版本索引、補 published 旗標、修正 latest_version，
+        有改動才寫回一次。舊單版本格式的轉換只在 migrate=True（schema 遷移）時做。
+        """
         with self.lock:
             changed = False
             for gname, ginfo in list(self.games.items()):
                 if not isinstance(ginfo, dict):
                     continue
-                if isinstance(ginfo.get('versions'), dict):
-                    continue
-                if 'version' in ginfo and 'file_path' in ginfo:
-                    v = str(ginfo.get('version'))
-                    self.games[gname] = {
-                        'name': ginfo.get('name', gname),
-                        'uploader': ginfo.get('uploader', ''),
-                        'description': ginfo.get('description', ''),
-                        'published': True,
-                        'latest_version': v,
-                        'versions': {
-                            v: {'version': v, 'file_path': ginfo.get('file_path', ''), 'description': ginfo.get('description', '')}
-                        }
-                    }
+                if migrate and not isinstance(ginfo.get('versions'), dict) \
+                        and 'version' in ginfo and 'file_path' in ginfo:
+                    ginfo = self.games[gname] = self._convert_legacy(gname, ginfo)
                     changed = True
-            if changed:
-                self._save()
-
-    def _ensure_published_flag(self):
-        with self.lock:
-            changed = False
-            for _, ginfo in self.games.items():
-                if isinstance(ginfo, dict) and 'published' not in ginfo:
+                if 'published' not in ginfo:
                     ginfo['published'] = True
                     changed = True
-            if changed:
-                self._save()
-
-    def _ensure_latest_version(self):
-        with self.lock:
-            changed = False
-            for _, ginfo in self.games.items():
-                if not isinstance(ginfo, dict):
-                    continue
-                versions = ginfo.get('versions', {}) or {}
-                if not versions:
-                    continue
-                best = sorted(versions.keys(), key=version_key)[-1]
-                if ginfo.get('latest_version') != best:
-                    ginfo['latest_version'] = best
+                ordered = self._index_versions(gname)
+                if ordered and ginfo.get('latest_version') != ordered[-1].raw:
+                    ginfo['latest_version'] = ordered[-1].raw
                     changed = True
             if changed:
                 self._save()
@@ -164,14 +986,20 @@ class GameDB:
         g = self.games.get(game_name, {})
         return g.get('uploader', '') if isinstance(g, dict) else ''
 
-    def add_game_version(self, game_name: str, uploader: str, version: str, description: str, file_path: str):
+    def add_game_version(self, game_name: str, uploader: str, version: str, description: str, file_path: str,
+                         size: int = None, meta: dict = None, exclusive: bool = False):
+        """
+        meta：其他要記在版本上的欄位（例如上傳流程算出的 sha256 / manifest）。
+        exclusive=True 時版本已存在就丟 ValueError：檢查和寫入在同一個 _mutation 裡（多 process 時持有檔案鎖），
+        不同 worker 同時上傳同一個版本只有一個會成功。
+        """
         game_name = (game_name or '').strip()
         uploader = (uploader or '').strip()
         version = str(version or '').strip()
         if not game_name or not uploader or not version:
             raise ValueError("bad game_name/uploader/version")
 
-        with self.lock:
+        with self._mutation():
             if game_name not in self.games:
                 self.games[game_name] = {
                     'name': game_name,
@@ -188,35 +1016,52 @@ class GameDB:
 
             if 'versions' not in self.games[game_name] or not isinstance(self.games[game_name]['versions'], dict):
                 self.games[game_name]['versions'] = {}
+            if exclusive and version in self.games[game_name]['versions']:
+                raise ValueError("Version already exists")
 
             if description:
                 self.games[game_name]['description'] = description
+            self.games[game_name]['updated_at'] = int(time.time())
 
+            is_new_version = version not in self.games[game_name]['versions']
             self.games[game_name]['versions'][version] = {
                 'version': version,
                 'file_path': file_path,
                 'description': description or ''
             }
+            if size is not None:
+                # 給 StorageGC 比對檔案大小
+                self.games[game_name]['versions'][version]['size'] = int(size)
+            if meta:
+                self.games[game_name]['versions'][version].update(meta)
+
+            ordered = self._versions.get(game_name)
+            if ordered is None:
+                ordered = self._index_versions(game_name)
+            elif is_new_version:
+                bisect.insort(ordered, parse_version(version))
 
             cur_latest = self.games[game_name].get('latest_version')
-            if (cur_latest is None) or (version_key(version) >= version_key(cur_latest)):
+            if (cur_latest is None) or (parse_version(version) >= parse_version(cur_latest)):
                 self.games[game_name]['latest_version'] = version
 
+            self._reindex_public(game_name)
             self._save()
 
     def set_game_published(self, game_name: str, uploader: str, published: bool):
-        with self.lock:
+        with self._mutation():
             if game_name not in self.games:
                 return False, "Game not found."
             ginfo = self.games[game_name]
             if ginfo.get('uploader') != uploader:
                 return False, "No permission to unpublish this game."
             ginfo['published'] = bool(published)
+            self._reindex_public(game_name)
             self._save()
             return True, "OK"
 
     def delete_game_permanently(self, game_name: str, uploader: str, *, delete_files: bool = True):
-        with self.lock:
+        with self._mutation():
             if game_name not in self.games:
                 return False, "Game not found."
             ginfo = self.games[game_name]
@@ -232,8 +1077,11 @@ class GameDB:
                         file_paths.append(fp)
 
             del self.games[game_name]
+            self._versions.pop(game_name, None)
+            self._reindex_public(game_name)
             self._save()
 
+        failed = 0
         if delete_files:
             for fp in file_paths:
                 abs_path = os.path.abspath(os.path.join(STORAGE_DIR, fp))
@@ -241,14 +1089,40 @@ class GameDB:
                 if abs_path.startswith(storage_abs) and os.path.exists(abs_path):
                     try:
                         os.remove(abs_path)
-                    except:
-                        pass
+                    except OSError as e:
+                        # catalog 已經刪掉了，留下的檔案之後由 StorageGC 當孤兒檔回收
+                        print(f"[!] Cannot remove {abs_path}: {e}")
+                        failed += 1
 
+        if failed:
+            return True, f"OK ({failed} file(s) could not be removed and will be reclaimed later)"
         return True, "OK"
 
+    def sorted_versions(self, game_name: str):
+        """回傳由舊到新的版本字串（使用快取的排序結果）"""
+        ordered = self._versions.get(game_name)
+        if ordered is None:
+            with self.lock:
+                ordered = self._index_versions(game_name)
+        return [v.raw for v in ordered]
+
+    def latest_version_matching(self, game_name: str, spec: str):
+        """
+        範圍查詢，例如 "1.x" 取得 1 開頭的最新正式版；找不到回傳 None。
+        """
+        ordered = self._versions.get(game_name)
+        if ordered is None:
+            with self.lock:
+                ordered = self._index_versions(game_name)
+        for v in reversed(ordered):
+            if version_matches(v, spec):
+                return v.raw
+        return None
+
     def list_games_by_uploader(self, uploader: str):
         result = []
-        for gname, ginfo in self.games.items():
+        for gname in sorted(self.games.keys()):
+            ginfo = self.games.get(gname)
             if not isinstance(ginfo, dict):
                 continue
             if ginfo.get('uploader') != uploader:
@@ -256,7 +1130,8 @@ class GameDB:
 
             published = bool(ginfo.get('published', True))
             versions = ginfo.get('versions', {}) or {}
-            for v, vinfo in versions.items():
+            for v in self.sorted_versions(gname):
+                vinfo = versions.get(v)
                 result.append({
                     'name': ginfo.get('name', gname),
                     'version': str(v),
@@ -267,36 +1142,220 @@ class GameDB:
                     'latest_version': ginfo.get('latest_version')
                 })
 
-        result.sort(key=lambda x: (x.get('name', ''), version_key(x.get('version', '0'))))
         return result
 
+    def _make_public_row(self, gname: str):
+        ginfo = self.games.get(gname)
+        if not isinstance(ginfo, dict):
+            return None
+        if not bool(ginfo.get('published', True)):
+            return None
+
+        versions = ginfo.get('versions', {}) or {}
+        if not versions:
+            return None
+
+        latest_version = ginfo.get('latest_version')
+        if not latest_version:
+            latest_version = self.sorted_versions(gname)[-1]
+
+        vinfo = versions.get(latest_version, {}) or {}
+
+        return {
+            'name': ginfo.get('name', gname),
+            'uploader': ginfo.get('uploader', ''),
+            'description': vinfo.get('description') or ginfo.get('description', '') or "尚未提供簡介",
+            'latest_version': latest_version
+        }
+
+    def _unindex_public(self, gname: str):
+        row = self._public_rows.pop(gname, None)
+        if row is None:
+            return
+        i = bisect.bisect_left(self._public_names, gname)
+        if i < len(self._public_names) and self._public_names[i] == gname:
+            self._public_names.pop(i)
+        names = self._public_by_uploader.get(row['uploader'])
+        if names is not None:
+            i = bisect.bisect_left(names, gname)
+            if i < len(names) and names[i] == gname:
+                names.pop(i)
+            if not names:
+                del self._public_by_uploader[row['uploader']]
+        key = row['_updated_key']
+        i = bisect.bisect_left(self._public_by_updated, key)
+        if i < len(self._public_by_updated) and self._public_by_updated[i] == key:
+            self._public_by_updated.pop(i)
+        keys = self._public_by_uploader_updated.get(row['uploader'])
+        if keys is not None:
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                keys.pop(i)
+            if not keys:
+                del self._public_by_uploader_updated[row['uploader']]
+
+    def _search_fields(self, gname: str, row: dict):
+        ginfo = self.games.get(gname) or {}
+        desc = row.get('description', '')
+        game_desc = ginfo.get('description', '') or ''
+        if game_desc and game_desc != desc:
+            desc = f"{desc}\n{game_desc}"
+        return {'name': row.get('name', gname), 'description': desc}
+
+    def _reindex_public(self, gname: str):
+        with self.lock:
+            self._unindex_public(gname)
+            row = self._make_public_row(gname)
+            if row is None:
+                self.search_index.remove(gname)
+                return
+            self.search_index.add(gname, self._search_fields(gname, row))
+            updated_at = int((self.games.get(gname) or {}).get('updated_at', 0) or 0)
+            row['_updated_key'] = (-updated_at, gname)
+            self._public_rows[gname] = row
+            bisect.insort(self._public_names, gname)
+            bisect.insort(self._public_by_uploader.setdefault(row['uploader'], []), gname)
+            bisect.insort(self._public_by_updated, row['_updated_key'])
+            bisect.insort(self._public_by_uploader_updated.setdefault(row['uploader'], []), row['_updated_key'])
+
+    def _build_public_index(self):
+        with self.lock:
+            self._public_rows = {}
+            self._public_names = []
+            self._public_by_uploader = {}
+            self._public_by_updated = []
+            self._public_by_uploader_updated = {}
+            self.search_index = SearchIndex()
+            for gname in self.games.keys():
+                row = self._make_public_row(gname)
+                if row is None:
+                    continue
+                self.search_index.add(gname, self._search_fields(gname, row))
+                updated_at = int((self.games.get(gname) or {}).get('updated_at', 0) or 0)
+                row['_updated_key'] = (-updated_at, gname)
+                self._public_rows[gname] = row
+                self._public_by_uploader.setdefault(row['uploader'], []).append(gname)
+                self._public_by_updated.append(row['_updated_key'])
+                self._public_by_uploader_updated.setdefault(row['uploader'], []).append(row['_updated_key'])
+            self._public_names = sorted(self._public_rows.keys())
+            for names in self._public_by_uploader.values():
+                names.sort()
+            self._public_by_updated.sort()
+            for keys in self._public_by_uploader_updated.values():
+                keys.sort()
+
+    @staticmethod
+    def _public_view(row):
+        return {k: v for k, v in row.items() if not k.startswith('_')}
+
     def list_public_games(self):
+        with self.lock:
+            return [self._public_view(self._public_rows[n]) for n in self._public_names]
+
+    def search_public_games(self, query: str, limit=None):
+        limit = SEARCH_LIMIT_DEFAULT if limit is None else int(limit)
+        limit = max(1, min(limit, SEARCH_LIMIT_MAX))
         result = []
-        for gname, ginfo in self.games.items():
-            if not isinstance(ginfo, dict):
-                continue
-            if not bool(ginfo.get('published', True)):
+        for gname, score in self.search_index.search(query, limit):
+            row = self._public_rows.get(gname)
+            if row is None:
                 continue
+            item = self._public_view(row)
+            item['score'] = round(score, 4)
+            result.append(item)
+        return result
 
-            versions = ginfo.get('versions', {}) or {}
-            if not versions:
-                continue
+    @staticmethod
+    def _encode_cursor(sort: str, key):
+        raw = json.dumps([sort, key], ensure_ascii=False).encode('utf-8')
+        return base64.urlsafe_b64encode(raw).decode('ascii')
 
-            latest_version = ginfo.get('latest_version')
-            if not latest_version:
-                latest_version = sorted(versions.keys(), key=version_key)[-1]
+    @staticmethod
+    def _decode_cursor(cursor: str, sort: str):
+        try:
+            c_sort, key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except Exception:
+            raise ValueError("bad cursor")
+        if c_sort != sort:
+            raise ValueError("cursor does not match sort order")
+        return tuple(key) if isinstance(key, list) else key
 
-            vinfo = versions.get(latest_version, {}) or {}
+    def query_public_games(self, *, limit=None, cursor=None, sort='name',
+                           uploader=None, prefix=None, open_games=None):
+        """
+        分頁查詢商城列表（cursor-based）。
+        - sort: 'name' / 'name_desc' / 'updated'（最近更新在前）
+        - uploader / prefix / open_games（有 OPEN 房間的遊戲名集合）為 server 端篩選
+        uploader 與 open_games 在兩種排序下都從各自的索引開始走；prefix 只有依名稱排序時能用 bisect 定位，
+        sort='updated' 搭配 prefix 會逐筆檢查（最壞 O(該 uploader / 整個商城的遊戲數)）。
+        回傳 (games, next_cursor)；沒有下一頁時 next_cursor 為 None。
+        """
+        sort = sort or 'name'
+        if sort not in STORE_SORT_ORDERS:
+            raise ValueError(f"unknown sort order: {sort}")
+        limit = STORE_PAGE_SIZE if limit is None else int(limit)
+        limit = max(1, min(limit, STORE_PAGE_SIZE_MAX))
+        prefix = prefix or ''
+        after = self._decode_cursor(cursor, sort) if cursor else None
 
-            result.append({
-                'name': ginfo.get('name', gname),
-                'uploader': ginfo.get('uploader', ''),
-                'description': vinfo.get('description') or ginfo.get('description', '') or "尚未提供簡介",
-                'latest_version': latest_version
-            })
+        with self.lock:
+            if sort == 'updated':
+                if open_games is not None:
+                    keys = sorted(self._public_rows[n]['_updated_key'] for n in open_games if n in self._public_rows)
+                elif uploader is not None:
+                    keys = self._public_by_uploader_updated.get(uploader, [])
+                else:
+                    keys = self._public_by_updated
+                start = bisect.bisect_right(keys, after) if after is not None else 0
+                candidates = self._iter_from(keys, start, lambda k: k[1])
+            else:
+                # 從最小的候選集合開始走：有房間的遊戲通常遠少於整個商城
+                if open_games is not None:
+                    names = sorted(n for n in open_games if n in self._public_rows)
+                elif uploader is not None:
+                    names = self._public_by_uploader.get(uploader, [])
+                else:
+                    names = self._public_names
 
-        result.sort(key=lambda x: x.get('name', ''))
-        return result
+                if sort == 'name':
+                    lo = bisect.bisect_left(names, prefix) if prefix else 0
+                    if after is not None:
+                        lo = max(lo, bisect.bisect_right(names, after))
+                    candidates = self._iter_from(names, lo, None)
+                else:
+                    hi = len(names)
+                    if prefix:
+                        hi = bisect.bisect_left(names, prefix + '\U0010ffff')
+                    if after is not None:
+                        hi = min(hi, bisect.bisect_left(names, after))
+                    candidates = (names[i] for i in range(hi - 1, -1, -1))
+
+            page = []
+            last_key = None
+            for gname in candidates:
+                row = self._public_rows.get(gname)
+                if row is None:
+                    continue
+                if prefix and not gname.startswith(prefix):
+                    if sort == 'name':
+                        break
+                    if sort == 'name_desc' and gname < prefix:
+                        break
+                    continue
+                if uploader is not None and row['uploader'] != uploader:
+                    continue
+                if open_games is not None and gname not in open_games:
+                    continue
+                if len(page) == limit:
+                    return page, self._encode_cursor(sort, last_key)
+                page.append(self._public_view(row))
+                last_key = list(row['_updated_key']) if sort == 'updated' else gname
+            return page, None
+
+    @staticmethod
+    def _iter_from(seq, start, key):
+        for i in range(start, len(seq)):
+            yield seq[i] if key is None else key(seq[i])
 
     def get_game_detail(self, game_name: str):
         ginfo = self.games.get(game_name)
@@ -305,13 +1364,16 @@ class GameDB:
 
         versions = ginfo.get('versions', {}) or {}
         version_list = []
-        for v, vinfo in versions.items():
+        for v in self.sorted_versions(game_name):
+            vinfo = versions.get(v)
             version_list.append({
                 'version': str(v),
                 'description': (vinfo or {}).get('description', ginfo.get('description', '')) or "尚未提供簡介",
                 'file_path': (vinfo or {}).get('file_path', '')
             })
-        version_list.sort(key=lambda x: version_key(x['version']))
+            for key in ('size', 'sha256'):
+                if key in (vinfo or {}):
+                    version_list[-1][key] = vinfo[key]
 
         latest_version = ginfo.get('latest_version')
         if not latest_version and version_list:
@@ -326,6 +1388,14 @@ class GameDB:
             'versions': version_list
         }
 
+    def version_info(self, game_name: str, version: str):
+        """某個版本在 catalog 裡的紀錄（複本），沒有時回傳 None"""
+        ginfo = self.games.get(game_name)
+        if not isinstance(ginfo, dict):
+            return None
+        vinfo = (ginfo.get('versions', {}) or {}).get(version)
+        return dict(vinfo) if isinstance(vinfo, dict) else None
+
     def resolve_zip_path(self, game_name: str, version: str):
         ginfo = self.games.get(game_name)
         if not isinstance(ginfo, dict):
@@ -349,6 +1419,65 @@ class GameDB:
             return None
         return abs_path
 
+    def storage_references(self):
+        """
+        catalog 參照到的所有檔案：絕對路徑 -> {'game', 'version', 'file_path', 'size', 'tier', 'saved_bytes'}
+        （size 沒紀錄時為 None）。
+        不論是否上架都算，超出 STORAGE_DIR 的路徑略過。
+        """
+        storage_abs = os.path.abspath(STORAGE_DIR)
+        refs = {}
+        with self.lock:
+            for gname, ginfo in self.games.items():
+                versions = ginfo.get('versions') if isinstance(ginfo, dict) else None
+                if not isinstance(versions, dict):
+                    continue
+                for ver, vinfo in versions.items():
+                    fp = vinfo.get('file_path') if isinstance(vinfo, dict) else None
+                    if not fp:
+                        continue
+                    abs_path = os.path.abspath(os.path.join(STORAGE_DIR, fp))
+                    if not abs_path.startswith(storage_abs + os.sep):
+                        continue
+                    refs[abs_path] = {'game': gname, 'version': ver, 'file_path': fp, 'size': vinfo.get('size'),
+                                      'tier': vinfo.get('tier', 'hot'), 'saved_bytes': vinfo.get('saved_bytes', 0)}
+        return refs
+
+    def set_version_tier(self, game_name: str, version: str, tier: str, *, size: int = None, saved_bytes: int = 0,
+                         sha256: str = None):
+        """ColdTiering 重新壓縮後更新版本的儲存資訊；版本已不存在時回傳 False"""
+        with self._mutation():
+            ginfo = self.games.get(game_name)
+            vinfo = (ginfo.get('versions') or {}).get(version) if isinstance(ginfo, dict) else None
+            if not isinstance(vinfo, dict):
+                return False
+            vinfo['tier'] = tier
+            if size is not None:
+                vinfo['size'] = int(size)
+            vinfo['saved_bytes'] = vinfo.get('saved_bytes', 0) + saved_bytes
+            if sha256:
+                vinfo['sha256'] = sha256
+            self._save()
+            return True
+
+    def record_version_hash(self, game_name: str, version: str, sha256: str, signature) -> bool:
+        """
+        補上舊版本缺少的 sha256（第一次申請下載 ticket 時才算）。
+        signature 是算 hash 時檔案的 file_signature；這段期間檔案被換過（例如 ColdTiering 重新壓縮）就不寫入。
+        """
+        with self._mutation():
+            ginfo = self.games.get(game_name)
+            vinfo = (ginfo.get('versions') or {}).get(version) if isinstance(ginfo, dict) else None
+            if not isinstance(vinfo, dict) or vinfo.get('sha256'):
+                return False
+            abs_path = self.resolve_zip_path(game_name, version)
+            if abs_path is None or file_signature(abs_path) != signature:
+                return False
+            vinfo['sha256'] = sha256
+            vinfo['size'] = signature[1]
+            self._save()
+            return True
+
     def is_published(self, game_name: str) -> bool:
         g = self.games.get(game_name)
         if not isinstance(g, dict):
@@ -406,25 +1535,248 @@ def migrate_old_database_if_exists():
         save_json(GAMES_DB_PATH, games)
 
 
+def run_migrations():
+    """
+    依 schema 標記檔只跑還沒跑過的遷移，跑完寫入目前版本；
+    已是最新版本時只讀這個小檔，不會載入舊資料庫或整份 games.json。
+    """
+    marker = load_json(SCHEMA_MARKER_PATH, {})
+    current = marker.get('version', 0) if isinstance(marker, dict) else 0
+    if current >= SCHEMA_VERSION:
+        return False
+    with interprocess_lock(SCHEMA_MARKER_PATH):
+        if current < 1:
+            migrate_old_database_if_exists()
+        if current < 2:
+            GameDB(GAMES_DB_PATH, migrate=True)
+        save_json(SCHEMA_MARKER_PATH, {'version': SCHEMA_VERSION, 'migrated_at': int(time.time())})
+    print(f"[*] Data migrated from schema {current} to {SCHEMA_VERSION}")
+    return True
+
+
+class PortAllocator:
+    """
+    房間 port 分配器：
+    - 以「observed IP」為單位各自維護一張 bitmap（同一個 NAT 後的多台 host 共用同一張，不會撞 port）
+    - next-fit 掃描，房間關閉/過期時 release 歸還
+    - host 回報實際 bind 到的 port（可能在範圍外）時以 reassign 轉移 lease
+    """
+
+    def __init__(self, port_range=ROOM_PORT_RANGE):
+        self.start, self.end = int(port_range[0]), int(port_range[1])
+        if not (0 < self.start < self.end <= 65536):
+            raise ValueError(f"bad port range: {port_range}")
+        self.size = self.end - self.start
+        self.bitmaps = {}    # observed_ip -> bytearray（1 = 已被租用）
+        self.cursors = {}    # observed_ip -> 下一次開始掃描的 offset
+        self.counts = {}     # observed_ip -> 範圍內已租用的數量
+        self.extra = {}      # observed_ip -> 範圍外（host 自行回報）的 port set
+        self.leases = {}     # room_id -> (observed_ip, host_key, port)
+        self.host_ports = {}  # (observed_ip, reported_ip) -> set(port)
+
+    def _mark(self, ip, port, used: bool):
+        if self.start <= port < self.end:
+            bm = self.bitmaps.setdefault(ip, bytearray(self.size))
+            bm[port - self.start] = 1 if used else 0
+            self.counts[ip] = self.counts.get(ip, 0) + (1 if used else -1)
+            if not used and self.counts[ip] == 0:
+                self.bitmaps.pop(ip, None)
+                self.counts.pop(ip, None)
+                self.cursors.pop(ip, None)
+        else:
+            ports = self.extra.setdefault(ip, set())
+            if used:
+                ports.add(port)
+            else:
+                ports.discard(port)
+                if not ports:
+                    del self.extra[ip]
+
+    def is_free(self, ip, port) -> bool:
+        if self.start <= port < self.end:
+            bm = self.bitmaps.get(ip)
+            return bm is None or not bm[port - self.start]
+        return port not in self.extra.get(ip, ())
+
+    def _lease(self, rid, ip, host_key, port):
+        self._mark(ip, port, True)
+        self.leases[rid] = (ip, host_key, port)
+        self.host_ports.setdefault(host_key, set()).add(port)
+
+    def allocate(self, rid, observed_ip, reported_ip=''):
+        ip = observed_ip or ''
+        if self.counts.get(ip, 0) >= self.size:
+            return None
+        bm = self.bitmaps.setdefault(ip, bytearray(self.size))
+        cur = self.cursors.get(ip, 0)
+        idx = bm.find(0, cur)
+        if idx < 0:
+            idx = bm.find(0, 0, cur)
+        if idx < 0:
+            return None
+        self.cursors[ip] = (idx + 1) % self.size
+        port = self.start + idx
+        self._lease(rid, ip, (ip, reported_ip or ''), port)
+        return port
+
+    def release(self, rid):
+        lease = self.leases.pop(rid, None)
+        if lease is None:
+            return
+        ip, host_key, port = lease
+        self._mark(ip, port, False)
+        ports = self.host_ports.get(host_key)
+        if ports is not None:
+            ports.discard(port)
+            if not ports:
+                del self.host_ports[host_key]
+
+    def reassign(self, rid, port):
+        lease = self.leases.get(rid)
+        if lease is None:
+            return False, "No port lease for room."
+        ip, host_key, old = lease
+        if port == old:
+            return True, "OK"
+        if not self.is_free(ip, port):
+            return False, "Port already used by another room behind the same IP."
+        self.release(rid)
+        self._lease(rid, ip, host_key, port)
+        return True, "OK"
+
+
 class RoomManager:
-    def __init__(self):
+    def __init__(self, ttl_sec: float = ROOM_TTL_SEC, port_range=ROOM_PORT_RANGE):
         self.lock = threading.RLock()
         self.next_id = 1001
         self.rooms = {}
+        self.ttl_sec = float(ttl_sec)
+        self.ports = PortAllocator(port_range)
 
-    def _alloc_port(self, rid: int) -> int:
-        return 50000 + (rid % 1000)
+        # 依到期時間排序的 min-heap：(deadline, room_id)。
+        # heartbeat 不動 heap，只更新 last_heartbeat；pop 到還沒真正到期的房間時再依實際期限放回去，
+        # 所以每次清理只碰到「期限已到」的項目，不用掃全部房間。
+        # 關房時會另外排一個立即到期的項目，舊的那個就作廢：expiry_due 記每個房間唯一有效的 deadline，
+        # 跟它對不上的項目 pop 到時直接丟掉。
+        self.expiry_heap = []
+        self.expiry_due = {}  # room_id -> heap 裡有效項目的 deadline
+        # 回收執行緒在這個 condition 上睡到 heap 頂端到期；有更早的項目排進來時叫醒它
+        self.expiry_cond = threading.Condition(self.lock)
+        self.open_count = {}  # game_name -> OPEN 房間數（商城「有房間」篩選用）
+
+        # 查詢索引：LIST_ROOMS 只看符合條件的房間，不用複製/排序全部
+        self.by_game = {}    # game_name -> {version: set(room_id)}
+        self.by_status = {}  # status -> set(room_id)
+        self.by_host = {}    # host user -> set(room_id)，一次 session heartbeat 續約全部
+
+        # QUICK_JOIN：每個 (game, version) 一個 max-heap（以人數排序）記錄還有空位的房間，
+        # 項目為 (-players, room_id)，人數變動就 push 新項目，過期項目在 pop 時丟掉。
+        self.joinable = {}
+        self.mm_queues = {}        # (game, version) -> OrderedDict(user -> 排隊資訊)
+        self.mm_assignments = {}   # user -> 已配對好、等待該玩家下次 poll 取走的結果
+        self.mm_waits = collections.deque(maxlen=1000)
+        self.mm_stats = {'matched': 0, 'hosts_promoted': 0, 'timeouts': 0, 'cancelled': 0}
+
+    def _set_status(self, room, status):
+        old = room.get('status')
+        if old == status:
+            return
+        room['status'] = status
+        rid = room.get('room_id')
+        ids = self.by_status.get(old)
+        if ids is not None:
+            ids.discard(rid)
+            if not ids:
+                del self.by_status[old]
+        if status != 'REMOVED':
+            self.by_status.setdefault(status, set()).add(rid)
+        g = room.get('game_name')
+        if old == 'OPEN':
+            n = self.open_count.get(g, 0) - 1
+            if n > 0:
+                self.open_count[g] = n
+            else:
+                self.open_count.pop(g, None)
+        if status == 'OPEN':
+            self.open_count[g] = self.open_count.get(g, 0) + 1
+
+    def _remove_room(self, rid):
+        room = self.rooms.pop(rid, None)
+        if room is not None:
+            self._set_status(room, 'REMOVED')
+            self.ports.release(rid)
+            hosted = self.by_host.get(room.get('host'))
+            if hosted is not None:
+                hosted.discard(rid)
+                if not hosted:
+                    del self.by_host[room.get('host')]
+            versions = self.by_game.get(room.get('game_name'), {})
+            ids = versions.get(room.get('version'))
+            if ids is not None:
+                ids.discard(rid)
+                if not ids:
+                    del versions[room.get('version')]
+            if not versions:
+                self.by_game.pop(room.get('game_name'), None)
+        return room
+
+    def _schedule_expiry(self, rid, deadline):
+        # 呼叫端持有 self.lock
+        self.expiry_due[rid] = deadline
+        heapq.heappush(self.expiry_heap, (deadline, rid))
+        if self.expiry_heap[0] == (deadline, rid):
+            self.expiry_cond.notify()
+
+    def _schedule_reap(self, rid):
+        # 已關閉的房間不必等 TTL，排一個立即到期的項目並叫醒回收執行緒
+        self._schedule_expiry(rid, time.time())
+
+    def export_state(self):
+        """graceful restart 用的可序列化快照；只保留 OPEN 的房間，配對佇列不保留（client 下次輪詢會重新排隊）"""
+        with self.lock:
+            return {
+                'next_id': self.next_id,
+                'rooms': [self._room_view(r) for r in self.rooms.values() if r.get('status') == 'OPEN'],
+            }
+
+    def import_state(self, state):
+        """接回 export_state 的房間：重建 port lease、各索引與到期 heap"""
+        with self.lock:
+            self.next_id = max(self.next_id, int(state.get('next_id', self.next_id)))
+            for room in state.get('rooms', []):
+                rid = int(room['room_id'])
+                observed = room.get('observed_host_ip') or ''
+                port = int(room['port'])
+                if rid in self.rooms or not self.ports.is_free(observed, port):
+                    continue
+                self.ports._lease(rid, observed, (observed, room.get('reported_host_ip') or ''), port)
+                status = room.get('status', 'OPEN')
+                room['status'] = None
+                self.rooms[rid] = room
+                self.by_game.setdefault(room['game_name'], {}).setdefault(room['version'], set()).add(rid)
+                self.by_host.setdefault(room['host'], set()).add(rid)
+                self._set_status(room, status)
+                self._touch_joinable(room)
+                self._schedule_expiry(rid, float(room.get('last_heartbeat', time.time())) + self.ttl_sec)
+            return len(self.rooms)
+
+    def games_with_open_rooms(self):
+        with self.lock:
+            return set(self.open_count.keys())
 
     def create_room(self, host_user, reported_host_ip, observed_host_ip, game_name, version, max_players=3):
+        """建立房間；port 範圍用完時回傳 None。"""
         with self.lock:
+            reported_host_ip = (reported_host_ip or "").strip()
+            observed_host_ip = (observed_host_ip or "").strip()
+
             rid = self.next_id
+            port = self.ports.allocate(rid, observed_host_ip, reported_host_ip)
+            if port is None:
+                return None
             self.next_id += 1
-            port = self._alloc_port(rid)
             now = time.time()
 
-            reported_host_ip = (reported_host_ip or "").strip()
-            observed_host_ip = (observed_host_ip or "").strip()
-
             # 預設給舊 client 用的 host_ip：先用 reported（LAN），沒有才 observed（public）
             host_ip = reported_host_ip if reported_host_ip else observed_host_ip
 
@@ -441,23 +1793,63 @@ class RoomManager:
                 'port': port,
                 'players': [host_user],
                 'max_players': int(max_players),
-                'status': 'OPEN',
+                'status': 'NEW',
                 'created_at': int(now),
                 'last_heartbeat': now
             }
             self.rooms[rid] = room
-            return room
+            self.by_game.setdefault(game_name, {}).setdefault(version, set()).add(rid)
+            self.by_host.setdefault(host_user, set()).add(rid)
+            self._set_status(room, 'OPEN')
+            self._touch_joinable(room)
+            self._schedule_expiry(rid, now + self.ttl_sec)
+            return self._room_view(room)
 
 
-    def list_rooms(self):
+    @staticmethod
+    def _room_view(room):
+        # 回傳副本，避免在 lock 外序列化時 players 被其他執行緒改動
+        view = dict(room)
+        view['players'] = list(room.get('players', []))
+        return view
+
+    def list_rooms(self, status=None, game_name=None, version=None, has_free_slot=False):
+        """
+        依條件列出房間（依 room_id 排序）。條件都走索引：
+        先取 (game_name, version) 與 status 兩個候選集合中較小的，再檢查其餘條件。
+        """
         with self.lock:
-            rooms = list(self.rooms.values())
-        rooms.sort(key=lambda r: r['room_id'])
+            candidates = []
+            if game_name is not None:
+                versions = self.by_game.get(game_name, {})
+                if version is not None:
+                    candidates.append(versions.get(version, set()))
+                else:
+                    candidates.append(set().union(*versions.values()) if versions else set())
+            if status is not None:
+                candidates.append(self.by_status.get(status, set()))
+
+            if candidates:
+                candidates.sort(key=len)
+                others = candidates[1:]
+                ids = [rid for rid in candidates[0] if all(rid in o for o in others)]
+            else:
+                ids = list(self.rooms.keys())
+
+            rooms = []
+            for rid in sorted(ids):
+                room = self.rooms.get(rid)
+                if room is None:
+                    continue
+                if has_free_slot and len(room['players']) >= room['max_players']:
+                    continue
+                rooms.append(self._room_view(room))
         return rooms
 
     def get_room(self, rid):
         with self.lock:
-            return self.rooms.get(rid)
+            room = self.rooms.get(rid)
+            return self._room_view(room) if room else None
 
     def join_room(self, rid, user):
         with self.lock:
@@ -471,6 +1863,7 @@ class RoomManager:
             if len(room['players']) >= room['max_players']:
                 return False, "Room is full."
             room['players'].append(user)
+            self._touch_joinable(room)
             return True, "Joined."
 
     def leave_room(self, rid, user):
@@ -482,22 +1875,227 @@ class RoomManager:
                 return False, "Not in room."
             room['players'].remove(user)
             if user == room['host']:
-                room['status'] = 'CLOSED'
+                self._set_status(room, 'CLOSED')
             if len(room['players']) == 0:
-                room['status'] = 'CLOSED'
+                self._set_status(room, 'CLOSED')
+            if room['status'] == 'CLOSED':
+                self._schedule_reap(rid)
+            else:
+                self._touch_joinable(room)
             return True, "Left."
 
     def heartbeat(self, rid: int, user: str):
+        lease = self.renew_leases(user, [rid])
+        if lease['renewed']:
+            return True, "OK"
+        return False, lease['failed'][rid]
+
+    def renew_leases(self, user: str, room_ids=None):
+        """
+        續約 user 當 host 的房間 lease（room_ids 為 None 表示全部）。
+        回傳 renewed / failed 清單，以及 lease 長度與建議的下次 heartbeat 間隔（lease 的 1/3）。
+        """
+        now = time.time()
+        renewed, failed = [], {}
+        with self.lock:
+            ids = self.by_host.get(user, set()) if room_ids is None else room_ids
+            for rid in sorted(ids):
+                room = self.rooms.get(rid)
+                if not room:
+                    failed[rid] = "Room not found."
+                elif room.get('host') != user:
+                    failed[rid] = "Only host can heartbeat."
+                elif room.get('status') != 'OPEN':
+                    failed[rid] = "Room is not open."
+                else:
+                    room['last_heartbeat'] = now
+                    renewed.append(rid)
+        return {
+            'renewed': renewed,
+            'failed': failed,
+            'lease_sec': self.ttl_sec,
+            'next_heartbeat_sec': round(self.ttl_sec / 3.0, 2),
+        }
+
+    # ---------- QUICK_JOIN matchmaking ----------
+    def _touch_joinable(self, room):
+        if room.get('status') != 'OPEN' or len(room['players']) >= room['max_players']:
+            return
+        key = (room['game_name'], room['version'])
+        heap = self.joinable.setdefault(key, [])
+        heapq.heappush(heap, (-len(room['players']), room['room_id']))
+        # 過期項目太多時重建，避免 heap 無限長大
+        if len(heap) > 64 and len(heap) > 4 * len(self.by_game.get(key[0], {}).get(key[1], ())):
+            live = []
+            for rid in self.by_game.get(key[0], {}).get(key[1], ()):
+                r = self.rooms.get(rid)
+                if r and r['status'] == 'OPEN' and len(r['players']) < r['max_players']:
+                    live.append((-len(r['players']), rid))
+            heapq.heapify(live)
+            self.joinable[key] = live
+
+    def _best_joinable(self, key, user):
+        """取出人數最多、仍有空位的房間（O(log n)），不存在時回傳 None"""
+        heap = self.joinable.get(key)
+        skipped = []
+        best = None
+        while heap:
+            neg, rid = heap[0]
+            room = self.rooms.get(rid)
+            if (room is None or room['status'] != 'OPEN'
+                    or len(room['players']) != -neg
+                    or len(room['players']) >= room['max_players']):
+                heapq.heappop(heap)
+                continue
+            if user in room['players']:
+                skipped.append(heapq.heappop(heap))
+                continue
+            best = room
+            break
+        for item in skipped:
+            heapq.heappush(heap, item)
+        if heap is not None and not heap:
+            self.joinable.pop(key, None)
+        return best
+
+    def _record_match(self, entry, now):
+        wait = now - entry['enqueued_at']
+        self.mm_waits.append(wait)
+        self.mm_stats['matched'] += 1
+        return round(wait, 3)
+
+    def _expire_waiters(self, queue, now):
+        for u, e in list(queue.items()):
+            if now - e['last_poll'] > MATCH_POLL_TIMEOUT:
+                del queue[u]
+                self.mm_stats['timeouts'] += 1
+
+    def _promote_host(self, key, queue, now):
+        host_user, entry = next(iter(queue.items()))
+        room = self.create_room(host_user, entry['reported_ip'], entry['observed_ip'],
+                                key[0], key[1], entry['max_players'])
+        if room is None:
+            return False
+        del queue[host_user]
+        self.mm_stats['hosts_promoted'] += 1
+        self.mm_assignments[host_user] = {'action': 'HOST', 'room_id': room['room_id'],
+                                          'wait_sec': self._record_match(entry, now)}
+        live = self.rooms[room['room_id']]
+        while queue and len(live['players']) < live['max_players']:
+            u, e = queue.popitem(last=False)
+            live['players'].append(u)
+            self.mm_assignments[u] = {'action': 'JOIN', 'room_id': live['room_id'],
+                                      'wait_sec': self._record_match(e, now)}
+        self._touch_joinable(live)
+        return True
+
+    def quick_join(self, user, game_name, version, observed_ip='', reported_ip='',
+                   max_players=3, min_players=MATCH_MIN_PLAYERS):
+        """
+        配對流程（client 以 QUICK_JOIN 輪詢，同一個呼叫可重複送）：
+        1) 已被配對 -> 回傳結果（HOST 表示被推派為 host，需要啟動遊戲）
+        2) 有空位的房間 -> 直接加入人數最多的那間
+        3) 否則排隊；佇列湊滿 min_players 就推派最早排隊的人開房，並把其他人放進去
+        回傳 dict：{'action': 'JOIN'|'HOST'|'WAIT', ...}
+        """
+        key = (game_name, version)
+        now = time.time()
+        with self.lock:
+            assigned = self.mm_assignments.pop(user, None)
+            if assigned is not None:
+                room = self.rooms.get(assigned['room_id'])
+                if room is not None and room['status'] == 'OPEN':
+                    return dict(assigned, room=self._room_view(room))
+
+            queue = self.mm_queues.setdefault(key, collections.OrderedDict())
+            entry = queue.get(user)
+
+            room = self._best_joinable(key, user)
+            if room is not None:
+                room['players'].append(user)
+                self._touch_joinable(room)
+                wait = 0.0
+                if entry is not None:
+                    del queue[user]
+                    wait = self._record_match(entry, now)
+                else:
+                    self.mm_waits.append(0.0)
+                    self.mm_stats['matched'] += 1
+                if not queue:
+                    self.mm_queues.pop(key, None)
+                return {'action': 'JOIN', 'room': self._room_view(room), 'wait_sec': wait}
+
+            if entry is None:
+                entry = {'enqueued_at': now, 'observed_ip': observed_ip, 'reported_ip': reported_ip,
+                         'max_players': max(2, int(max_players))}
+                queue[user] = entry
+            entry['last_poll'] = now
+
+            self._expire_waiters(queue, now)
+            if len(queue) >= max(1, int(min_players)) and self._promote_host(key, queue, now):
+                if not queue:
+                    self.mm_queues.pop(key, None)
+                assigned = self.mm_assignments.pop(user, None)
+                if assigned is not None:
+                    room = self.rooms[assigned['room_id']]
+                    return dict(assigned, room=self._room_view(room))
+
+            position = list(queue.keys()).index(user) + 1 if user in queue else 0
+            return {'action': 'WAIT', 'position': position, 'waiting': len(queue),
+                    'wait_sec': round(now - entry['enqueued_at'], 3)}
+
+    def cancel_quick_join(self, user):
+        """離開配對佇列；若已被推派為 host 但還沒取走結果，順便關掉那間房"""
+        with self.lock:
+            for key, queue in list(self.mm_queues.items()):
+                if queue.pop(user, None) is not None:
+                    self.mm_stats['cancelled'] += 1
+                if not queue:
+                    del self.mm_queues[key]
+            assigned = self.mm_assignments.pop(user, None)
+            if assigned is None:
+                return
+            room = self.rooms.get(assigned['room_id'])
+            if room is None:
+                return
+            if assigned['action'] == 'HOST':
+                self._set_status(room, 'CLOSED')
+                self._schedule_reap(room['room_id'])
+            elif user in room['players']:
+                room['players'].remove(user)
+                self._touch_joinable(room)
+
+    def matchmaking_stats(self):
+        with self.lock:
+            waits = sorted(self.mm_waits)
+            stats = dict(self.mm_stats)
+            stats['waiting'] = sum(len(q) for q in self.mm_queues.values())
+        if waits:
+            stats['time_to_match'] = {
+                'samples': len(waits),
+                'avg': round(sum(waits) / len(waits), 3),
+                'p50': round(waits[len(waits) // 2], 3),
+                'p90': round(waits[min(len(waits) - 1, int(len(waits) * 0.9))], 3),
+                'max': round(waits[-1], 3),
+            }
+        return stats
+
+    def report_port(self, rid: int, user: str, port: int):
+        """host 回報實際 bind 到的 port（例如預分配的 port 在 host 機器上被占用）"""
+        if not (0 < port < 65536):
+            return False, "Bad port."
         with self.lock:
             room = self.rooms.get(rid)
             if not room:
                 return False, "Room not found."
             if room.get('host') != user:
-                return False, "Only host can heartbeat."
+                return False, "Only host can report port."
             if room.get('status') != 'OPEN':
                 return False, "Room is not open."
-            room['last_heartbeat'] = time.time()
-            return True, "OK"
+            ok, msg = self.ports.reassign(rid, port)
+            if ok:
+                room['port'] = port
+            return ok, msg
 
     def close_room(self, rid: int, user: str):
         with self.lock:
@@ -506,71 +2104,1783 @@ class RoomManager:
                 return False, "Room not found."
             if room.get('host') != user:
                 return False, "Only host can close."
-            room['status'] = 'CLOSED'
+            self._set_status(room, 'CLOSED')
+            self._schedule_reap(rid)
             return True, "OK"
 
-    def cleanup_expired(self, ttl_sec: int = 10):
+    def cleanup_expired(self, ttl_sec=None):
+        """
+        回收已關閉或超過 TTL 沒 heartbeat 的房間。
+        回傳距離下一個到期時間的秒數（沒有房間時回傳 None）。
+        """
+        ttl = self.ttl_sec if ttl_sec is None else float(ttl_sec)
         now = time.time()
         with self.lock:
-            to_delete = []
-            for rid, room in self.rooms.items():
+            heap = self.expiry_heap
+            while heap and (heap[0][0] <= now or self.expiry_due.get(heap[0][1]) != heap[0][0]):
+                due, rid = heapq.heappop(heap)
+                if self.expiry_due.get(rid) != due:
+                    continue  # 已作廢的項目
+                del self.expiry_due[rid]
+                room = self.rooms.get(rid)
+                if room is None:
+                    continue
                 if room.get('status') != 'OPEN':
-                    to_delete.append(rid)
+                    self._remove_room(rid)
                     continue
                 last = float(room.get('last_heartbeat', room.get('created_at', 0)))
-                if now - last > ttl_sec:
-                    to_delete.append(rid)
-            for rid in to_delete:
-                self.rooms.pop(rid, None)
+                deadline = last + ttl
+                if deadline <= now:
+                    self._remove_room(rid)
+                else:
+                    self.expiry_due[rid] = deadline
+                    heapq.heappush(heap, (deadline, rid))
+            if not heap:
+                return None
+            return max(0.0, heap[0][0] - now)
+
+
+class SessionRegistry:
+    """
+    線上使用者登記（同帳號同角色只能有一個連線）。
+    每個 session 有一個 resume token：連線斷掉後 client 在 SESSION_RESUME_GRACE_SEC 內
+    可以帶著它重新連上並接回登入狀態（RESUME），不必再輸入密碼；每次接回都會換新 token。
+    另外記住每個 session 最近幾個帶 req_id 的回應，讓 client 斷線重送時不會重複執行。
+    多 process 模式下放在共享的 state service 裡，各 worker 透過 proxy 呼叫。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.online = {}        # (role, user) -> 目前有效的 token
+        self.detached = {}      # (role, user) -> (token, 期限)：連線斷了、還能 resume 的 session
+        self.replies = {}       # (role, user) -> OrderedDict(req_id -> response)
+
+    def _expire(self, now):
+        for key, (_, deadline) in list(self.detached.items()):
+            if deadline <= now:
+                del self.detached[key]
+                self.replies.pop(key, None)
+
+    def try_login(self, role, user, token=None):
+        """登入成功回傳這個 session 的 token，帳號已在線上則回傳 None"""
+        with self.lock:
+            key = (role, user)
+            if key in self.online:
+                return None
+            self.detached.pop(key, None)
+            self.replies.pop(key, None)
+            token = self.online[key] = token or secrets.token_hex(16)
+            return token
+
+    def resume(self, role, user, token):
+        """
+        用 token 接回 session：舊連線可能還沒被偵測到斷線（仍在線上），也可能已經斷開但還在寬限期內。
+        成功回傳新的 token（舊連線之後登出時帶的是舊 token，不會把接回的 session 登出），失敗回傳 None。
+        """
+        with self.lock:
+            self._expire(time.time())
+            key = (role, user)
+            current = self.online.get(key)
+            if current is None and key in self.detached:
+                current = self.detached[key][0]
+            if not token or current is None or not hmac.compare_digest(current, token):
+                return None
+            self.detached.pop(key, None)
+            new_token = self.online[key] = secrets.token_hex(16)
+            return new_token
+
+    def logout(self, role, user, token=None, resumable=False):
+        """
+        token 不是目前的 token 時（session 已被新連線接回）什麼都不做。
+        resumable=True 表示連線中斷而不是主動登出，session 保留到寬限期結束。
+        """
+        with self.lock:
+            key = (role, user)
+            current = self.online.get(key)
+            if current is None or (token is not None and token != current):
+                return
+            del self.online[key]
+            if resumable:
+                self.detached[key] = (current, time.time() + SESSION_RESUME_GRACE_SEC)
+            else:
+                self.replies.pop(key, None)
+
+    def cached_reply(self, role, user, req_id):
+        with self.lock:
+            return self.replies.get((role, user), {}).get(req_id)
+
+    def remember_reply(self, role, user, req_id, response):
+        with self.lock:
+            cache = self.replies.setdefault((role, user), collections.OrderedDict())
+            cache[req_id] = response
+            while len(cache) > REPLY_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    def is_online(self, role, user) -> bool:
+        with self.lock:
+            return (role, user) in self.online
+
+    def count(self) -> int:
+        with self.lock:
+            return len(self.online)
+
+
+def room_expiry_loop(room_mgr, is_running):
+    """回收執行緒：清完到期的房間就睡到下一個到期時間（沒有房間時一直睡），有更早的項目排進來會被叫醒"""
+    with room_mgr.expiry_cond:
+        while is_running():
+            wait = None
+            try:
+                wait = room_mgr.cleanup_expired()
+            except Exception as e:
+                print(f"[!] Room cleanup failed: {e!r}")
+                wait = 1.0
+            room_mgr.expiry_cond.wait(wait)
+
+
+# ---------- 多 process 模式的共享狀態服務（Unix socket 上的 multiprocessing manager） ----------
+_shared_state = {}
+
+
+def _shared_room_manager():
+    if 'rooms' not in _shared_state:
+        mgr = RoomManager()
+        _shared_state['rooms'] = mgr
+        threading.Thread(target=room_expiry_loop, args=(mgr, lambda: True), daemon=True).start()
+    return _shared_state['rooms']
+
+
+def _shared_session_registry():
+    if 'sessions' not in _shared_state:
+        _shared_state['sessions'] = SessionRegistry()
+    return _shared_state['sessions']
+
+
+class LobbyStateManager(BaseManager):
+    pass
+
+
+LobbyStateManager.register('RoomManager', callable=_shared_room_manager)
+LobbyStateManager.register('SessionRegistry', callable=_shared_session_registry)
+
+
+class LatencyHistogram:
+    """
+    HDR 風格的 log-linear 直方圖（單位：微秒）：
+    每個 2 的次方區間切成 2^(PRECISION_BITS-1) 個等寬 bucket，相對誤差約 3%，
+    記錄是 O(1)，記憶體只跟實際出現過的 bucket 數有關。
+    """
+    PRECISION_BITS = 6
+    _HALF = 1 << (PRECISION_BITS - 1)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @classmethod
+    def _index(cls, v: int) -> int:
+        shift = v.bit_length() - cls.PRECISION_BITS
+        if shift <= 0:
+            return v
+        return shift * cls._HALF + (v >> shift)
+
+    @classmethod
+    def _upper(cls, idx: int) -> int:
+        if idx < (cls._HALF << 1):
+            return idx
+        shift = idx // cls._HALF - 1
+        mantissa = idx - shift * cls._HALF
+        return ((mantissa + 1) << shift) - 1
+
+    def record(self, micros: int):
+        micros = max(0, int(micros))
+        idx = self._index(micros)
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, q: float) -> int:
+        if not self.count:
+            return 0
+        target = max(1, int(math.ceil(self.count * q)))
+        seen = 0
+        for idx in sorted(self.buckets):
+            seen += self.buckets[idx]
+            if seen >= target:
+                return min(self._upper(idx), self.max)
+        return self.max
+
+    def summary(self):
+        ms = lambda us: round(us / 1000.0, 3)
+        return {
+            'count': self.count,
+            'mean_ms': ms(self.total / self.count) if self.count else 0,
+            'p50_ms': ms(self.percentile(0.50)),
+            'p99_ms': ms(self.percentile(0.99)),
+            'p999_ms': ms(self.percentile(0.999)),
+            'max_ms': ms(self.max),
+        }
+
+
+class ServerMetrics:
+    """每個指令的次數、錯誤數、進出 bytes 與延遲直方圖"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.commands = {}
+
+    def record(self, cmd: str, elapsed_sec: float, ok: bool, bytes_in: int, bytes_out: int):
+        with self.lock:
+            m = self.commands.get(cmd)
+            if m is None:
+                m = self.commands[cmd] = {'count': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0,
+                                          'latency': LatencyHistogram()}
+            m['count'] += 1
+            if not ok:
+                m['errors'] += 1
+            m['bytes_in'] += bytes_in
+            m['bytes_out'] += bytes_out
+            m['latency'].record(elapsed_sec * 1_000_000)
+
+    def snapshot(self):
+        with self.lock:
+            commands = {}
+            for cmd, m in sorted(self.commands.items()):
+                commands[cmd] = {
+                    'count': m['count'],
+                    'errors': m['errors'],
+                    'bytes_in': m['bytes_in'],
+                    'bytes_out': m['bytes_out'],
+                    'latency': m['latency'].summary(),
+                }
+        return {'uptime_sec': int(time.time() - self.started_at), 'commands': commands}
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """取一個 token；成功回傳 0，否則回傳還要等幾秒才有下一個 token"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    per-session 與 per-IP 兩層 token bucket。
+    session 的 bucket 放在 ClientConnection 上（只有該連線的執行緒會碰）；
+    IP 的 bucket 共用，需要上鎖。多 process 模式下每個 worker 各自計算 per-IP 額度。
+    """
+
+    def __init__(self, limits=None):
+        self.limits = limits if limits is not None else RATE_LIMITS
+        self.lock = threading.Lock()
+        self.ip_buckets = {}  # (ip, cls) -> TokenBucket
+        self.rejected = collections.Counter()  # cls -> 被擋下的次數
+        self.last_prune = time.monotonic()
+
+    def check(self, client, cls) -> float:
+        """回傳 0 表示放行，否則回傳建議的 retry_after（秒）"""
+        limit = self.limits.get(cls) or self.limits.get('default')
+        if not limit:
+            return 0.0
+        now = time.monotonic()
+
+        wait = 0.0
+        if 'session' in limit:
+            bucket = client.buckets.get(cls)
+            if bucket is None:
+                bucket = client.buckets[cls] = TokenBucket(*limit['session'], now)
+            wait = bucket.take(now)
+
+        if not wait and 'ip' in limit:
+            wait = self._take_ip(client, cls, limit, now)
+
+        if wait:
+            with self.lock:
+                self.rejected[cls] += 1
+        return wait
+
+    def charge_ip(self, client, cls):
+        """
+        額外從來源 IP 的 bucket 扣一個 token（例如 admin token 驗證失敗）：
+        換連線也躲不掉，猜 token 的速度比正常呼叫更快被擋下。
+        """
+        limit = self.limits.get(cls) or self.limits.get('default')
+        if limit and 'ip' in limit:
+            self._take_ip(client, cls, limit, time.monotonic())
+
+    def _take_ip(self, client, cls, limit, now) -> float:
+        with self.lock:
+            key = (client.observed_ip, cls)
+            bucket = self.ip_buckets.get(key)
+            if bucket is None:
+                bucket = self.ip_buckets[key] = TokenBucket(*limit['ip'], now)
+            wait = bucket.take(now)
+            if now - self.last_prune > RATE_LIMIT_IDLE_SEC:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now):
+        self.last_prune = now
+        stale = [k for k, b in self.ip_buckets.items() if now - b.updated > RATE_LIMIT_IDLE_SEC]
+        for k in stale:
+            del self.ip_buckets[k]
+
+    def stats(self):
+        with self.lock:
+            return {'rejected': dict(self.rejected), 'ip_buckets': len(self.ip_buckets)}
+
+
+def _diag_path(prefix: str, ext: str) -> str:
+    os.makedirs(DIAG_DIR, exist_ok=True)
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(DIAG_DIR, f"{prefix}-{stamp}-{os.getpid()}.{ext}")
+
+
+class SamplingProfiler:
+    """
+    低負擔的 sampling profiler：背景執行緒定期讀 sys._current_frames()，
+    把所有 handler 執行緒的 call stack 累計起來，停止時輸出 collapsed stacks
+    （每行 "thread;file:func;... count"，可直接丟給 flamegraph.pl / speedscope）。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = {}
+        self.samples = 0
+        self.started_at = 0.0
+        self.interval = PROFILE_INTERVAL_MS / 1000.0
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval_ms=None):
+        with self.lock:
+            if self.running:
+                return False, "Profiler already running."
+            self.interval = max(1, int(interval_ms or PROFILE_INTERVAL_MS)) / 1000.0
+            self.stacks = {}
+            self.samples = 0
+            self.started_at = time.time()
+            self.stop_event.clear()
+            self.thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self.thread.start()
+        return True, "Profiler started."
+
+    def _run(self):
+        me = threading.get_ident()
+        deadline = time.monotonic() + PROFILE_MAX_SEC
+        while not self.stop_event.wait(self.interval):
+            if time.monotonic() > deadline:
+                break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                parts = []
+                while frame is not None:
+                    code = frame.f_code
+                    parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(parts))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        """停止取樣並寫出 collapsed stacks，回傳 (ok, msg, path)"""
+        with self.lock:
+            if self.thread is None:
+                return False, "Profiler not running.", None
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+            path = _diag_path('profile', 'collapsed')
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, n in sorted(self.stacks.items(), key=lambda kv: -kv[1]):
+                    f.write(f"{stack} {n}\n")
+            msg = f"{self.samples} samples over {time.time() - self.started_at:.1f}s"
+        return True, msg, path
+
+
+class MemoryTracer:
+    """tracemalloc 快照與差異；第一次取快照時才開始追蹤，避免平常的負擔"""
+    NFRAMES = 10
+    TOP = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None
+
+    def _take(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.NFRAMES)
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+
+    def snapshot(self):
+        with self.lock:
+            snap = self._take()
+            self.last = snap
+            stats = snap.statistics('traceback')
+            path = _diag_path('tracemalloc', 'txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                total = sum(s.size for s in stats)
+                f.write(f"# total {total} bytes in {len(stats)} allocation sites\n")
+                for s in stats[:self.TOP]:
+                    f.write(f"{s.size} bytes, {s.count} blocks\n")
+                    for line in s.traceback.format():
+                        f.write(f"    {line}\n")
+        return True, f"{len(stats)} allocation sites", path
+
+    def diff(self):
+        """和上一次快照比較；沒有上一次快照時先建立基準"""
+        with self.lock:
+            if self.last is None:
+                self.last = self._take()
+                return False, "No previous snapshot; baseline taken, run again to diff.", None
+            snap = self._take()
+            stats = snap.compare_to(self.last, 'traceback')
+            self.last = snap
+            path = _diag_path('tracemalloc-diff', 'txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                for s in stats[:self.TOP]:
+                    f.write(f"{s.size_diff:+d} bytes ({s.size} total), {s.count_diff:+d} blocks\n")
+                    for line in s.traceback.format():
+                        f.write(f"    {line}\n")
+        return True, f"{len(stats)} allocation sites compared", path
+
+    def stop(self):
+        with self.lock:
+            self.last = None
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+        return True, "tracemalloc stopped."
+
+
+class StorageGC:
+    """
+    storage/ 的背景一致性檢查與空間回收。定期掃描整個目錄（每秒檢查的檔案數有上限，不會拖慢 request），
+    找出沒被 games.json 參照的孤兒檔、參照到卻不存在的檔案、大小和紀錄不符的檔案，以及上傳中斷留下的暫存檔。
+    孤兒檔與暫存檔至少要 STORAGE_GC_GRACE_SEC 沒動過才回收，避免刪到正在上傳、還沒寫進 catalog 的檔案。
+    """
+
+    def __init__(self, get_game_db):
+        self.get_game_db = get_game_db  # server 的 game_db 會在 RELOAD 時整個換掉，所以每次掃描重新取
+        self.scan_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_report = None
+        self.totals = {'scans': 0, 'reclaimed_files': 0, 'reclaimed_bytes': 0, 'errors': 0}
+
+    @property
+    def scanning(self) -> bool:
+        return self.scan_lock.locked()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='storage-gc', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+
+    def trigger(self):
+        """要求背景執行緒立刻掃一次，回傳 (ok, msg)"""
+        if self.scanning:
+            return False, "Storage scan already running."
+        self.wake.set()
+        return True, "Storage scan started."
+
+    def _run(self):
+        delay = STORAGE_GC_FIRST_DELAY
+        while not self.stop_event.is_set():
+            self.wake.wait(delay)
+            self.wake.clear()
+            delay = STORAGE_GC_INTERVAL
+            if self.stop_event.is_set():
+                break
+            try:
+                self.scan()
+            except Exception as e:
+                print(f"[!] Storage scan failed: {e}")
+
+    def _throttle(self, bucket):
+        while not self.stop_event.is_set():
+            wait = bucket.take(time.monotonic())
+            if not wait:
+                return True
+            self.stop_event.wait(wait)
+        return False
+
+    def _remove(self, path, size, report):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            print(f"[!] Storage GC: cannot remove {path}: {e}")
+            self._note(report['errors'], f"{os.path.relpath(path, STORAGE_DIR)}: {e}")
+            return
+        report['reclaimed_files'] += 1
+        report['reclaimed_bytes'] += size
+
+    @staticmethod
+    def _note(items, item):
+        if len(items) < STORAGE_GC_REPORT_MAX:
+            items.append(item)
+
+    def scan(self):
+        """掃描一次並回傳報告；已經有掃描在跑時回傳 None"""
+        if not self.scan_lock.acquire(blocking=False):
+            return None
+        try:
+            report = self._scan()
+        finally:
+            self.scan_lock.release()
+        self.last_report = report
+        self.totals['scans'] += 1
+        self.totals['reclaimed_files'] += report['reclaimed_files']
+        self.totals['reclaimed_bytes'] += report['reclaimed_bytes']
+        self.totals['errors'] += len(report['errors'])
+        print(f"[*] Storage scan: {report['files']} files, {report['orphans']} orphan(s), "
+              f"{len(report['missing'])} missing, {len(report['size_mismatch'])} size mismatch(es), "
+              f"reclaimed {report['reclaimed_bytes']} bytes in {report['duration_ms']} ms")
+        return report
+
+    def _scan(self):
+        started = time.perf_counter()
+        report = {
+            'files': 0, 'bytes': 0, 'referenced': 0,
+            'orphans': 0, 'orphan_bytes': 0, 'temp_files': 0,
+            'missing': [], 'size_mismatch': [],
+            'reclaimed_files': 0, 'reclaimed_bytes': 0, 'errors': [],
+            'complete': False,
+        }
+        db = self.get_game_db()
+        db.refresh_if_stale(force=True)
+        refs = db.storage_references()
+        seen = set()
+        candidates = []  # (path, size)：孤兒檔 / 暫存檔，掃完後再確認一次才刪
+        bucket = TokenBucket(STORAGE_GC_FILES_PER_SEC, STORAGE_GC_FILES_PER_SEC, time.monotonic())
+        now = time.time()
+
+        pending = [os.path.abspath(STORAGE_DIR)]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as it:
+                    entries = list(it)
+            except OSError as e:
+                self._note(report['errors'], str(e))
+                continue
+            for entry in entries:
+                if not self._throttle(bucket):
+                    return self._finish(report, started)
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    self._note(report['errors'], str(e))
+                    continue
+                report['files'] += 1
+                report['bytes'] += st.st_size
+                stale = now - st.st_mtime > STORAGE_GC_GRACE_SEC
+                ref = refs.get(entry.path)
+                if ref is not None:
+                    seen.add(entry.path)
+                    report['referenced'] += 1
+                    if ref['size'] is not None and ref['size'] != st.st_size:
+                        self._note(report['size_mismatch'], {'game': ref['game'], 'version': ref['version'],
+                                                             'file_path': ref['file_path'],
+                                                             'expected': ref['size'], 'actual': st.st_size})
+                elif entry.name.endswith(STORAGE_TEMP_SUFFIXES):
+                    report['temp_files'] += 1
+                    if stale:
+                        candidates.append((entry.path, st.st_size))
+                else:
+                    report['orphans'] += 1
+                    report['orphan_bytes'] += st.st_size
+                    if stale:
+                        candidates.append((entry.path, st.st_size))
+
+        for path, ref in refs.items():
+            if path not in seen and not os.path.exists(path):
+                self._note(report['missing'], {k: v for k, v in ref.items() if k != 'size'})
+
+        if STORAGE_GC_RECLAIM and candidates:
+            # 掃描期間 catalog 可能又有異動（例如剛上傳完成），刪之前以最新的參照再確認一次
+            db = self.get_game_db()
+            db.refresh_if_stale(force=True)
+            refs = db.storage_references()
+            for path, size in candidates:
+                if path not in refs:
+                    self._remove(path, size, report)
+        report['complete'] = True
+        return self._finish(report, started)
+
+    @staticmethod
+    def _finish(report, started):
+        report['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        report['finished_at'] = int(time.time())
+        return report
+
+    def stats(self):
+        stats = dict(self.totals)
+        stats['scanning'] = self.scanning
+        stats['last_scan'] = self.last_report
+        return stats
+
+
+class DownloadTracker:
+    """
+    記錄各版本最後一次被下載的時間（冷熱分級用）。先累積在記憶體，定期合併寫回 DOWNLOAD_STATS_PATH；
+    多 process 模式下各 worker 寫同一個檔，以 interprocess_lock 合併。
+    """
+
+    def __init__(self, path=None, *, shared=False):
+        self.path = path or DOWNLOAD_STATS_PATH
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.pending = {}           # game -> {version: 下載時間}，還沒寫回檔案的
+        self.active = 0             # 進行中的下載數
+        self.last_started = 0.0     # 最近一次開始下載的時間（monotonic）
+        self.last_download = self._read()
+        self.running = False
+
+    def _read(self):
+        data = load_json(self.path, {})
+        downloads = data.get('last_download') if isinstance(data, dict) else None
+        return downloads if isinstance(downloads, dict) else {}
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self._flush_loop, name='download-stats', daemon=True).start()
+
+    def _flush_loop(self):
+        while self.running:
+            time.sleep(DOWNLOAD_STATS_FLUSH_SEC)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[!] Download stats flush failed: {e}")
+
+    @contextlib.contextmanager
+    def downloading(self, game_name, version):
+        with self.lock:
+            self.active += 1
+            self.last_started = time.monotonic()
+            self.pending.setdefault(game_name, {})[version] = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def busy(self) -> bool:
+        """有下載進行中，或最近 TIERING_IDLE_SEC 內才有下載"""
+        with self.lock:
+            return self.active > 0 or time.monotonic() - self.last_started < TIERING_IDLE_SEC
+
+    def last_seen(self, game_name, version):
+        with self.lock:
+            ts = self.pending.get(game_name, {}).get(version)
+        return ts or self.last_download.get(game_name, {}).get(version)
+
+    def refresh(self):
+        """重新讀檔（其他 process 寫入的下載紀錄）"""
+        self.last_download = self._read()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        with interprocess_lock(self.path, self.shared):
+            data = load_json(self.path, {})
+            if not isinstance(data, dict):
+                data = {}
+            downloads = data.get('last_download')
+            if not isinstance(downloads, dict):
+                downloads = {}
+            for game_name, versions in pending.items():
+                slot = downloads.setdefault(game_name, {})
+                for version, ts in versions.items():
+                    slot[version] = max(ts, slot.get(version, 0))
+            data['last_download'] = downloads
+            save_json(self.path, data)
+        self.last_download = downloads
+
+
+class ColdTiering:
+    """
+    冷版本分級：很久沒被下載的版本，在 server 閒置時以最高壓縮率（deflate level 9）重新壓縮 zip。
+    檔案內容與 CRC 不變，client 照常下載解壓；處理過的版本在 catalog 標記 tier='cold' 並記錄省下的空間。
+    重新壓縮的執行緒 CPU 時間以 TIERING_CPU_BUDGET 為上限，有下載進行或機器負載高時暫停。
+    """
+
+    def __init__(self, get_game_db, tracker):
+        self.get_game_db = get_game_db
+        self.tracker = tracker
+        self.pass_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.totals = {'passes': 0, 'recompressed': 0, 'unchanged': 0, 'failed': 0, 'saved_bytes': 0}
+        self.catalog = {'cold_versions': 0, 'saved_bytes': 0}  # 上次掃描時 catalog 裡的累計
+        self.last_pass = None
+
+    def start(self):
+        threading.Thread(target=self._run, name='cold-tiering', daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
+
+    def trigger(self):
+        if self.pass_lock.locked():
+            return False, "Tiering pass already running."
+        self.wake.set()
+        return True, "Tiering pass started."
+
+    def _run(self):
+        delay = STORAGE_GC_FIRST_DELAY
+        while not self.stop_event.is_set():
+            self.wake.wait(delay)
+            self.wake.clear()
+            delay = TIERING_INTERVAL
+            if self.stop_event.is_set():
+                break
+            try:
+                self.run_pass()
+            except Exception as e:
+                print(f"[!] Tiering pass failed: {e}")
+
+    def _idle(self) -> bool:
+        if self.tracker.busy():
+            return False
+        if hasattr(os, 'getloadavg') and os.getloadavg()[0] > TIERING_MAX_LOAD * (os.cpu_count() or 1):
+            return False
+        return True
+
+    def _pace(self, cpu_start, wall_start):
+        """等到 server 閒置，且這個執行緒的 CPU 使用比例不超過 TIERING_CPU_BUDGET；要停止時回傳 False"""
+        while not self.stop_event.is_set():
+            ahead = (time.thread_time() - cpu_start) / TIERING_CPU_BUDGET - (time.monotonic() - wall_start)
+            if ahead > 0:
+                self.stop_event.wait(ahead)
+            elif self._idle():
+                return True
+            else:
+                self.stop_event.wait(1.0)
+        return False
+
+    def cold_versions(self, db):
+        """回傳依最後下載時間（沒下載過的用上傳時間）由舊到新排列的 [(絕對路徑, ref), ...]"""
+        now = time.time()
+        cold = []
+        catalog = {'cold_versions': 0, 'saved_bytes': 0}
+        for abs_path, ref in db.storage_references().items():
+            if ref['tier'] == 'cold':
+                catalog['cold_versions'] += 1
+                catalog['saved_bytes'] += ref['saved_bytes']
+                continue
+            last = self.tracker.last_seen(ref['game'], ref['version'])
+            if last is None:
+                try:
+                    last = os.path.getmtime(abs_path)
+                except OSError:
+                    continue
+            if now - last >= TIERING_COLD_SEC:
+                cold.append((last, abs_path, ref))
+        self.catalog = catalog
+        return [(abs_path, ref) for _, abs_path, ref in sorted(cold, key=lambda c: c[0])]
+
+    def run_pass(self):
+        if not self.pass_lock.acquire(blocking=False):
+            return None
+        started = time.perf_counter()
+        summary = {'candidates': 0, 'recompressed': 0, 'unchanged': 0, 'failed': 0, 'saved_bytes': 0}
+        try:
+            self.tracker.refresh()
+            db = self.get_game_db()
+            db.refresh_if_stale(force=True)
+            candidates = self.cold_versions(db)
+            summary['candidates'] = len(candidates)
+            for abs_path, ref in candidates:
+                result = self.recompress(abs_path)
+                if result is None:
+                    if self.stop_event.is_set():
+                        break
+                    summary['failed'] += 1
+                    continue
+                before, after, sha256 = result
+                db = self.get_game_db()
+                if not db.set_version_tier(ref['game'], ref['version'], 'cold',
+                                           size=after, saved_bytes=before - after, sha256=sha256):
+                    continue  # 處理期間版本被刪掉了，留下的檔案交給 StorageGC
+                summary['recompressed' if after < before else 'unchanged'] += 1
+                summary['saved_bytes'] += before - after
+        finally:
+            self.pass_lock.release()
+        summary['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        summary['finished_at'] = int(time.time())
+        self.last_pass = summary
+        self.totals['passes'] += 1
+        for key in ('recompressed', 'unchanged', 'failed', 'saved_bytes'):
+            self.totals[key] += summary[key]
+        self.catalog['cold_versions'] += summary['recompressed'] + summary['unchanged']
+        self.catalog['saved_bytes'] += summary['saved_bytes']
+        if summary['candidates']:
+            print(f"[*] Tiering: {summary['recompressed']} recompressed, {summary['unchanged']} unchanged, "
+                  f"{summary['failed']} failed, saved {summary['saved_bytes']} bytes")
+        return summary
+
+    def recompress(self, abs_path):
+        """
+        以 deflate level 9 重寫整個 zip，比對每個成員的 CRC 與大小後原子替換。
+        回傳 (原大小, 新大小, 新檔 sha256)（沒變小時保留原檔，sha256 為 None）；失敗或被停止時回傳 None。
+        """
+        tmp = abs_path + '.tmp'
+        cpu_start, wall_start = time.thread_time(), time.monotonic()
+        try:
+            before = os.path.getsize(abs_path)
+            with zipfile.ZipFile(abs_path) as src, \
+                    zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED, compresslevel=TIERING_COMPRESS_LEVEL) as dst:
+                expected = [(i.filename, i.CRC, i.file_size) for i in src.infolist()]
+                for info in src.infolist():
+                    if not self._pace(cpu_start, wall_start):
+                        raise InterruptedError("stopped")
+                    # 保留成員的時間與權限位元，只換壓縮方式
+                    zi = zipfile.ZipInfo(info.filename, info.date_time)
+                    zi.external_attr = info.external_attr
+                    zi.create_system = info.create_system
+                    if info.is_dir():
+                        dst.writestr(zi, b'')
+                        continue
+                    zi.compress_type = zipfile.ZIP_DEFLATED
+                    # ZipInfo 的壓縮等級：3.13 起是 compress_level，之前只有 _compresslevel
+                    setattr(zi, 'compress_level' if hasattr(zi, 'compress_level') else '_compresslevel',
+                            TIERING_COMPRESS_LEVEL)
+                    # 成員可能很大，串流寫入而不是 writestr
+                    zip64 = info.file_size >= zipfile.ZIP64_LIMIT
+                    with src.open(info) as r, dst.open(zi, 'w', force_zip64=zip64) as w:
+                        while True:
+                            chunk = r.read(TIERING_CHUNK)
+                            if not chunk:
+                                break
+                            w.write(chunk)
+                            if not self._pace(cpu_start, wall_start):
+                                raise InterruptedError("stopped")
+            with zipfile.ZipFile(tmp) as check:
+                if [(i.filename, i.CRC, i.file_size) for i in check.infolist()] != expected:
+                    raise zipfile.BadZipFile("recompressed archive does not match")
+            after = os.path.getsize(tmp)
+            if after >= before:
+                os.remove(tmp)
+                return before, before, None
+            sha256 = file_sha256(tmp)
+            os.replace(tmp, abs_path)  # 進行中的下載持有舊檔的 fd，不受影響
+            return before, after, sha256
+        except InterruptedError:
+            self._discard(tmp)
+            return None
+        except (OSError, zipfile.BadZipFile, zipfile.LargeZipFile, RuntimeError, NotImplementedError) as e:
+            # RuntimeError / NotImplementedError：加密或不支援的壓縮方式
+            print(f"[!] Tiering: cannot recompress {abs_path}: {e}")
+            self._discard(tmp)
+            return None
+
+    @staticmethod
+    def _discard(tmp):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    def stats(self):
+        stats = dict(self.totals)
+        stats['running'] = self.pass_lock.locked()
+        stats['catalog'] = dict(self.catalog)
+        stats['last_pass'] = self.last_pass
+        return stats
+
+
+class UploadPipeline:
+    """
+    上傳後的處理流程：upload handler 收完檔案就交給這裡，依序經過
+    safety（只讀目錄：檔案數、路徑穿越、symlink、解壓後大小）→ integrity（解壓驗 CRC）→ config（game_config.json）
+    → manifest（檔案清單）→ hash（sha256）→ catalog（搬到正式檔名並寫入 GameDB）。
+    每個 stage 有自己的 worker pool，不同上傳可以同時處在不同 stage；
+    走完 catalog 才會出現在商城、可以下載，任何一步失敗就刪掉檔案、不留紀錄。
+    """
+
+    STAGES = ('safety', 'integrity', 'config', 'manifest', 'hash', 'catalog')
+
+    def __init__(self, get_game_db):
+        self.get_game_db = get_game_db
+        self.lock = threading.Lock()
+        self.pools = {stage: ThreadPoolExecutor(max_workers=UPLOAD_STAGE_WORKERS.get(stage, 1),
+                                                thread_name_prefix=f"upload-{stage}")
+                      for stage in self.STAGES}
+        self.jobs = collections.OrderedDict()  # upload_id -> job（保留最近 UPLOAD_JOBS_KEEP 筆）
+        self.reserved = {}                     # (game_name, version) -> uploader，處理中的上傳（只限這個 process）
+        self.counts = {'submitted': 0, 'completed': 0, 'failed': 0}
+        self.timings = {stage: {'wait': LatencyHistogram(), 'run': LatencyHistogram()} for stage in self.STAGES}
+
+    # ---------- 上傳前 ----------
+    def create(self, uploader, game_name, version, description):
+        """保留 (game_name, version) 並建立 job；同一個版本已在處理中時回傳 (False, msg, None)"""
+        with self.lock:
+            for (gname, ver), owner in self.reserved.items():
+                if gname == game_name and owner != uploader:
+                    return False, "Game name is being uploaded by another developer", None
+                if gname == game_name and ver == version:
+                    return False, "This version is already being processed", None
+            upload_id = base64.urlsafe_b64encode(os.urandom(9)).decode()
+            job = {
+                'upload_id': upload_id,
+                'uploader': uploader,
+                'game_name': game_name,
+                'version': version,
+                'description': description,
+                'state': 'RECEIVING',
+                'stage': None,
+                'error': None,
+                'timings_ms': {},
+                'created_at': int(time.time()),
+                'finished_at': None,
+                '_tmp_path': os.path.join(STORAGE_DIR, f"{upload_id}.upload"),
+            }
+            self.reserved[(game_name, version)] = uploader
+            self.jobs[upload_id] = job
+            self._trim()
+        return True, "OK", job
+
+    def is_reserved(self, game_name) -> bool:
+        with self.lock:
+            return any(gname == game_name for gname, _ in self.reserved)
+
+    def abandon(self, job, error="Transfer aborted"):
+        """檔案沒收完：直接當作失敗"""
+        self._fail(job, error)
+
+    # ---------- 執行 ----------
+    def submit(self, job):
+        with self.lock:
+            self.counts['submitted'] += 1
+            job['state'] = 'QUEUED'
+        self._schedule(job, 0)
+
+    def _schedule(self, job, index):
+        job['_enqueued'] = time.perf_counter()
+        self.pools[self.STAGES[index]].submit(self._run_stage, job, index)
+
+    def _run_stage(self, job, index):
+        stage = self.STAGES[index]
+        started, enqueued = time.perf_counter(), job['_enqueued']
+        job['state'], job['stage'] = 'PROCESSING', stage
+        try:
+            getattr(self, f"_stage_{stage}")(job)
+        except (ValueError, PermissionError, OSError, zipfile.BadZipFile) as e:
+            self._fail(job, str(e) or type(e).__name__)
+            return
+        except Exception as e:
+            print(f"[!] Upload {job['upload_id']} stage {stage} crashed: {e!r}")
+            self._fail(job, "Internal error while processing upload")
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                job['timings_ms'][stage] = round(elapsed * 1000, 1)
+                self.timings[stage]['wait'].record((started - enqueued) * 1_000_000)
+                self.timings[stage]['run'].record(elapsed * 1_000_000)
+
+        if index + 1 < len(self.STAGES):
+            self._schedule(job, index + 1)
+            return
+        with self.lock:
+            job['state'], job['stage'] = 'DONE', None
+            job['finished_at'] = int(time.time())
+            self.reserved.pop((job['game_name'], job['version']), None)
+            self.counts['completed'] += 1
+            self._release(job)
+        print(f"[*] Upload {job['game_name']} {job['version']} by {job['uploader']} published "
+              f"({sum(job['timings_ms'].values()):.1f} ms in pipeline)")
+
+    def _fail(self, job, error):
+        for path in (job.get('_tmp_path'), job.get('_final_path')):
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    print(f"[!] Cannot remove {path}: {e}")  # StorageGC 之後會回收
+        with self.lock:
+            job['state'], job['error'] = 'FAILED', error
+            job['finished_at'] = int(time.time())
+            self.reserved.pop((job['game_name'], job['version']), None)
+            self.counts['failed'] += 1
+            self._release(job)
+
+    @staticmethod
+    def _release(job):
+        # 中間結果只在處理期間需要
+        for key in [k for k in job if k.startswith('_')]:
+            del job[key]
+
+    def _trim(self):
+        while len(self.jobs) > UPLOAD_JOBS_KEEP:
+            oldest = next(iter(self.jobs.values()))
+            if oldest['finished_at'] is None:
+                break
+            self.jobs.popitem(last=False)
+
+    # ---------- stages ----------
+    def _stage_safety(self, job):
+        # 只看中央目錄，不解壓任何內容：檔案數與解壓後大小超限的 zip 不會進到 integrity 被整個 inflate
+        try:
+            with zipfile.ZipFile(job['_tmp_path']) as zf:
+                infos = job['_infos'] = zf.infolist()
+        except (zipfile.BadZipFile, zipfile.LargeZipFile) as e:
+            raise ValueError(f"Invalid zip file: {e}")
+        if len(infos) > UPLOAD_MAX_MEMBERS:
+            raise ValueError(f"Too many files in zip ({len(infos)} > {UPLOAD_MAX_MEMBERS})")
+        total = 0
+        for info in infos:
+            name = info.filename
+            parts = name.replace('\\', '/').split('/')
+            if name.startswith(('/', '\\')) or '\\' in name or ':' in parts[0] or '..' in parts:
+                raise ValueError(f"Unsafe path in zip: {name}")
+            if stat.S_ISLNK(info.external_attr >> 16):
+                raise ValueError(f"Symbolic link in zip: {name}")
+            total += info.file_size
+        if total > UPLOAD_MAX_UNPACKED:
+            raise ValueError(f"Unpacked size too large ({total} bytes)")
+        job['unpacked_size'] = total
+
+    def _stage_integrity(self, job):
+        try:
+            with zipfile.ZipFile(job['_tmp_path']) as zf:
+                bad = zf.testzip()
+        except (zipfile.BadZipFile, zipfile.LargeZipFile, RuntimeError, NotImplementedError) as e:
+            raise ValueError(f"Invalid zip file: {e}")
+        if bad is not None:
+            raise ValueError(f"Corrupt zip member: {bad}")
+
+    def _stage_config(self, job):
+        with zipfile.ZipFile(job['_tmp_path']) as zf:
+            try:
+                raw = zf.read('game_config.json')
+            except KeyError:
+                raise ValueError("game_config.json not found at the top level of the zip")
+        try:
+            config = json.loads(raw.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            raise ValueError("game_config.json is not valid JSON")
+        ok, msg = check_game_config(config)
+        if not ok:
+            raise ValueError(f"game_config.json: {msg}")
+
+    def _stage_manifest(self, job):
+        entries = [{'path': i.filename, 'size': i.file_size, 'crc': f"{i.CRC:08x}"}
+                   for i in job['_infos'] if not i.is_dir()]
+        body = json.dumps(entries, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        # 以內容命名：清單只描述解壓後的檔案，重新壓縮（ColdTiering）也不會變
+        manifest_id = hashlib.sha256(body).hexdigest()
+        path = os.path.join(MANIFEST_DIR, f"{manifest_id}.json")
+        if not os.path.exists(path):
+            os.makedirs(MANIFEST_DIR, exist_ok=True)
+            save_json(path, entries)
+        job['manifest'] = manifest_id
+        job['files'] = len(entries)
+
+    def _stage_hash(self, job):
+        job['sha256'] = file_sha256(job['_tmp_path'])
+        job['size'] = os.path.getsize(job['_tmp_path'])
+
+    def _stage_catalog(self, job):
+        safe = lambda s: re.sub(r'[^A-Za-z0-9._-]+', '_', s)[:64]
+        file_name = f"{safe(job['game_name'])}_{safe(job['version'])}_{job['upload_id'][:8]}.zip"
+        job['_final_path'] = os.path.join(STORAGE_DIR, file_name)
+        os.replace(job['_tmp_path'], job['_final_path'])
+        # reserved 只擋得住同一個 process 裡的重複上傳；跨 worker 靠 exclusive 在檔案鎖內一次完成檢查與寫入，
+        # 失敗時 _fail 會刪掉剛搬好的檔案
+        self.get_game_db().add_game_version(
+            job['game_name'], job['uploader'], job['version'], job['description'], file_name,
+            size=job['size'], exclusive=True,
+            meta={'sha256': job['sha256'], 'manifest': job['manifest'], 'files': job['files'],
+                  'unpacked_size': job['unpacked_size'], 'uploaded_at': int(time.time())})
+
+    # ---------- 查詢 ----------
+    @staticmethod
+    def view(job):
+        return {k: v for k, v in job.items() if not k.startswith('_')}
+
+    def get(self, upload_id):
+        with self.lock:
+            job = self.jobs.get(upload_id)
+            return self.view(job) if job else None
+
+    def list_by(self, uploader):
+        with self.lock:
+            return [self.view(j) for j in reversed(self.jobs.values()) if j['uploader'] == uploader]
+
+    def idle(self) -> bool:
+        with self.lock:
+            return not self.reserved
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['in_progress'] = len(self.reserved)
+            stats['stages'] = {stage: {'wait': h['wait'].summary(), 'run': h['run'].summary()}
+                               for stage, h in self.timings.items()}
+        return stats
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class CountingSocket:
+    """包住 client socket，累計收送的 bytes（其餘操作直接轉給原本的 socket）"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def recv(self, n, *args):
+        data = self._sock.recv(n, *args)
+        self.bytes_in += len(data)
+        return data
+
+    def sendall(self, data, *args):
+        self._sock.sendall(data, *args)
+        self.bytes_out += len(data)
+
+    def send(self, data, *args):
+        n = self._sock.send(data, *args)
+        self.bytes_out += n
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def tune_client_socket(conn):
+    """開啟 TCP keepalive，讓 crash 的 client 留下的半開連線能被 OS 偵測出來"""
+    try:
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, TCP_KEEPALIVE_IDLE)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, TCP_KEEPALIVE_INTERVAL)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, TCP_KEEPALIVE_COUNT)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def transfer_timeout(conn):
+    """收送檔案期間每次 send / recv 最多等 CLIENT_READ_TIMEOUT，對方卡住就中斷（平常的閒置 timeout 很長）"""
+    prev = conn.gettimeout()
+    conn.settimeout(CLIENT_READ_TIMEOUT)
+    try:
+        yield
+    finally:
+        conn.settimeout(prev)
+
+
+def make_download_ticket(user, game_name, version):
+    """
+    下載 ticket：player 在控制連線上申請，之後在另外開的資料連線上用它下載（資料連線不必登入）。
+    內容是 base64 的 JSON 加上 HMAC 簽章，server 不需要記住發出過哪些 ticket。
+    """
+    payload = json.dumps([user, game_name, version, int(time.time()) + DOWNLOAD_TICKET_TTL],
+                         separators=(',', ':')).encode('utf-8')
+    sig = hmac.new(DOWNLOAD_TICKET_KEY, payload, hashlib.sha256).hexdigest()
+    return base64.urlsafe_b64encode(payload).decode('ascii') + '.' + sig
+
+
+def check_download_ticket(ticket):
+    """驗證 ticket，有效時回傳 (user, game_name, version)，否則 None"""
+    try:
+        data, sig = ticket.split('.', 1)
+        payload = base64.urlsafe_b64decode(data.encode('ascii'))
+        expected = hmac.new(DOWNLOAD_TICKET_KEY, payload, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, sig):
+            return None
+        user, game_name, version, expires = json.loads(payload.decode('utf-8'))
+    except (AttributeError, ValueError, TypeError, UnicodeDecodeError):
+        return None
+    if expires < time.time():
+        return None
+    return user, game_name, version
+
+
+class ClientConnection:
+    """一條 client 連線的 session 狀態；reaper 也用它判斷閒置 / 卡住"""
+    __slots__ = ('conn', 'addr', 'observed_ip', 'user', 'role', 'token', 'connected_at',
+                 'last_activity', 'busy', 'reaped', 'bytes_mark', 'buckets', 'handed_off', 'transferring',
+                 'aborted')
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.observed_ip = addr[0]  # server 看到的來源 IP（通常是 public/NAT 後）
+        self.user = None
+        self.role = None
+        self.token = None  # session 的 resume token（SessionRegistry 發的）
+        self.connected_at = time.time()
+        self.last_activity = self.connected_at
+        self.busy = False
+        self.reaped = None
+        self.bytes_mark = (0, 0)
+        self.buckets = {}  # 限流類別 -> TokenBucket（per-session）
+        self.handed_off = False  # graceful restart 時交給新 process，不登出也不關閉
+        self.transferring = None  # 正在收送檔案時是 'download' / 'upload'
+        self.aborted = False  # 傳檔中斷，連線已對不上封包邊界：這個 request 處理完就關閉（也不交接）
+
+    def touch(self, busy: bool):
+        self.last_activity = time.time()
+        self.busy = busy
+
+    def is_role(self, role) -> bool:
+        return bool(self.user) and self.role == role
+
+
+class CommandSpec:
+    __slots__ = ('name', 'func', 'role', 'executor', 'rate_class')
+
+    def __init__(self, name, func, role, executor, rate_class):
+        self.name = name
+        self.func = func
+        self.role = role
+        self.executor = executor
+        self.rate_class = rate_class
+
+
+# 指令表：cmd -> CommandSpec，由 GameStoreServer 的 @command 方法註冊
+COMMANDS = {}
+
+
+def command(name, *, role=None, executor='inline', rate_class='default'):
+    """
+    註冊一個指令 handler：handler(self, client, request) -> response dict。
+    role: None 不需登入；'player' / 'developer' 需以該身分登入；'admin' 需帶 admin token。
+    executor: 'inline' 在連線執行緒上直接跑；'pool' / 'disk' 丟到對應的有界 thread pool，
+    讓重 CPU 或大量讀寫磁碟的指令不會全部同時擠在一起。
+    rate_class: RATE_LIMITS 的類別；None 表示不限流。
+    """
+    if executor not in COMMAND_EXECUTORS and executor != 'inline':
+        raise ValueError(f"unknown executor {executor!r}")
+
+    def register(func):
+        COMMANDS[name] = CommandSpec(name, func, role, executor, rate_class)
+        return func
+    return register
 
 
 class GameStoreServer:
-    def __init__(self, host, port):
-        migrate_old_database_if_exists()
-
-        self.dev_manager = AccountDB(DEV_DB_PATH, "developer")
-        self.player_manager = AccountDB(PLAYER_DB_PATH, "player")
-        self.game_db = GameDB(GAMES_DB_PATH)
-        self.room_mgr = RoomManager()
-
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen(20)
+    def __init__(self, host, port, *, room_mgr=None, sessions=None, reuse_port=False,
+                 backlog=LISTEN_BACKLOG, max_handlers=MAX_CLIENT_HANDLERS, listen_sock=None):
+        """
+        room_mgr / sessions 為 None 時使用本地物件（單 process 模式）；
+        多 process 模式由 worker 傳入共享 state service 的 proxy，並以 SO_REUSEPORT 共用同一個 port。
+        listen_sock：graceful restart 時從舊 process 接手的 listening socket（位址沒變才沿用）。
+        """
+        started = time.perf_counter()
+        self.shared = room_mgr is not None
+        if not self.shared:
+            run_migrations()
+        migrated = time.perf_counter()
+
+        # 帳號檔可能很大，背景載入；商城要立刻能查詢，GameDB 照常同步建好
+        self.dev_manager = AccountDB(DEV_DB_PATH, "developer", shared=self.shared, lazy=True)
+        self.player_manager = AccountDB(PLAYER_DB_PATH, "player", shared=self.shared, lazy=True)
+        self.game_db = GameDB(GAMES_DB_PATH, shared=self.shared)
+        games_loaded = time.perf_counter()
+        self.room_mgr = room_mgr if room_mgr is not None else RoomManager()
+        self.sessions = sessions if sessions is not None else SessionRegistry()
+
+        if listen_sock is not None and listen_sock.getsockname()[:2] != (host, port):
+            print(f"[*] Listen address changed {listen_sock.getsockname()[:2]} -> {(host, port)}, rebinding")
+            listen_sock.close()
+            listen_sock = None
+        if listen_sock is not None:
+            self.server_socket = listen_sock
+        else:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+        self.server_socket.listen(backlog)
         self.server_socket.settimeout(1.0)
+        self.startup_ms = {
+            'migrate': round((migrated - started) * 1000, 1),
+            'games': round((games_loaded - migrated) * 1000, 1),
+            'listen': round((time.perf_counter() - started) * 1000, 1),
+        }
 
         self.running = True
 
-        self.online_users = set()
-        self.online_users_lock = threading.Lock()
+        self.connections = {}  # id(ClientConnection) -> ClientConnection
+        self.connections_lock = threading.Lock()
+        self.conn_stats = {
+            'accepted': 0,
+            'closed': 0,
+            'idle_timeouts': 0,   # socket 層等不到 request 而結束
+            'reaped_idle': 0,     # reaper 回收的閒置連線
+            'reaped_stuck': 0,    # reaper 回收的卡住連線（處理中太久）
+            'shed': 0,            # 過載時直接回 SERVER_BUSY 的連線
+        }
+
+        # 連線 handler：固定大小的 thread pool + 有上限的排隊數，超過就拒絕而不是無限開執行緒。
+        # 每條連線從登入到斷線都佔著一個執行緒（閒置時阻塞在 poll 上，只耗 stack），
+        # 所以 max_handlers 就是同時在線的 session 數上限，要依預期的在線人數設定。
+        # 排隊的連線放在 waiting（而不是 pool 的內部 queue），這樣 accept 和 reaper 才看得到、
+        # 能在排太久時主動回 SERVER_BUSY，不會讓沒設 timeout 的 client 一直乾等
+        self.backlog = backlog
+        self.max_handlers = max_handlers
+        self.handler_pool = ThreadPoolExecutor(max_workers=max_handlers, thread_name_prefix="client")
+        self.waiting = collections.deque()   # (client_sock, addr, session, queued_at)
+        self.handler_gauges = {'active': 0, 'queued': 0, 'peak_active': 0, 'peak_queued': 0}
+
+        # graceful restart：handoff 設起來後閒置的 handler 不再讀 request，把連線停到 parked 等著交接；
+        # wake socket 讓卡在等 request 的 handler 立刻醒來
+        self.handoff = threading.Event()
+        self.accept_paused = threading.Event()
+        self.parked = []
+        self._wake_r, self._wake_w = socket.socketpair()
 
         if not os.path.exists(STORAGE_DIR):
             os.makedirs(STORAGE_DIR)
 
-        self.room_cleanup_thread = threading.Thread(target=self._room_cleanup_loop, daemon=True)
-        self.room_cleanup_thread.start()
+        self.reaper_thread = threading.Thread(target=self._reaper_loop, daemon=True)
+        self.reaper_thread.start()
+
+        self.metrics = ServerMetrics()
+        self.profiler = SamplingProfiler()
+        self.memory_tracer = MemoryTracer()
+        # 多 process 模式下由 parent 負責掃描 / 重新壓縮 storage/，避免每個 worker 重複做
+        self.storage_gc = None
+        self.tiering = None
+        self.downloads = DownloadTracker(shared=self.shared)
+        self.downloads.start()
+        self.uploads = UploadPipeline(lambda: self.game_db)
+        if not self.shared:
+            self.storage_gc = StorageGC(lambda: self.game_db)
+            self.storage_gc.start()
+            self.tiering = ColdTiering(lambda: self.game_db, self.downloads)
+            self.tiering.start()
+        self.executors = {name: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"cmd-{name}")
+                          for name, n in COMMAND_EXECUTORS.items()}
+        self.executor_lock = threading.Lock()
+        self.executor_queued = dict.fromkeys(COMMAND_EXECUTORS, 0)  # 已送進 executor、還沒開始跑的指令數
+        self.rate_limiter = RateLimiter()
+        self.middleware = [self._metrics_middleware, self._reply_middleware, self._replay_middleware,
+                           self._rate_limit_middleware]
+        if TRACE_COMMANDS:
+            self.middleware.append(self._trace_middleware)
+        self._build_dispatch()
+        if STATS_DUMP_PATH:
+            threading.Thread(target=self._stats_dump_loop, daemon=True).start()
+
+        if not self.shared:
+            # 多 process 模式下由 state service 負責回收房間
+            self.room_cleanup_thread = threading.Thread(target=self._room_cleanup_loop, daemon=True)
+            self.room_cleanup_thread.start()
         print("[*]", SERVER_BUILD)
-        print(f"[*] Server listening on {host}:{port}")
+        print(f"[*] Server listening on {host}:{port} (pid={os.getpid()}) after {self.startup_ms['listen']} ms")
         print("[*]", SERVER_BUILD)
 
     def _room_cleanup_loop(self):
+        room_expiry_loop(self.room_mgr, lambda: self.running)
+
+    def _reaper_loop(self):
+        while self.running:
+            time.sleep(REAPER_INTERVAL)
+            with self.connections_lock:
+                expired = self._expire_waiting()
+            for client_sock, _, _, _ in expired:
+                self._shed(client_sock)
+            now = time.time()
+            with self.connections_lock:
+                tracked = list(self.connections.values())
+            for c in tracked:
+                idle = now - c.last_activity
+                if c.busy and idle > CLIENT_BUSY_TIMEOUT:
+                    c.reaped = 'reaped_stuck'
+                elif not c.busy and c.user is None and idle > CLIENT_IDLE_TIMEOUT:
+                    c.reaped = 'reaped_idle'
+                else:
+                    continue
+                # shutdown 會讓卡在 recv/send 的 handler 執行緒立刻返回並走正常的清理流程
+                try:
+                    c.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _record_metrics(self, cmd, response, started, client):
+        elapsed = time.perf_counter() - started
+        ok = isinstance(response, dict) and response.get('status') not in ('FAIL', 'ERROR')
+        self.metrics.record(cmd, elapsed, ok,
+                            client.conn.bytes_in - client.bytes_mark[0],
+                            client.conn.bytes_out - client.bytes_mark[1])
+
+    def _is_admin(self, request) -> bool:
+        token = str(request.get('token') or '')
+        return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+    def collect_stats(self):
+        stats = self.metrics.snapshot()
+        stats['pid'] = os.getpid()
+        stats['connections'] = self.connection_stats()
+        stats['handlers'] = self.handler_stats()
+        stats['online_users'] = self.sessions.count()
+        stats['matchmaking'] = self.room_mgr.matchmaking_stats()
+        stats['rate_limit'] = self.rate_limiter.stats()
+        stats['startup_ms'] = self.startup_stats()
+        if self.storage_gc is not None:
+            stats['storage'] = self.storage_gc.stats()
+        if self.tiering is not None:
+            stats['tiering'] = self.tiering.stats()
+        stats['uploads'] = self.uploads.stats()
+        return stats
+
+    def startup_stats(self):
+        stats = dict(self.startup_ms)
+        stats['developers'] = self.dev_manager.load_ms
+        stats['players'] = self.player_manager.load_ms
+        return stats
+
+    def _stats_dump_loop(self):
+        # 多 process 模式下每個 worker 各寫一份
+        path = STATS_DUMP_PATH if not self.shared else f"{STATS_DUMP_PATH}.{os.getpid()}"
         while self.running:
+            time.sleep(STATS_DUMP_INTERVAL)
             try:
-                self.room_mgr.cleanup_expired(ttl_sec=10)
-            except:
+                save_json(path, self.collect_stats())
+            except Exception as e:
+                print(f"[!] Stats dump failed: {e}")
+
+    def connection_stats(self):
+        with self.connections_lock:
+            stats = dict(self.conn_stats)
+            stats['active'] = len(self.connections)
+        return stats
+
+    def reload(self):
+        """
+        重新讀設定檔、games.json 與帳號檔。新的 GameDB 完整建好後才換上（單一 attribute 指派），
+        進行中的 request 繼續用舊的快照，不會看到載入一半的狀態。
+        設定檔和 games.json 都檢查過才開始套用；載入到換上之間持有舊 GameDB 的寫入鎖
+        （多 process 時含檔案鎖），避免同時進行的上傳寫進舊物件後被新的快照蓋掉。
+        """
+        try:
+            updates = read_server_config()
+            games_path = resolve_db_path(GAMES_DB_PATH)
+            if games_path.endswith('.snap'):
+                SnapshotStore(games_path)  # 開檔會檢查 magic / 索引
+            elif os.path.exists(games_path):
+                with open(games_path, 'r', encoding='utf-8') as f:
+                    json.load(f)  # 壞掉的檔案不要載入成空的商城
+        except (OSError, ValueError) as e:
+            print(f"[!] Reload failed: {e}")
+            return False, f"Reload failed: {e}"
+
+        with self.game_db._mutation():
+            applied, pending = apply_server_config(updates)
+            if not os.path.exists(STORAGE_DIR):
+                os.makedirs(STORAGE_DIR)
+            self.rate_limiter.limits = RATE_LIMITS
+            game_db = GameDB(GAMES_DB_PATH, shared=self.shared)
+            self.game_db = game_db
+        self.dev_manager.reload()
+        self.player_manager.reload()
+
+        msg = f"Reloaded {len(game_db.games)} games"
+        if applied:
+            msg += f"; applied {', '.join(applied)}"
+        if pending:
+            msg += f"; restart required for {', '.join(pending)}"
+        print(f"[*] {msg}")
+        return True, msg
+
+    def graceful_restart(self):
+        """
+        啟動新 process 並把 listening socket、房間狀態與所有閒置連線（含登入身分）交給它，
+        client 不會斷線。實際交接在背景執行緒進行，這裡只負責開始。
+        """
+        if self.shared:
+            return False, "Graceful restart is only supported in single-process mode."
+        if not hasattr(socket, 'send_fds'):
+            return False, "Graceful restart is not supported on this platform."
+        with self.connections_lock:
+            if self.handoff.is_set():
+                return False, "Restart already in progress."
+            self.handoff.set()
+        self._wake_w.send(b'x')
+        threading.Thread(target=self._handoff, daemon=True).start()
+        return True, "Restart started."
+
+    def _handoff(self):
+        print("[*] Graceful restart: draining...")
+        deadline = time.monotonic() + HANDOFF_DRAIN_SEC
+        while time.monotonic() < deadline:
+            with self.connections_lock:
+                idle = self.handler_gauges['active'] == 0 and self.handler_gauges['queued'] == 0
+            # 上傳處理流程也要跑完，否則新 process 不知道這些上傳
+            if idle and self.accept_paused.is_set() and self.uploads.idle():
+                break
+            time.sleep(0.05)
+
+        detached = self._cut_transfers()
+        with self.connections_lock:
+            parked, self.parked = self.parked, []
+            busy = len(self.connections)
+        if busy:
+            print(f"[!] Graceful restart: {busy} connection(s) still busy, they will be dropped")
+
+        state = {
+            'rooms': self.room_mgr.export_state(),
+            'clients': [{'addr': list(c.addr), 'user': c.user, 'role': c.role, 'token': c.token} for c in parked],
+            'detached': detached,
+        }
+        fds = [self.server_socket.fileno()] + [c.conn.fileno() for c in parked]
+        ok, msg = self._send_handoff(state, fds)
+        if not ok:
+            print(f"[!] Graceful restart failed: {msg}; resuming")
+            self._resume(parked)
+            return
+
+        # 新 process 已持有這些 socket，這裡只關掉自己的 fd（不 shutdown，連線不受影響）
+        for c in parked:
+            try:
+                c.conn.close()
+            except OSError:
+                pass
+        print(f"[*] Handed off {len(parked)} connection(s) and {len(state['rooms']['rooms'])} room(s) to {msg}")
+        self.running = False
+
+    def _cut_transfers(self):
+        """
+        drain 時間到還在收送檔案的連線不直接砍掉，而是讓它們以可續傳的方式收尾：
+        下載的資料連線送到一半就斷開，client 會帶 offset/etag 到新 process 從斷點續傳（ticket 金鑰沿用）；
+        上傳停止接收並回 SERVER_BUSY，登入狀態帶到新 process 當作斷線保留，client RESUME 後重新上傳。
+        回傳要交給新 process 保留的 session。
+        """
+        with self.connections_lock:
+            cut = [c for c in self.connections.values() if c.transferring]
+        if not cut:
+            return []
+        print(f"[*] Graceful restart: interrupting {len(cut)} transfer(s), clients will resume")
+        for c in cut:
+            try:
+                # 上傳只關讀的方向：recv 立刻返回，之後還能把 SERVER_BUSY 寫回去
+                c.conn.shutdown(socket.SHUT_RD if c.transferring == 'upload' else socket.SHUT_RDWR)
+            except OSError:
+                pass
+        deadline = time.monotonic() + HANDOFF_CUT_GRACE_SEC
+        while time.monotonic() < deadline and any(c.transferring for c in cut):
+            time.sleep(0.05)
+        return [{'user': c.user, 'role': c.role, 'token': c.token} for c in cut if c.user and c.role]
+
+    @contextlib.contextmanager
+    def _transferring(self, client, kind):
+        """收送檔案期間套用 transfer_timeout，並標記這條連線，讓 graceful restart 能中斷後請 client 續傳"""
+        with transfer_timeout(client.conn):
+            client.transferring = kind
+            try:
+                yield
+            finally:
+                client.transferring = None
+
+    def _send_handoff(self, state, fds):
+        path = os.path.join(tempfile.gettempdir(), f"np_lobby_handoff_{os.getpid()}.sock")
+        if os.path.exists(path):
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        proc = None
+        try:
+            listener.bind(path)
+            listener.listen(1)
+            listener.settimeout(HANDOFF_CONNECT_SEC)
+
+            argv = list(sys.argv)
+            if '--takeover' in argv:
+                i = argv.index('--takeover')
+                del argv[i:i + 2]
+            # 新 process 沿用同一把 ticket 金鑰，被中斷的下載才能憑原本的 ticket 續傳
+            env = dict(os.environ, LOBBY_TICKET_KEY=DOWNLOAD_TICKET_KEY.decode('utf-8'))
+            proc = subprocess.Popen([sys.executable] + argv + ['--takeover', path], start_new_session=True, env=env)
+
+            chan, _ = listener.accept()
+            with chan:
+                chan.settimeout(HANDOFF_CONNECT_SEC)
+                send_json(chan, dict(state, fd_count=len(fds)))
+                for i in range(0, len(fds), HANDOFF_FDS_PER_MSG):
+                    socket.send_fds(chan, [b'F'], fds[i:i + HANDOFF_FDS_PER_MSG])
+                ack = recv_json(chan)
+            if not ack or ack.get('status') != 'OK':
+                raise ConnectionError("new process did not acknowledge")
+            return True, f"pid {ack.get('pid', proc.pid)}"
+        except (OSError, ConnectionError) as e:
+            if proc is not None and proc.poll() is None:
+                proc.kill()
+            return False, str(e) or type(e).__name__
+        finally:
+            listener.close()
+            try:
+                os.remove(path)
+            except OSError:
                 pass
-            time.sleep(2)
+
+    def _resume(self, parked):
+        # 先把 wake socket 讀乾淨再清旗標，否則接回的 handler 會一直被叫醒
+        self._wake_r.setblocking(False)
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+        self._wake_r.setblocking(True)
+        self.handoff.clear()
+        for c in parked:
+            self._adopt(c.conn._sock, c.addr, (c.user, c.role, c.token) if c.user else None)
+
+    def handler_stats(self):
+        with self.connections_lock:
+            stats = dict(self.handler_gauges)
+        stats['max_handlers'] = self.max_handlers
+        stats['queue_max'] = HANDLER_QUEUE_MAX
+        stats['backlog'] = self.backlog
+        stats['threads'] = threading.active_count()
+        with self.executor_lock:
+            stats['executor_queues'] = dict(self.executor_queued)
+        return stats
+
+    def _shed(self, client_sock):
+        """過載時在讀任何 request 之前回一個 SERVER_BUSY 後關閉"""
+        with self.connections_lock:
+            self.conn_stats['shed'] += 1
+        try:
+            client_sock.settimeout(1.0)
+            send_json(client_sock, {'status': 'SERVER_BUSY', 'msg': 'Server busy, try again later',
+                                    'retry_after': 1})
+        except OSError:
+            pass
+        try:
+            client_sock.close()
+        except OSError:
+            pass
+
+    def _expire_waiting(self):
+        """從 waiting 取出排隊超過 HANDLER_QUEUE_TIMEOUT 的連線（呼叫端持有 connections_lock，拿到後自己 _shed）"""
+        expired = []
+        deadline = time.monotonic() - HANDLER_QUEUE_TIMEOUT
+        while self.waiting and self.waiting[0][3] < deadline:
+            expired.append(self.waiting.popleft())
+        self.handler_gauges['queued'] -= len(expired)
+        return expired
+
+    def _run_handler(self, client_sock, addr, session=None):
+        # 一條連線結束後直接在同一個執行緒接手下一條排隊的連線，pool 的內部 queue 永遠是空的
+        while client_sock is not None:
+            try:
+                self.handle_client(client_sock, addr, session)
+            except Exception as e:
+                print(f"[!] Handler error for {addr}: {e}")
+            with self.connections_lock:
+                expired = self._expire_waiting()
+                if self.waiting and self.running:
+                    client_sock, addr, session, _ = self.waiting.popleft()
+                    self.handler_gauges['queued'] -= 1
+                else:
+                    client_sock = None
+                    self.handler_gauges['active'] -= 1
+            for stale, _, _, _ in expired:
+                self._shed(stale)
+
+    def _adopt(self, client_sock, addr, session=None):
+        """把一條已連上的 socket 交給 handler pool；session=(user, role, token) 表示沿用既有的登入狀態"""
+        tune_client_socket(client_sock)
+        # 閒置回收主要由 reaper 負責；socket timeout 只是保底
+        client_sock.settimeout(CLIENT_IDLE_TIMEOUT + REAPER_INTERVAL)
+        with self.connections_lock:
+            # 每次 accept 都順便清掉排太久的，讓它們立刻收到 SERVER_BUSY 並空出排隊位置
+            expired = self._expire_waiting()
+            g = self.handler_gauges
+            if g['active'] < self.max_handlers:
+                g['active'] += 1
+                g['peak_active'] = max(g['peak_active'], g['active'])
+                start = True
+            elif len(self.waiting) < HANDLER_QUEUE_MAX:
+                self.waiting.append((client_sock, addr, session, time.monotonic()))
+                g['queued'] += 1
+                g['peak_queued'] = max(g['peak_queued'], g['queued'])
+                start = False
+            else:
+                start = None
+        for stale, _, _, _ in expired:
+            self._shed(stale)
+        if start is None:
+            self._shed(client_sock)
+            return False
+        if start:
+            self.handler_pool.submit(self._run_handler, client_sock, addr, session)
+        return True
+
+    def _install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        # signal handler 裡只開執行緒，避免和主執行緒正持有的 lock 互卡
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=self.reload, daemon=True).start())
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2,
+                          lambda *_: threading.Thread(target=self.graceful_restart, daemon=True).start())
 
     def start(self):
+        self._install_signal_handlers()
         try:
             while self.running:
+                if self.handoff.is_set():
+                    # 交接中不再 accept，新連線留在 kernel backlog 給新 process；交接失敗會清掉旗標繼續服務
+                    self.accept_paused.set()
+                    time.sleep(0.1)
+                    continue
+                self.accept_paused.clear()
                 try:
                     client_sock, addr = self.server_socket.accept()
-                    client_sock.settimeout(None)
-                    t = threading.Thread(target=self.handle_client, args=(client_sock, addr), daemon=True)
-                    t.start()
                 except socket.timeout:
                     continue
+                self._adopt(client_sock, addr)
         except KeyboardInterrupt:
             print("\n[*] Server stopping...")
             self.running = False
@@ -579,199 +3889,773 @@ class GameStoreServer:
                 self.server_socket.close()
             except:
                 pass
+            # handler pool 的執行緒不是 daemon：關掉所有連線讓它們結束，排隊中的直接取消
+            self.running = False
+            if self.storage_gc is not None:
+                self.storage_gc.stop()
+            if self.tiering is not None:
+                self.tiering.stop()
+            self.downloads.running = False
+            self.downloads.flush()
+            self.uploads.shutdown()
+            self.handler_pool.shutdown(wait=False, cancel_futures=True)
+            with self.connections_lock:
+                tracked = list(self.connections.values())
+                waiting, self.waiting = list(self.waiting), collections.deque()
+                self.handler_gauges['queued'] = 0
+            for client_sock, _, _, _ in waiting:
+                try:
+                    client_sock.close()
+                except OSError:
+                    pass
+            for c in tracked:
+                try:
+                    c.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    # ---------- 指令分派 ----------
+    def _build_dispatch(self):
+        """把 middleware 由外而內包在 _invoke 外面：middleware(spec, client, request, call_next)"""
+        handler = self._invoke
+        for mw in reversed(self.middleware):
+            handler = functools.partial(mw, call_next=handler)
+        self._dispatch = handler
+
+    def _invoke(self, spec, client, request):
+        if spec is None:
+            return {'status': 'ERROR', 'msg': 'Unknown command'}
+        if spec.role == 'admin':
+            if not self._is_admin(request):
+                self.rate_limiter.charge_ip(client, spec.rate_class or 'auth')
+                return {'status': 'FAIL', 'msg': 'Permission denied'}
+        elif spec.role is not None and not client.is_role(spec.role):
+            return {'status': 'FAIL', 'msg': 'Permission denied'}
+        if spec.executor == 'inline':
+            return spec.func(self, client, request)
+        with self.executor_lock:
+            self.executor_queued[spec.executor] += 1
+        return self.executors[spec.executor].submit(self._run_queued, spec, client, request).result()
+
+    def _run_queued(self, spec, client, request):
+        with self.executor_lock:
+            self.executor_queued[spec.executor] -= 1
+        return spec.func(self, client, request)
+
+    def _metrics_middleware(self, spec, client, request, call_next):
+        started = time.perf_counter()
+        response = None
+        try:
+            response = call_next(spec, client, request)
+            return response
+        finally:
+            self._record_metrics(spec.name if spec else '<unknown>', response, started, client)
+
+    def _reply_middleware(self, spec, client, request, call_next):
+        response = call_next(spec, client, request)
+        # handler 已自行回覆（例如下載中斷）時不再送最後的 response
+        if not response.pop('_no_reply', False):
+            send_json(client.conn, response)
+        return response
+
+    def _replay_middleware(self, spec, client, request, call_next):
+        """
+        client 斷線重連後會用同一個 req_id 重送沒收到回應的 request；
+        已經執行過的就直接回當時的結果，避免同一個建房/加入等動作做兩次。
+        """
+        req_id = request.get('req_id')
+        if not req_id or not client.user or spec is None:
+            return call_next(spec, client, request)
+        if request.get('replay'):
+            cached = self.sessions.cached_reply(client.role, client.user, req_id)
+            if cached is not None:
+                return dict(cached, replayed=True)
+        response = call_next(spec, client, request)
+        # 自行回覆的串流指令（例如下載）沒辦法重播；被限流的 request 其實沒執行，也不記
+        if client.user and not response.get('_no_reply') \
+                and response.get('status') not in ('RATE_LIMITED', 'SERVER_BUSY'):
+            self.sessions.remember_reply(client.role, client.user, req_id, response)
+        return response
+
+    def _rate_limit_middleware(self, spec, client, request, call_next):
+        rate_class = spec.rate_class if spec else 'default'
+        if rate_class:
+            wait = self.rate_limiter.check(client, rate_class)
+            if wait:
+                return {'status': 'RATE_LIMITED', 'msg': 'Too many requests',
+                        'retry_after': round(wait, 3)}
+        return call_next(spec, client, request)
+
+    def _trace_middleware(self, spec, client, request, call_next):
+        started = time.perf_counter()
+        response = call_next(spec, client, request)
+        status = response.get('status') if isinstance(response, dict) else None
+        print(f"[trace] pid={os.getpid()} {client.addr[0]}:{client.addr[1]} user={client.user} "
+              f"cmd={request.get('cmd')} status={status} {(time.perf_counter() - started) * 1000:.2f}ms")
+        return response
+
+    def _wait_for_request(self, conn):
+        """
+        等 client 送下一個 request：回傳 'request'、'timeout'，
+        或 'handoff'（graceful restart 中，不讀任何資料，request 留在 socket 裡給新 process）。
+        """
+        timeout = conn.gettimeout()
+        while not self.handoff.is_set():
+            if hasattr(select, 'poll'):
+                poller = select.poll()
+                poller.register(conn, select.POLLIN)
+                poller.register(self._wake_r, select.POLLIN)
+                ready = [fd for fd, _ in poller.poll(None if timeout is None else timeout * 1000)]
+                conn_ready = conn.fileno() in ready
+            else:
+                ready, _, _ = select.select([conn, self._wake_r], [], [], timeout)
+                conn_ready = conn in ready
+            if not ready:
+                return 'timeout'
+            if self.handoff.is_set():
+                break
+            if conn_ready:
+                return 'request'
+        return 'handoff'
 
-    def handle_client(self, conn, addr):
-        current_user = None
-        current_role = None
-        observed_ip = addr[0]  # ✅ 這個就是 server 看到的來源 IP（通常是 public/NAT 後）
+    def handle_client(self, conn, addr, session=None):
+        conn = CountingSocket(conn)
+        client = ClientConnection(conn, addr)
+        if session:
+            client.user, client.role, client.token = session
+        with self.connections_lock:
+            self.connections[id(client)] = client
+            self.conn_stats['accepted'] += 1
 
         try:
             while True:
-                request = recv_json(conn)
+                client.touch(busy=False)
+                client.bytes_mark = (conn.bytes_in, conn.bytes_out)
+                ready = self._wait_for_request(conn)
+                if ready == 'handoff':
+                    client.handed_off = True
+                    break
+                if ready == 'timeout' and client.user is not None:
+                    continue  # 已登入的連線只是閒著，對方真的消失時 keepalive 會讓 poll 回報錯誤
+                request = recv_json(conn, body_timeout=CLIENT_READ_TIMEOUT) if ready == 'request' else None
                 if not request:
+                    if client.reaped is None and time.time() - client.last_activity >= CLIENT_IDLE_TIMEOUT:
+                        with self.connections_lock:
+                            self.conn_stats['idle_timeouts'] += 1
                     break
+                client.touch(busy=True)
+
+                if self.shared:
+                    self.game_db.refresh_if_stale()
 
                 cmd = request.get('cmd')
-                response = {'status': 'ERROR', 'msg': 'Unknown command'}
-
-                if cmd == 'PING':
-                    response = {'status': 'OK', 'msg': 'Pong'}
-
-                elif cmd == 'REGISTER':
-                    username = request.get('user')
-                    password = request.get('pwd')
-                    role = request.get('role', 'player')
-
-                    if role == 'developer':
-                        ok, msg = self.dev_manager.register(username, password)
-                    else:
-                        ok, msg = self.player_manager.register(username, password)
-
-                    response = {'status': 'OK' if ok else 'FAIL', 'msg': msg}
-
-                elif cmd == 'LOGIN':
-                    username = request.get('user')
-                    password = request.get('pwd')
-                    role = request.get('role', 'player')
-
-                    mgr = self.dev_manager if role == 'developer' else self.player_manager
-                    ok, msg = mgr.login(username, password)
-
-                    if ok:
-                        with self.online_users_lock:
-                            key = (role, username)
-                            if key in self.online_users:
-                                ok = False
-                                msg = "帳號已在其他裝置登入"
-                            else:
-                                self.online_users.add(key)
-                                current_user = username
-                                current_role = role
-
-                    response = {'status': 'OK', 'msg': msg, 'role': role} if ok else {'status': 'FAIL', 'msg': msg}
-
-                elif cmd == 'LOGOUT':
-                    if current_user and current_role:
-                        with self.online_users_lock:
-                            self.online_users.discard((current_role, current_user))
-                    current_user = None
-                    current_role = None
-                    response = {'status': 'OK', 'msg': 'Logged out'}
-
-                # ---------- Player ----------
-                elif cmd == 'LIST_PUBLIC_GAMES':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        response = {'status': 'OK', 'games': self.game_db.list_public_games()}
-
-                elif cmd == 'GET_GAME_DETAIL':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        game_name = (request.get('game_name') or '').strip()
-                        detail = self.game_db.get_game_detail(game_name)
-                        if detail is None:
-                            response = {'status': 'FAIL', 'msg': 'Game not found'}
-                        elif not detail.get('published', True):
-                            response = {'status': 'FAIL', 'msg': 'Game is unpublished'}
-                        else:
-                            response = {'status': 'OK', 'detail': detail}
-
-                elif cmd == 'DOWNLOAD_REQUEST':
-                    if not current_user or current_role != 'player':
-                        send_json(conn, {'status': 'FAIL', 'msg': 'Permission denied'})
-                        continue
+                spec = COMMANDS.get(cmd) if isinstance(cmd, str) else None
+                self._dispatch(spec, client, request)
+                if client.aborted:
+                    break
 
-                    game_name = (request.get('game_name') or '').strip()
-                    version = str(request.get('version') or '').strip()
-                    if not game_name or not version:
-                        send_json(conn, {'status': 'FAIL', 'msg': 'Bad request'})
-                        continue
+        except Exception as e:
+            print(f"[!] Error handling client {addr}: {e}")
+        finally:
+            with self.connections_lock:
+                self.connections.pop(id(client), None)
+                if client.handed_off:
+                    # 連線與登入狀態原封不動交給新 process（交接失敗時由 _resume 接回）
+                    self.parked.append(client)
+                else:
+                    self.conn_stats['closed'] += 1
+                    if client.reaped:
+                        self.conn_stats[client.reaped] += 1
+            if not client.handed_off:
+                self._release_client(client)
 
-                    abs_path = self.game_db.resolve_zip_path(game_name, version)
-                    if abs_path is None:
-                        send_json(conn, {'status': 'FAIL', 'msg': 'Game/version not available'})
-                        continue
+    def _release_client(self, client):
+        """連線結束：取消配對、登出並關閉 socket"""
+        if client.reaped:
+            print(f"[*] Reaped connection {client.addr} ({client.reaped}, user={client.user})")
+        if client.is_role('player'):
+            self.room_mgr.cancel_quick_join(client.user)
+        if client.user and client.role:
+            try:
+                # 連線中斷不等於登出：保留 session 讓 client 在寬限期內 RESUME
+                self.sessions.logout(client.role, client.user, client.token, resumable=True)
+            except Exception:
+                pass
+        try:
+            client.conn.close()
+        except:
+            pass
 
-                    file_size = os.path.getsize(abs_path)
-                    send_json(conn, {'status': 'READY', 'file_size': file_size})
+    # ---------- 一般 ----------
+    @command('PING')
+    def _cmd_ping(self, client, request):
+        return {'status': 'OK', 'msg': 'Pong'}
 
-                    ok = send_file(conn, abs_path)
-                    if not ok:
-                        continue
-                    send_json(conn, {'status': 'OK', 'msg': 'Download complete'})
-                    continue
+    @command('REGISTER', executor='disk', rate_class='auth')
+    def _cmd_register(self, client, request):
+        username = request.get('user')
+        password = request.get('pwd')
+        role = request.get('role', 'player')
+
+        if role == 'developer':
+            ok, msg = self.dev_manager.register(username, password)
+        else:
+            ok, msg = self.player_manager.register(username, password)
 
-                # ---------- Rooms ----------
-                elif cmd == 'CREATE_ROOM':
-                    print("[DBG] CREATE_ROOM request =", request, " observed_ip =", observed_ip)
-
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        game_name = (request.get('game_name') or '').strip()
-                        version = str(request.get('version') or '').strip()
-                        max_players = int(request.get('max_players', 3))
-
-                        reported_ip = (request.get('host_ip') or '').strip()
-
-                        if not self.game_db.is_published(game_name):
-                            response = {'status': 'FAIL', 'msg': 'Game is unpublished. Cannot create room.'}
-                        elif not self.game_db.has_version(game_name, version):
-                            response = {'status': 'FAIL', 'msg': 'Version not available.'}
-                        else:
-                            room = self.room_mgr.create_room(
-                                host_user=current_user,
-                                reported_host_ip=reported_ip,
-                                observed_host_ip=observed_ip,
-                                game_name=game_name,
-                                version=version,
-                                max_players=max_players
-                            )
-                            response = {'status': 'OK', 'room': room}
-
-
-
-                elif cmd == 'LIST_ROOMS':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        rooms = [r for r in self.room_mgr.list_rooms() if r.get('status') == 'OPEN']
-                        response = {'status': 'OK', 'rooms': rooms}
-
-                elif cmd == 'JOIN_ROOM':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        rid = int(request.get('room_id', 0))
-                        ok, msg = self.room_mgr.join_room(rid, current_user)
-                        if ok:
-                            room = self.room_mgr.get_room(rid)
-                            response = {'status': 'OK', 'msg': msg, 'room': room}
-                        else:
-                            response = {'status': 'FAIL', 'msg': msg}
-
-                elif cmd == 'LEAVE_ROOM':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        rid = int(request.get('room_id', 0))
-                        ok, msg = self.room_mgr.leave_room(rid, current_user)
-                        response = {'status': 'OK', 'msg': msg} if ok else {'status': 'FAIL', 'msg': msg}
-
-                elif cmd == 'HEARTBEAT_ROOM':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        rid = int(request.get('room_id', 0))
-                        ok, msg = self.room_mgr.heartbeat(rid, current_user)
-                        response = {'status': 'OK', 'msg': msg} if ok else {'status': 'FAIL', 'msg': msg}
-
-                elif cmd == 'CLOSE_ROOM':
-                    if not current_user or current_role != 'player':
-                        response = {'status': 'FAIL', 'msg': 'Permission denied'}
-                    else:
-                        rid = int(request.get('room_id', 0))
-                        ok, msg = self.room_mgr.close_room(rid, current_user)
-                        response = {'status': 'OK', 'msg': msg} if ok else {'status': 'FAIL', 'msg': msg}
-
-                send_json(conn, response)
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
 
-        except Exception as e:
-            print(f"[!] Error handling client {addr}: {e}")
-        finally:
-            if current_user and current_role:
-                with self.online_users_lock:
-                    self.online_users.discard((current_role, current_user))
+    @command('LOGIN', rate_class='auth')
+    def _cmd_login(self, client, request):
+        username = request.get('user')
+        password = request.get('pwd')
+        role = request.get('role', 'player')
+
+        mgr = self.dev_manager if role == 'developer' else self.player_manager
+        ok, msg = mgr.login(username, password)
+
+        if ok:
+            token = self.sessions.try_login(role, username)
+            if not token:
+                ok = False
+                msg = "帳號已在其他裝置登入"
+            else:
+                client.user, client.role, client.token = username, role, token
+
+        if not ok:
+            return {'status': 'FAIL', 'msg': msg}
+        return {'status': 'OK', 'msg': msg, 'role': role, 'resume_token': client.token}
+
+    @command('RESUME', rate_class='auth')
+    def _cmd_resume(self, client, request):
+        """斷線重連後用 LOGIN 拿到的 resume token 接回 session（不需密碼）"""
+        username = request.get('user')
+        role = request.get('role', 'player')
+        if client.user:
+            return {'status': 'FAIL', 'msg': 'Already logged in'}
+        token = self.sessions.resume(role, username, request.get('token'))
+        if not token:
+            return {'status': 'FAIL', 'msg': 'Session expired'}
+        client.user, client.role, client.token = username, role, token
+        return {'status': 'OK', 'msg': 'Session resumed', 'role': role, 'resume_token': token}
+
+    @command('LOGOUT')
+    def _cmd_logout(self, client, request):
+        if client.is_role('player'):
+            self.room_mgr.cancel_quick_join(client.user)
+        if client.user and client.role:
+            self.sessions.logout(client.role, client.user, client.token)
+        client.user = client.role = client.token = None
+        return {'status': 'OK', 'msg': 'Logged out'}
+
+    # ---------- Admin ----------
+    @command('STATS', role='admin', rate_class='auth')
+    def _cmd_stats(self, client, request):
+        return {'status': 'OK', 'stats': self.collect_stats()}
+
+    @command('PROFILE_START', role='admin', rate_class='auth')
+    def _cmd_profile_start(self, client, request):
+        ok, msg = self.profiler.start(request.get('interval_ms'))
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+    @command('PROFILE_STOP', role='admin', executor='disk', rate_class='auth')
+    def _cmd_profile_stop(self, client, request):
+        ok, msg, path = self.profiler.stop()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg, 'path': path}
+
+    @command('TRACEMALLOC_SNAPSHOT', role='admin', executor='pool', rate_class='auth')
+    def _cmd_tracemalloc_snapshot(self, client, request):
+        ok, msg, path = self.memory_tracer.snapshot()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg, 'path': path}
+
+    @command('TRACEMALLOC_DIFF', role='admin', executor='pool', rate_class='auth')
+    def _cmd_tracemalloc_diff(self, client, request):
+        ok, msg, path = self.memory_tracer.diff()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg, 'path': path}
+
+    @command('TRACEMALLOC_STOP', role='admin', rate_class='auth')
+    def _cmd_tracemalloc_stop(self, client, request):
+        ok, msg = self.memory_tracer.stop()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+    @command('RELOAD', role='admin', executor='disk', rate_class='auth')
+    def _cmd_reload(self, client, request):
+        ok, msg = self.reload()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+    @command('STORAGE_GC', role='admin', rate_class='auth')
+    def _cmd_storage_gc(self, client, request):
+        if self.storage_gc is None:
+            return {'status': 'FAIL', 'msg': "Storage scan runs in the parent process in multi-process mode."}
+        ok, msg = self.storage_gc.trigger()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg, 'storage': self.storage_gc.stats()}
+
+    @command('TIERING_RUN', role='admin', rate_class='auth')
+    def _cmd_tiering_run(self, client, request):
+        if self.tiering is None:
+            return {'status': 'FAIL', 'msg': "Tiering runs in the parent process in multi-process mode."}
+        ok, msg = self.tiering.trigger()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg, 'tiering': self.tiering.stats()}
+
+    @command('RESTART', role='admin', rate_class='auth')
+    def _cmd_restart(self, client, request):
+        ok, msg = self.graceful_restart()
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+    # ---------- Player：商城 ----------
+    @command('LIST_PUBLIC_GAMES', role='player', rate_class='query')
+    def _cmd_list_public_games(self, client, request):
+        uploader = (request.get('uploader') or '').strip() or None
+        open_games = self.room_mgr.games_with_open_rooms() if request.get('has_rooms') else None
+        try:
+            games, next_cursor = self.game_db.query_public_games(
+                limit=request.get('limit'),
+                cursor=request.get('cursor') or None,
+                sort=request.get('sort') or 'name',
+                uploader=uploader,
+                prefix=(request.get('prefix') or '').strip(),
+                open_games=open_games
+            )
+            return {'status': 'OK', 'games': games, 'next_cursor': next_cursor}
+        except (ValueError, TypeError) as e:
+            return {'status': 'FAIL', 'msg': f'Bad request: {e}'}
+
+    @command('SEARCH_GAMES', role='player', executor='pool', rate_class='query')
+    def _cmd_search_games(self, client, request):
+        query = (request.get('query') or '').strip()
+        if not query:
+            return {'status': 'FAIL', 'msg': 'Empty query'}
+        try:
+            games = self.game_db.search_public_games(query, request.get('limit'))
+            return {'status': 'OK', 'games': games}
+        except (ValueError, TypeError) as e:
+            return {'status': 'FAIL', 'msg': f'Bad request: {e}'}
+
+    @command('GET_GAME_DETAIL', role='player', rate_class='query')
+    def _cmd_get_game_detail(self, client, request):
+        game_name = (request.get('game_name') or '').strip()
+        detail = self.game_db.get_game_detail(game_name)
+        if detail is None:
+            return {'status': 'FAIL', 'msg': 'Game not found'}
+        if not detail.get('published', True):
+            return {'status': 'FAIL', 'msg': 'Game is unpublished'}
+        # 可選的版本範圍查詢，例如 version_spec="1.x" 取得 1 開頭的最新版
+        spec = (request.get('version_spec') or '').strip()
+        if spec:
+            detail['matched_version'] = self.game_db.latest_version_matching(game_name, spec)
+        return {'status': 'OK', 'detail': detail}
+
+    @command('DOWNLOAD_REQUEST', role='player', rate_class='download')
+    def _cmd_download_request(self, client, request):
+        game_name = (request.get('game_name') or '').strip()
+        version = str(request.get('version') or '').strip()
+        if not game_name or not version:
+            return {'status': 'FAIL', 'msg': 'Bad request'}
+        return self._stream_version(client, game_name, version)
+
+    @command('DOWNLOAD_TICKET', role='player', rate_class='query')
+    def _cmd_download_ticket(self, client, request):
+        """
+        申請下載 ticket，讓 client 另開資料連線下載（可平行、可續傳），控制連線不會被大檔卡住。
+        上傳流程加入 hash 之前的舊版本沒有 sha256，第一次有人申請時才算並寫回 catalog，
+        之後 client 端就能用 ContentStore 共用這個版本。
+        """
+        game_name = (request.get('game_name') or '').strip()
+        version = str(request.get('version') or '').strip()
+        if not game_name or not version:
+            return {'status': 'FAIL', 'msg': 'Bad request'}
+        abs_path = self.game_db.resolve_zip_path(game_name, version)
+        if abs_path is None:
+            return {'status': 'FAIL', 'msg': 'Game/version not available'}
+        vinfo = self.game_db.version_info(game_name, version) or {}
+        sha256 = vinfo.get('sha256')
+        try:
+            if not sha256:
+                signature = file_signature(abs_path)
+                sha256 = file_sha256(abs_path)
+                if not self.game_db.record_version_hash(game_name, version, sha256, signature):
+                    sha256 = (self.game_db.version_info(game_name, version) or {}).get('sha256')
+            file_size = os.path.getsize(abs_path)
+        except OSError:
+            return {'status': 'FAIL', 'msg': 'Game/version not available'}
+        return {'status': 'OK', 'ticket': make_download_ticket(client.user, game_name, version),
+                'file_size': file_size, 'sha256': sha256, 'expires_in': DOWNLOAD_TICKET_TTL}
+
+    @command('DOWNLOAD_DATA', rate_class='download')
+    def _cmd_download_data(self, client, request):
+        """
+        資料連線：憑 ticket 從 offset 開始送檔。client 帶上次 READY 給的 etag 續傳，
+        檔案已經換過（例如被 ColdTiering 重新壓縮）時改從頭送，READY 裡的 offset 會是 0。
+        """
+        owner = check_download_ticket(request.get('ticket'))
+        if owner is None:
+            return {'status': 'FAIL', 'msg': 'Invalid or expired ticket'}
+        _, game_name, version = owner
+        try:
+            offset = max(0, int(request.get('offset') or 0))
+        except (TypeError, ValueError):
+            return {'status': 'FAIL', 'msg': 'Bad request'}
+        return self._stream_version(client, game_name, version, offset, request.get('etag'))
+
+    def _stream_version(self, client, game_name, version, offset=0, etag=None):
+        abs_path = self.game_db.resolve_zip_path(game_name, version)
+        if abs_path is None:
+            return {'status': 'FAIL', 'msg': 'Game/version not available'}
+
+        # 在連線自己的執行緒上送（不佔共用的 executor）；先開檔再取大小：ColdTiering 可能正在替換這個檔案
+        with self.downloads.downloading(game_name, version), open(abs_path, 'rb') as f, \
+                self._transferring(client, 'download'):
+            st = os.fstat(f.fileno())
+            current = f"{st.st_size:x}-{st.st_mtime_ns:x}"
+            if offset > st.st_size or (offset and etag != current):
+                offset = 0
+            send_json(client.conn, {'status': 'READY', 'file_size': st.st_size, 'offset': offset, 'etag': current})
+            f.seek(offset)
+            if not send_file(client.conn, f):
+                # 串流停在中間，這條連線已經對不上封包邊界，直接斷開
+                client.aborted = True
+                try:
+                    client.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return {'status': 'ERROR', 'msg': 'Transfer aborted', '_no_reply': True}
+        return {'status': 'OK', 'msg': 'Download complete'}
+
+    # ---------- Developer ----------
+    @command('CHECK_GAME_NAME', role='developer', rate_class='query')
+    def _cmd_check_game_name(self, client, request):
+        game_name = (request.get('game_name') or '').strip()
+        if not game_name:
+            return {'status': 'FAIL', 'msg': 'Bad request'}
+        available = not self.game_db.is_game_name_taken(game_name) and not self.uploads.is_reserved(game_name)
+        return {'status': 'OK', 'available': available}
+
+    @command('UPLOAD_REQUEST', role='developer', rate_class='upload')
+    def _cmd_upload_request(self, client, request):
+        """
+        在連線自己的執行緒上收檔（速度取決於網路，不佔共用的 executor），收完立刻回覆 upload_id；
+        驗證 / 清單 / 雜湊 / 寫入 catalog 由 UploadPipeline 在背景完成，進度用 UPLOAD_STATUS 查詢。
+        流程跑完之前這個版本不會出現在商城。
+        """
+        game_name = (request.get('game_name') or '').strip()
+        version = str(request.get('version') or '').strip()
+        description = (request.get('description') or '').strip()
+        try:
+            file_size = int(request.get('file_size'))
+        except (TypeError, ValueError):
+            file_size = 0
+        if not game_name or not version or file_size <= 0:
+            return {'status': 'FAIL', 'msg': 'Bad request'}
+        if file_size > UPLOAD_MAX_BYTES:
+            return {'status': 'FAIL', 'msg': f'File too large (limit {UPLOAD_MAX_BYTES} bytes)'}
+        owner = self.game_db.get_game_owner(game_name)
+        if owner and owner != client.user:
+            return {'status': 'FAIL', 'msg': 'Game name already owned by another developer'}
+        if self.game_db.has_version(game_name, version):
+            return {'status': 'FAIL', 'msg': 'Version already exists'}
+        ok, msg, job = self.uploads.create(client.user, game_name, version, description)
+        if not ok:
+            return {'status': 'FAIL', 'msg': msg}
+
+        send_json(client.conn, {'status': 'READY', 'upload_id': job['upload_id']})
+        with self._transferring(client, 'upload'):
+            received = recv_file(client.conn, job['_tmp_path'], file_size)
+        if not received:
+            self.uploads.abandon(job)
+            if self.handoff.is_set():
+                # graceful restart 中斷的上傳：client 稍後 RESUME 再重新上傳
+                res = {'status': 'SERVER_BUSY', 'msg': 'Server restarting, upload again', 'retry_after': 1}
+            else:
+                res = {'status': 'ERROR', 'msg': 'Transfer aborted'}
+            # 檔案內容沒收完，這條連線已經對不上封包邊界，回覆後斷開
+            client.aborted = True
+            send_json(client.conn, res)
             try:
-                conn.close()
-            except:
+                client.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
+            return dict(res, _no_reply=True)
+        self.uploads.submit(job)
+        return {'status': 'OK', 'msg': f'Upload received, processing {game_name} {version}',
+                'upload_id': job['upload_id'], 'state': 'QUEUED'}
+
+    @command('UPLOAD_STATUS', role='developer', rate_class='query')
+    def _cmd_upload_status(self, client, request):
+        upload_id = (request.get('upload_id') or '').strip()
+        if not upload_id:
+            return {'status': 'OK', 'uploads': self.uploads.list_by(client.user)}
+        job = self.uploads.get(upload_id)
+        if job is None or job['uploader'] != client.user:
+            return {'status': 'FAIL', 'msg': 'Upload not found'}
+        return {'status': 'OK', 'upload': job}
+
+    # ---------- Player：房間 ----------
+    @command('CREATE_ROOM', role='player', rate_class='room')
+    def _cmd_create_room(self, client, request):
+        game_name = (request.get('game_name') or '').strip()
+        version = str(request.get('version') or '').strip()
+        max_players = int(request.get('max_players', 3))
+        reported_ip = (request.get('host_ip') or '').strip()
+
+        if not self.game_db.is_published(game_name):
+            return {'status': 'FAIL', 'msg': 'Game is unpublished. Cannot create room.'}
+        if not self.game_db.has_version(game_name, version):
+            return {'status': 'FAIL', 'msg': 'Version not available.'}
+        room = self.room_mgr.create_room(
+            host_user=client.user,
+            reported_host_ip=reported_ip,
+            observed_host_ip=client.observed_ip,
+            game_name=game_name,
+            version=version,
+            max_players=max_players
+        )
+        if room is None:
+            return {'status': 'FAIL', 'msg': 'No free room port. Try again later.'}
+        return {'status': 'OK', 'room': room}
+
+    @command('LIST_ROOMS', role='player', rate_class='query')
+    def _cmd_list_rooms(self, client, request):
+        game_name = (request.get('game_name') or '').strip() or None
+        version = str(request.get('version') or '').strip() or None
+        rooms = self.room_mgr.list_rooms(
+            status='OPEN',
+            game_name=game_name,
+            version=version,
+            has_free_slot=bool(request.get('has_free_slot'))
+        )
+        return {'status': 'OK', 'rooms': rooms}
+
+    @command('QUICK_JOIN', role='player', rate_class='room')
+    def _cmd_quick_join(self, client, request):
+        game_name = (request.get('game_name') or '').strip()
+        version = str(request.get('version') or '').strip()
+        if not self.game_db.is_published(game_name):
+            return {'status': 'FAIL', 'msg': 'Game is unpublished.'}
+        if not self.game_db.has_version(game_name, version):
+            return {'status': 'FAIL', 'msg': 'Version not available.'}
+        result = self.room_mgr.quick_join(
+            client.user, game_name, version,
+            observed_ip=client.observed_ip,
+            reported_ip=(request.get('host_ip') or '').strip(),
+            max_players=int(request.get('max_players', 3))
+        )
+        return dict(result, status='WAITING' if result['action'] == 'WAIT' else 'OK')
+
+    @command('QUICK_JOIN_CANCEL', role='player', rate_class='room')
+    def _cmd_quick_join_cancel(self, client, request):
+        self.room_mgr.cancel_quick_join(client.user)
+        return {'status': 'OK', 'msg': 'Cancelled'}
+
+    @command('JOIN_ROOM', role='player', rate_class='room')
+    def _cmd_join_room(self, client, request):
+        rid = int(request.get('room_id', 0))
+        ok, msg = self.room_mgr.join_room(rid, client.user)
+        if not ok:
+            return {'status': 'FAIL', 'msg': msg}
+        return {'status': 'OK', 'msg': msg, 'room': self.room_mgr.get_room(rid)}
+
+    @command('LEAVE_ROOM', role='player', rate_class='room')
+    def _cmd_leave_room(self, client, request):
+        rid = int(request.get('room_id', 0))
+        ok, msg = self.room_mgr.leave_room(rid, client.user)
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+    @command('HEARTBEAT_ROOM', role='player', rate_class='heartbeat')
+    def _cmd_heartbeat_room(self, client, request):
+        rid = int(request.get('room_id', 0))
+        lease = self.room_mgr.renew_leases(client.user, [rid])
+        if not lease['renewed']:
+            return {'status': 'FAIL', 'msg': lease['failed'].get(rid, 'Room not found.')}
+        return {'status': 'OK', 'msg': 'OK',
+                'lease_sec': lease['lease_sec'],
+                'next_heartbeat_sec': lease['next_heartbeat_sec']}
+
+    @command('HEARTBEAT_SESSION', role='player', rate_class='heartbeat')
+    def _cmd_heartbeat_session(self, client, request):
+        # 一次續約這個 session 當 host 的所有房間
+        lease = self.room_mgr.renew_leases(client.user)
+        return {
+            'status': 'OK',
+            'rooms': lease['renewed'],
+            'lease_sec': lease['lease_sec'],
+            'next_heartbeat_sec': lease['next_heartbeat_sec'],
+        }
+
+    @command('REPORT_ROOM_PORT', role='player', rate_class='room')
+    def _cmd_report_room_port(self, client, request):
+        rid = int(request.get('room_id', 0))
+        port = int(request.get('port', 0))
+        ok, msg = self.room_mgr.report_port(rid, client.user, port)
+        if not ok:
+            return {'status': 'FAIL', 'msg': msg}
+        return {'status': 'OK', 'msg': msg, 'room': self.room_mgr.get_room(rid)}
+
+    @command('CLOSE_ROOM', role='player', rate_class='room')
+    def _cmd_close_room(self, client, request):
+        rid = int(request.get('room_id', 0))
+        ok, msg = self.room_mgr.close_room(rid, client.user)
+        return {'status': 'OK' if ok else 'FAIL', 'msg': msg}
+
+
+def take_over(path, host, port, **kwargs):
+    """
+    graceful restart 的新 process：從舊 process 接收 listening socket、房間狀態與所有閒置連線，
+    恢復各連線的登入身分後回覆 OK，舊 process 收到才會結束。
+    """
+    chan = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    chan.settimeout(HANDOFF_CONNECT_SEC)
+    chan.connect(path)
+    state = recv_json(chan)
+    if not state:
+        raise ConnectionError("handoff channel closed")
+    fds = []
+    while len(fds) < state['fd_count']:
+        _, received, _, _ = socket.recv_fds(chan, 1, HANDOFF_FDS_PER_MSG)
+        if not received:
+            raise ConnectionError("handoff channel closed")
+        fds.extend(received)
+
+    server = GameStoreServer(host, port, listen_sock=socket.socket(fileno=fds[0]), **kwargs)
+    rooms = server.room_mgr.import_state(state['rooms'])
+    for info, fd in zip(state['clients'], fds[1:]):
+        session = None
+        if info.get('user') and info.get('role'):
+            token = server.sessions.try_login(info['role'], info['user'], info.get('token'))
+            if token:
+                session = (info['user'], info['role'], token)
+        server._adopt(socket.socket(fileno=fd), tuple(info['addr']), session)
+    # 傳檔被中斷的連線已經關閉，session 以斷線狀態保留，client 可在寬限期內 RESUME
+    for info in state.get('detached', []):
+        token = server.sessions.try_login(info['role'], info['user'], info.get('token'))
+        if token:
+            server.sessions.logout(info['role'], info['user'], token, resumable=True)
+    send_json(chan, {'status': 'OK', 'pid': os.getpid()})
+    chan.close()
+    print(f"[*] Took over {len(fds) - 1} connection(s) and {rooms} room(s)")
+    return server
+
+
+def bench_startup(host):
+    """
+    --bench-startup：建立 server（不進 accept 迴圈），等帳號檔載完後印出各階段耗時。
+    listen 在系統分配的臨時 port 上，正式 server 跑著的時候也能量，不會搶它的 port。
+    """
+    started = time.perf_counter()
+    server = GameStoreServer(host, 0)
+    server.dev_manager.wait_loaded()
+    server.player_manager.wait_loaded()
+    stats = server.startup_stats()
+    stats['ready'] = round((time.perf_counter() - started) * 1000, 1)
+    stats['games_count'] = len(server.game_db.games)
+    stats['accounts_count'] = len(server.dev_manager.data) + len(server.player_manager.data)
+    print(json.dumps(stats, indent=2))
+    server.running = False
+    server.server_socket.close()
+    return stats
+
+
+def _worker_main(host, port, state_address, authkey, backlog, max_handlers):
+    state = LobbyStateManager(address=state_address, authkey=authkey)
+    state.connect()
+    server = GameStoreServer(host, port,
+                             room_mgr=state.RoomManager(),
+                             sessions=state.SessionRegistry(),
+                             reuse_port=True,
+                             backlog=backlog,
+                             max_handlers=max_handlers)
+    server.start()
+
+
+def run_multi_process(host, port, workers, backlog=LISTEN_BACKLOG, max_handlers=MAX_CLIENT_HANDLERS):
+    """
+    多 process 模式：N 個 worker 以 SO_REUSEPORT 在同一個 port accept，
+    房間與線上使用者放在一個 Unix socket 上的 state service，
+    GameDB 則由各 worker 各自保有快照（檔案有變動時重新載入）。
+    """
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("[!] 多 process 模式需要 SO_REUSEPORT 與 Unix socket（Linux）")
+
+    # 資料庫遷移只在 parent 做一次，worker 啟動時就不會同時改寫檔案
+    run_migrations()
+
+    state_address = os.path.join(tempfile.gettempdir(), f"np_lobby_state_{port}.sock")
+    if os.path.exists(state_address):
+        os.remove(state_address)
+    authkey = os.urandom(16)
+    # 每個 worker 都要能驗證其他 worker 發的下載 ticket
+    os.environ['LOBBY_TICKET_KEY'] = DOWNLOAD_TICKET_KEY.decode('utf-8')
+    state = LobbyStateManager(address=state_address, authkey=authkey)
+    state.start()
+    print(f"[*] State service on {state_address}")
+
+    procs = []
+    for _ in range(workers):
+        p = multiprocessing.Process(target=_worker_main, args=(host, port, state_address, authkey, backlog, max_handlers), daemon=True)
+        p.start()
+        procs.append(p)
+
+    def forward_reload(*_):
+        # 每個 worker 各自重新載入設定與 GameDB
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGHUP)
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, forward_reload)
+
+    catalog = GameDB(GAMES_DB_PATH, shared=True)
+    storage_gc = StorageGC(lambda: catalog)
+    storage_gc.start()
+    # 下載紀錄由 worker 寫入；parent 這邊看不到進行中的下載，只靠 load average 判斷是否閒置
+    tiering = ColdTiering(lambda: catalog, DownloadTracker(shared=True))
+    tiering.start()
+
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        print("\n[*] Server stopping...")
+    finally:
+        storage_gc.stop()
+        tiering.stop()
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+        state.shutdown()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Game lobby / store server")
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=1,
+                        help="worker process 數（>1 時使用 SO_REUSEPORT 多 process 模式）")
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG, help="listen() 的 accept backlog")
+    parser.add_argument('--max-handlers', type=int, default=MAX_CLIENT_HANDLERS,
+                        help="每個 process 同時在線的連線數上限（每條連線佔一個執行緒）")
+    parser.add_argument('--bench-startup', action='store_true',
+                        help="量測啟動各階段耗時（含帳號檔載入）後直接結束")
+    parser.add_argument('--convert', nargs=2, metavar=('SRC', 'DST'),
+                        help="資料庫 JSON 與二進位快照互轉（依副檔名 .json / .snap 判斷）後直接結束")
+    parser.add_argument('--takeover', help=argparse.SUPPRESS)  # graceful restart 內部使用
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
+    load_server_config(startup=True)
+    args = parse_args()
     if not os.path.exists(STORAGE_DIR):
         os.makedirs(STORAGE_DIR)
-    server = GameStoreServer(HOST, PORT)
-    server.start()
+    if args.convert:
+        src, dst = args.convert
+        print(f"[*] Converted {convert_store(src, dst)} record(s): {src} -> {dst}")
+    elif args.bench_startup:
+        bench_startup(args.host)
+    elif args.takeover:
+        server = take_over(args.takeover, args.host, args.port,
+                           backlog=args.backlog, max_handlers=args.max_handlers)
+        server.start()
+    elif args.workers > 1:
+        run_multi_process(args.host, args.port, args.workers, args.backlog, args.max_handlers)
+    else:
+        server = GameStoreServer(args.host, args.port, backlog=args.backlog, max_handlers=args.max_handlers)
+        server.start()
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# server_main / lobby_client 都不是套件，直接把所在目錄放進 sys.path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for sub in ('', 'server', 'Player'):
+    path = os.path.join(ROOT, sub)
+    if path not in sys.path:
+        sys.path.insert(0, path)
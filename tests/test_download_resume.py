@@ -0,0 +1,157 @@
+import hashlib
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+import lobby_client as lc
+from common.protocol import send_json, recv_json
+
+
+PAYLOAD = os.urandom(300_000)
+SHA256 = hashlib.sha256(PAYLOAD).hexdigest()
+ETAG = 'e1'
+
+
+class FakeDataServer:
+    """只會 DOWNLOAD_DATA 的資料連線 server；cut_after 表示第一條連線送了這麼多 bytes 就斷線"""
+
+    def __init__(self, cut_after=None, etag=ETAG):
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.requests = []
+        self.cut_after = cut_after
+        self.etag = etag
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                req = recv_json(conn)
+                self.requests.append(req)
+                offset = req.get('offset') or 0
+                if offset and req.get('etag') != self.etag:
+                    offset = 0
+                send_json(conn, {'status': 'READY', 'file_size': len(PAYLOAD), 'offset': offset, 'etag': self.etag})
+                end = len(PAYLOAD)
+                if self.cut_after is not None:
+                    end, self.cut_after = min(end, offset + self.cut_after), None
+                conn.sendall(PAYLOAD[offset:end])
+                if end == len(PAYLOAD):
+                    send_json(conn, {'status': 'OK', 'msg': 'Download complete'})
+
+    def close(self):
+        self.sock.close()
+
+
+class FakeClient:
+    def __init__(self, root):
+        self.root = root
+        self.store = lc.ContentStore(os.path.join(root, lc.STORE_DIRNAME))
+        self.tickets = 0
+
+    def request(self, req):
+        assert req['cmd'] == 'DOWNLOAD_TICKET'
+        self.tickets += 1
+        return {'status': 'OK', 'ticket': f't{self.tickets}', 'file_size': len(PAYLOAD), 'sha256': SHA256}
+
+    def local_paths(self, game_name, version):
+        base = os.path.join(self.root, 'alice', game_name, version)
+        return base, os.path.join(base, f"{game_name}_{version}.zip"), os.path.join(base, 'extracted')
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    monkeypatch.setattr(lc, 'DOWNLOADS_DIR', str(tmp_path))
+    monkeypatch.setattr(lc, 'SERVER_IP', '127.0.0.1')
+    os.makedirs(tmp_path / 'alice')
+    servers = []
+
+    def start(**kw):
+        server = FakeDataServer(**kw)
+        servers.append(server)
+        monkeypatch.setattr(lc, 'SERVER_PORT', server.port)
+        return server
+
+    yield FakeClient(str(tmp_path)), start
+    for server in servers:
+        server.close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_resumes_from_part_file_after_client_restart(env):
+    client, start = env
+    server = start()
+    _, zip_path, _ = client.local_paths('Snake', '1.0')
+    os.makedirs(os.path.dirname(zip_path))
+    with open(zip_path + '.part', 'wb') as f:
+        f.write(PAYLOAD[:120_000])
+    # 上次關掉 client 時留下的佇列檔
+    key = lc.DownloadManager.job_key('Snake', '1.0')
+    saved = [{'key': key, 'game_name': 'Snake', 'version': '1.0', 'zip_path': zip_path, 'state': 'RUNNING',
+              'install': False, 'received': 120_000, 'total': len(PAYLOAD), 'rate': 0.0,
+              'etag': ETAG, 'sha256': SHA256, 'error': None}]
+    with open(os.path.join(client.root, 'alice', lc.DOWNLOAD_QUEUE_FILE), 'w') as f:
+        json.dump(saved, f)
+
+    manager = lc.DownloadManager(client, 'alice')
+    try:
+        assert manager.start() == 1
+        assert manager.wait(key, show_progress=False, timeout=30)
+    finally:
+        manager.shutdown()
+    assert [r['offset'] for r in server.requests] == [120_000]
+    assert read(zip_path) == PAYLOAD
+    assert not os.path.exists(zip_path + '.part')
+    assert client.store.has_zip(SHA256)
+
+
+def test_reconnects_and_continues_after_a_dropped_connection(env, monkeypatch):
+    monkeypatch.setattr(lc, 'DOWNLOAD_DATA_TIMEOUT', 5.0)
+    client, start = env
+    server = start(cut_after=100_000)
+    manager = lc.DownloadManager(client, 'alice')
+    try:
+        job = manager.enqueue('Snake', '1.0', install=False)
+        assert manager.wait(job['key'], show_progress=False, timeout=30)
+    finally:
+        manager.shutdown()
+    offsets = [r['offset'] for r in server.requests]
+    assert offsets[0] == 0 and len(offsets) == 2 and 0 < offsets[1] <= 100_000
+    assert server.requests[1]['etag'] == ETAG
+    assert read(job['zip_path']) == PAYLOAD
+
+
+def test_part_file_is_discarded_when_the_server_file_changed(env):
+    client, start = env
+    server = start(etag='e2')
+    _, zip_path, _ = client.local_paths('Snake', '1.0')
+    os.makedirs(os.path.dirname(zip_path))
+    with open(zip_path + '.part', 'wb') as f:
+        f.write(b'stale bytes from an older upload')
+    key = lc.DownloadManager.job_key('Snake', '1.0')
+    saved = [{'key': key, 'game_name': 'Snake', 'version': '1.0', 'zip_path': zip_path, 'state': 'QUEUED',
+              'install': False, 'received': 32, 'total': len(PAYLOAD), 'rate': 0.0,
+              'etag': ETAG, 'sha256': SHA256, 'error': None}]
+    with open(os.path.join(client.root, 'alice', lc.DOWNLOAD_QUEUE_FILE), 'w') as f:
+        json.dump(saved, f)
+
+    manager = lc.DownloadManager(client, 'alice')
+    try:
+        manager.start()
+        assert manager.wait(key, show_progress=False, timeout=30)
+    finally:
+        manager.shutdown()
+    # server 回 offset 0，client 從頭重收而不是接在舊內容後面
+    assert server.requests[0]['offset'] == 32
+    assert read(zip_path) == PAYLOAD
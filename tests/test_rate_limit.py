@@ -0,0 +1,97 @@
+import pytest
+
+import server_main as sm
+from server_main import ClientConnection, RateLimiter, TokenBucket
+
+
+def test_bucket_allows_a_burst_up_to_capacity():
+    b = TokenBucket(rate=2, capacity=3, now=100.0)
+    assert [b.take(100.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    # 第 4 個要等補 1 個 token：1 / rate 秒
+    assert b.take(100.0) == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_rate_and_caps_at_capacity():
+    b = TokenBucket(rate=2, capacity=3, now=0.0)
+    for _ in range(3):
+        b.take(0.0)
+    assert b.take(0.25) == pytest.approx(0.25)   # 補了 0.5 個，還差 0.5 個
+    assert b.take(0.5) == 0.0
+    # 閒置很久也只會補到 capacity
+    assert [b.take(1000.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert b.take(1000.0) > 0
+
+
+def test_rejected_take_does_not_consume():
+    b = TokenBucket(rate=1, capacity=1, now=0.0)
+    assert b.take(0.0) == 0.0
+    for t in (0.1, 0.2, 0.3):
+        assert b.take(t) == pytest.approx(1.0 - t)
+    assert b.take(1.0) == 0.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sm.time, 'monotonic', lambda: now[0])
+    return now
+
+
+LIMITS = {'query': {'session': (1, 2), 'ip': (1, 3)}, 'default': {'session': (10, 10)}}
+
+
+def test_session_buckets_are_per_connection(clock):
+    limiter = RateLimiter({'query': {'session': (1, 2)}})
+    a, b = ClientConnection(None, ('10.0.0.1', 1)), ClientConnection(None, ('10.0.0.2', 2))
+    assert [limiter.check(a, 'query') for _ in range(2)] == [0.0, 0.0]
+    assert limiter.check(a, 'query') == pytest.approx(1.0)
+    assert limiter.check(b, 'query') == 0.0
+    clock[0] += 1.0
+    assert limiter.check(a, 'query') == 0.0
+    assert limiter.rejected['query'] == 1
+
+
+def test_ip_bucket_is_shared_between_connections(clock):
+    limiter = RateLimiter(LIMITS)
+    conns = [ClientConnection(None, ('10.0.0.1', port)) for port in range(4)]
+    assert [limiter.check(c, 'query') for c in conns[:3]] == [0.0, 0.0, 0.0]
+    # 第 4 條連線自己的 session bucket 還是滿的，但同一個 IP 已經用完額度
+    assert limiter.check(conns[3], 'query') == pytest.approx(1.0)
+    assert limiter.check(ClientConnection(None, ('10.0.0.9', 1)), 'query') == 0.0
+
+
+def test_session_rejection_does_not_spend_ip_tokens(clock):
+    limiter = RateLimiter(LIMITS)
+    a = ClientConnection(None, ('10.0.0.1', 1))
+    for _ in range(5):
+        limiter.check(a, 'query')
+    key = ('10.0.0.1', 'query')
+    assert limiter.ip_buckets[key].tokens == pytest.approx(1.0)
+
+
+def test_unknown_class_uses_default_and_empty_limits_allow(clock):
+    limiter = RateLimiter(LIMITS)
+    c = ClientConnection(None, ('10.0.0.1', 1))
+    assert all(limiter.check(c, 'whatever') == 0.0 for _ in range(10))
+    assert limiter.check(c, 'whatever') > 0
+    assert RateLimiter({}).check(c, 'query') == 0.0
+
+
+def test_idle_ip_buckets_are_pruned(clock):
+    limiter = RateLimiter(LIMITS)
+    limiter.check(ClientConnection(None, ('10.0.0.1', 1)), 'query')
+    clock[0] += sm.RATE_LIMIT_IDLE_SEC + 1
+    limiter.check(ClientConnection(None, ('10.0.0.2', 1)), 'query')
+    assert list(limiter.ip_buckets) == [('10.0.0.2', 'query')]
+
+
+def test_charge_ip_spends_the_shared_ip_bucket_across_connections(clock):
+    limiter = RateLimiter(LIMITS)
+    # 每次換新連線（新的 session bucket），扣掉的 IP 額度仍然累計
+    for port in range(3):
+        limiter.charge_ip(ClientConnection(None, ('10.0.0.1', port)), 'query')
+    assert limiter.check(ClientConnection(None, ('10.0.0.1', 9)), 'query') > 0
+    assert limiter.check(ClientConnection(None, ('10.0.0.2', 9)), 'query') == 0.0
+    # 沒有 ip 額度的類別不受影響
+    limiter.charge_ip(ClientConnection(None, ('10.0.0.1', 1)), 'default')
+    assert ('10.0.0.1', 'default') not in limiter.ip_buckets
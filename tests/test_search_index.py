@@ -0,0 +1,85 @@
+import server_main as sm
+from server_main import SearchIndex, tokenize
+
+
+def ids(results):
+    return [doc_id for doc_id, _ in results]
+
+
+def test_tokenize_words_and_cjk_ngrams():
+    assert tokenize('Snake 2 Player') == ['snake', '2', 'player']
+    # 建索引：單字 + 相鄰兩字；查詢：長度 >= 2 的片段只用 bigram
+    assert sorted(tokenize('貪食蛇')) == sorted(['貪', '食', '蛇', '貪食', '食蛇'])
+    assert tokenize('食蛇', for_query=True) == ['食蛇']
+    assert tokenize('蛇', for_query=True) == ['蛇']
+    # NFKC：全形英數字與半形相同
+    assert tokenize('ＳＮＡＫＥ') == ['snake']
+
+
+def test_cjk_query_needs_adjacent_characters():
+    idx = SearchIndex()
+    idx.add('a', {'name': '遊戲大廳'})
+    idx.add('b', {'name': '遊樂園', 'description': '好玩的戲'})
+    assert ids(idx.search('遊戲')) == ['a']
+    assert sorted(ids(idx.search('遊'))) == ['a', 'b']
+    assert ids(idx.search('大廳 遊戲')) == ['a']
+
+
+def test_and_semantics_and_removal():
+    idx = SearchIndex()
+    idx.add('snake', {'name': 'Snake', 'description': 'classic arcade game'})
+    idx.add('tetris', {'name': 'Tetris', 'description': 'falling blocks arcade game'})
+    assert sorted(ids(idx.search('arcade game'))) == ['snake', 'tetris']
+    assert ids(idx.search('arcade blocks')) == ['tetris']
+    assert idx.search('arcade chess') == []
+    assert idx.search('   ') == []
+    idx.remove('tetris')
+    assert ids(idx.search('arcade')) == ['snake']
+    assert 'blocks' not in idx.postings
+    # 重新 add 會取代舊內容
+    idx.add('snake', {'name': 'Snake'})
+    assert idx.search('arcade') == []
+
+
+def test_name_matches_rank_above_description_matches():
+    idx = SearchIndex()
+    idx.add('puzzle-pack', {'name': 'Puzzle Pack', 'description': 'many games'})
+    idx.add('chess', {'name': 'Chess', 'description': 'a strategy puzzle'})
+    ranked = idx.search('puzzle')
+    assert ids(ranked) == ['puzzle-pack', 'chess']
+    assert ranked[0][1] > ranked[1][1]
+
+
+def test_rare_terms_weigh_more_and_tf_saturates():
+    idx = SearchIndex()
+    for i in range(8):
+        idx.add(f'common{i}', {'description': 'card game'})
+    idx.add('rare', {'description': 'card game solitaire'})
+    idx.add('spam', {'description': 'card card card card card card game'})
+    ranked = dict(idx.search('card game', limit=20))
+    # 詞頻飽和：重複很多次只比出現一次多一點，不會超過 2 倍
+    assert ranked['spam'] > ranked['common0']
+    assert ranked['spam'] < 2 * ranked['common0']
+    # idf：罕見詞命中的分數高於常見詞
+    assert ids(idx.search('solitaire game')) == ['rare']
+    rare_score = dict(idx.search('solitaire'))['rare']
+    assert rare_score > dict(idx.search('game'))['rare']
+
+
+def test_ties_break_by_id_and_limit_applies():
+    idx = SearchIndex()
+    for doc_id in ('c', 'a', 'b'):
+        idx.add(doc_id, {'name': 'Same Name'})
+    assert ids(idx.search('same')) == ['a', 'b', 'c']
+    assert ids(idx.search('same', limit=2)) == ['a', 'b']
+
+
+def test_game_db_search_only_returns_published_games(tmp_path):
+    db = sm.GameDB(str(tmp_path / 'games.json'))
+    db.add_game_version('貪食蛇', 'dev', '1.0', '經典的貪食蛇遊戲', 'a.zip')
+    db.add_game_version('俄羅斯方塊', 'dev', '1.0', '方塊遊戲', 'b.zip')
+    assert sorted(g['name'] for g in db.search_public_games('遊戲')) == ['俄羅斯方塊', '貪食蛇']
+    assert [g['name'] for g in db.search_public_games('方塊')] == ['俄羅斯方塊']
+    db.set_game_published('俄羅斯方塊', 'dev', False)
+    assert db.search_public_games('方塊') == []
+    assert 'score' in db.search_public_games('蛇')[0]
@@ -0,0 +1,138 @@
+import json
+import os
+
+import pytest
+
+import server_main as sm
+from server_main import SnapshotStore
+
+
+DATA = {
+    'alice': {'password': 'pw', 'role': 'player', 'history': ['Snake']},
+    '小明': {'password': '密碼', 'role': 'player', 'history': []},
+    'bob': {'password': 'x', 'role': 'developer', 'history': [{'game': 'Go', 'n': 3}]},
+}
+
+
+@pytest.fixture
+def path(tmp_path):
+    p = str(tmp_path / 'players.snap')
+    SnapshotStore.write(p, DATA)
+    return p
+
+
+def test_write_and_reopen_round_trip(path):
+    store = SnapshotStore(path)
+    assert dict(store.items()) == DATA
+    assert len(store) == 3 and '小明' in store and 'carol' not in store
+    with pytest.raises(KeyError):
+        store['carol']
+
+
+def test_values_are_decoded_lazily_from_the_mmap(path):
+    store = SnapshotStore(path)
+    assert store.stats()['decoded'] == 0
+    assert store['bob']['history'][0]['n'] == 3
+    assert store.stats()['decoded'] == 1
+    # 同一個 key 再取拿到同一個物件（就地修改會在 flush 時寫回）
+    assert store['bob'] is store['bob']
+
+
+def test_flush_appends_changes_and_index_segments(path):
+    store = SnapshotStore(path)
+    store['alice']['history'].append('Tetris')   # 就地修改
+    store['carol'] = {'password': 'c', 'role': 'player', 'history': []}
+    del store['bob']
+    size, idx_size = os.path.getsize(path), os.path.getsize(path + '.idx')
+    store.flush()
+    assert os.path.getsize(path) > size and os.path.getsize(path + '.idx') > idx_size
+
+    reopened = SnapshotStore(path)
+    assert sorted(reopened) == sorted(['alice', '小明', 'carol'])
+    assert reopened['alice']['history'] == ['Snake', 'Tetris']
+    assert reopened['carol']['password'] == 'c'
+    assert reopened.stats()['dead_bytes'] > 0
+
+
+def test_flush_without_changes_writes_nothing(path):
+    store = SnapshotStore(path)
+    store['alice']
+    store['bob'] = dict(DATA['bob'])   # 內容相同
+    size = os.path.getsize(path)
+    store.flush()
+    assert os.path.getsize(path) == size
+
+
+def test_missing_or_stale_index_is_rebuilt_by_scanning(path):
+    store = SnapshotStore(path)
+    store['dave'] = {'n': 1}
+    del store['alice']
+    store.flush()
+    expected = {k: store[k] for k in store}
+
+    os.remove(path + '.idx')
+    assert {k: v for k, v in SnapshotStore(path).items()} == expected
+    assert os.path.exists(path + '.idx')
+
+    # 資料寫進去了但索引沒跟上（寫到一半 crash）：索引長度對不上，開檔時重掃
+    key = 'eve'.encode('utf-8')
+    value = json.dumps({'n': 2}).encode('utf-8')
+    with open(path, 'ab') as f:
+        f.write(SnapshotStore._RECORD.pack(len(key), len(value)) + key + value)
+    reopened = SnapshotStore(path)
+    assert reopened['eve'] == {'n': 2} and 'alice' not in reopened
+
+    with open(path + '.idx', 'wb') as f:
+        f.write(b'garbage')
+    assert set(SnapshotStore(path)) == set(expected) | {'eve'}
+
+
+def test_compaction_drops_dead_records(path, monkeypatch):
+    monkeypatch.setattr(sm, 'SNAPSHOT_COMPACT_MIN', 0)
+    store = SnapshotStore(path)
+    for i in range(5):
+        store['alice'] = {'password': 'pw' * 50, 'round': i}
+        store.flush()
+    assert store.stats()['dead_bytes'] <= os.path.getsize(path) - store.stats()['dead_bytes']
+    store.compact()
+    assert store.stats()['dead_bytes'] == 0
+    reopened = SnapshotStore(path)
+    assert reopened['alice']['round'] == 4 and reopened['bob'] == DATA['bob']
+
+
+def test_rejects_files_that_are_not_snapshots(tmp_path):
+    p = tmp_path / 'players.snap'
+    p.write_text('{"alice": {}}')
+    with pytest.raises(ValueError):
+        SnapshotStore(str(p))
+
+
+def test_convert_store_between_json_and_snapshot(tmp_path):
+    src, snap, back = (str(tmp_path / n) for n in ('games.json', 'games.snap', 'back.json'))
+    sm.save_json(src, DATA)
+    assert sm.convert_store(src, snap) == 3
+    assert sm.resolve_db_path(src) == snap
+    assert isinstance(sm.load_store(snap, None), SnapshotStore)
+    assert sm.convert_store(snap, back) == 3
+    with open(back, encoding='utf-8') as f:
+        assert json.load(f) == DATA
+
+
+@pytest.mark.parametrize('cut', [1, 5, 20])
+def test_torn_tail_from_a_crashed_append_is_dropped(path, cut):
+    store = SnapshotStore(path)
+    store['carol'] = {'password': 'c', 'role': 'player', 'history': ['Snake'] * 10}
+    store.flush()
+    size = os.path.getsize(path)
+    store._close()
+    # append 寫到一半 crash：資料檔少了結尾，索引記的長度對不上
+    os.truncate(path, size - cut)
+
+    reopened = SnapshotStore(path)
+    assert 'carol' not in reopened
+    assert dict(reopened.items()) == DATA
+    assert os.path.getsize(path) < size - cut
+    # 截掉殘缺尾巴之後可以照常 append
+    reopened['dave'] = {'n': 1}
+    reopened.flush()
+    assert SnapshotStore(path)['dave'] == {'n': 1}
@@ -0,0 +1,89 @@
+import itertools
+
+import pytest
+
+import server_main as sm
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    clock = itertools.count(1_700_000_000)
+    monkeypatch.setattr(sm.time, 'time', lambda: next(clock))
+    db = sm.GameDB(str(tmp_path / 'games.json'))
+    # 依序上架，越後面的 updated_at 越新
+    for i, name in enumerate(['Tetris', 'Snake', 'Sokoban', 'Chess', 'Go', 'Gomoku', 'Pong', 'Solitaire']):
+        db.add_game_version(name, 'alice' if i % 2 == 0 else 'bob', '1.0', f'{name} desc', f'{name}.zip')
+    db.set_game_published('Pong', 'alice', False)
+    return db
+
+
+def walk(db, limit, **kw):
+    """一頁一頁取到底，回傳每頁的遊戲名"""
+    pages, cursor = [], None
+    while True:
+        games, cursor = db.query_public_games(limit=limit, cursor=cursor, **kw)
+        pages.append([g['name'] for g in games])
+        if cursor is None:
+            return pages
+
+
+def test_name_order_pages_cover_everything_once(db):
+    pages = walk(db, 3)
+    assert pages == [['Chess', 'Go', 'Gomoku'], ['Snake', 'Sokoban', 'Solitaire'], ['Tetris']]
+
+
+def test_exact_multiple_of_limit_has_no_empty_last_page(db):
+    assert walk(db, 7) == [['Chess', 'Go', 'Gomoku', 'Snake', 'Sokoban', 'Solitaire', 'Tetris']]
+
+
+def test_name_desc_and_updated_orders(db):
+    assert sum(walk(db, 2, sort='name_desc'), []) == \
+        ['Tetris', 'Solitaire', 'Sokoban', 'Snake', 'Gomoku', 'Go', 'Chess']
+    # Pong 下架後不在列表裡；其他依最近更新在前
+    assert sum(walk(db, 2, sort='updated'), []) == \
+        ['Solitaire', 'Gomoku', 'Go', 'Chess', 'Sokoban', 'Snake', 'Tetris']
+
+
+def test_prefix_and_uploader_filters(db):
+    assert walk(db, 1, prefix='So') == [['Sokoban'], ['Solitaire']]
+    assert sum(walk(db, 2, sort='name_desc', prefix='Go'), []) == ['Gomoku', 'Go']
+    assert sum(walk(db, 2, uploader='bob'), []) == ['Chess', 'Gomoku', 'Snake', 'Solitaire']
+    assert walk(db, 5, open_games={'Go', 'Snake', 'Pong', 'Nope'}) == [['Go', 'Snake']]
+
+
+def test_updated_order_with_filters(db):
+    assert walk(db, 2, sort='updated', uploader='bob') == [['Solitaire', 'Gomoku'], ['Chess', 'Snake']]
+    assert walk(db, 5, sort='updated', open_games={'Go', 'Snake', 'Pong', 'Nope'}) == [['Go', 'Snake']]
+    assert sum(walk(db, 1, sort='updated', uploader='alice', prefix='So'), []) == ['Sokoban']
+    # 重新上架 / 更新後 uploader 的 updated 索引跟著移動
+    db.add_game_version('Chess', 'bob', '1.1', 'd', 'Chess_1.1.zip')
+    assert sum(walk(db, 3, sort='updated', uploader='bob'), []) == ['Chess', 'Solitaire', 'Gomoku', 'Snake']
+
+
+def test_cursor_is_stable_when_games_are_added_between_pages(db):
+    games, cursor = db.query_public_games(limit=3)
+    assert [g['name'] for g in games] == ['Chess', 'Go', 'Gomoku']
+    # 在已經看過的範圍內新增不會讓下一頁重複或漏掉
+    db.add_game_version('Checkers', 'carol', '1.0', 'd', 'Checkers.zip')
+    db.add_game_version('Sudoku', 'carol', '1.0', 'd', 'Sudoku.zip')
+    games, cursor = db.query_public_games(limit=3, cursor=cursor)
+    assert [g['name'] for g in games] == ['Snake', 'Sokoban', 'Solitaire']
+    games, cursor = db.query_public_games(limit=3, cursor=cursor)
+    assert [g['name'] for g in games] == ['Sudoku', 'Tetris'] and cursor is None
+
+
+def test_bad_cursor_and_sort_are_rejected(db):
+    _, cursor = db.query_public_games(limit=2)
+    with pytest.raises(ValueError):
+        db.query_public_games(limit=2, cursor=cursor, sort='updated')
+    with pytest.raises(ValueError):
+        db.query_public_games(cursor='not-a-cursor!!')
+    with pytest.raises(ValueError):
+        db.query_public_games(sort='random')
+
+
+def test_limit_is_clamped(db):
+    games, cursor = db.query_public_games(limit=0)
+    assert len(games) == 1 and cursor is not None
+    games, _ = db.query_public_games(limit=10 ** 6)
+    assert len(games) == min(7, sm.STORE_PAGE_SIZE_MAX)
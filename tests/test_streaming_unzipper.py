@@ -0,0 +1,131 @@
+import io
+import os
+import zipfile
+
+import pytest
+
+from lobby_client import StreamingUnzipper
+
+
+FILES = {
+    'game_config.json': b'{"exe_cmd": "python main.py"}',
+    'main.py': b'print("hello")\n' * 500,
+    'assets/sprite.bin': os.urandom(50_000),
+    'assets/中文.txt': '貪食蛇'.encode('utf-8') * 100,
+}
+
+
+class Unseekable(io.RawIOBase):
+    """不能 seek 的輸出：zipfile 會改用 data descriptor 記錄 CRC 與大小"""
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.data += b
+        return len(b)
+
+
+def build_zip(path, files, *, stored=(), seekable=True):
+    target = open(path, 'wb') if seekable else Unseekable()
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr(zipfile.ZipInfo('assets/'), b'')
+        for name, data in files.items():
+            z.writestr(name, data, compress_type=zipfile.ZIP_STORED if name in stored else zipfile.ZIP_DEFLATED)
+    if not seekable:
+        with open(path, 'wb') as f:
+            f.write(target.data)
+    target.close()
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def feed_all(unzip, blob, chunk):
+    for i in range(0, len(blob), chunk):
+        unzip.feed(blob[i:i + chunk])
+
+
+def assert_extracted(dest, files):
+    for name, data in files.items():
+        with open(os.path.join(dest, *name.split('/')), 'rb') as f:
+            assert f.read() == data
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 4096, 1 << 20])
+def test_extracts_deflated_and_stored_entries_in_any_chunking(tmp_path, chunk):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = build_zip(zip_path, FILES, stored={'main.py'})
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    feed_all(unzip, blob, chunk)
+    assert unzip.error is None and unzip.done
+    assert unzip.finish(zip_path)
+    assert_extracted(unzip.dest, FILES)
+    assert os.path.isdir(os.path.join(unzip.dest, 'assets'))
+
+
+def test_data_descriptors(tmp_path):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = build_zip(zip_path, FILES, seekable=False)
+    with zipfile.ZipFile(zip_path) as z:
+        assert all(info.flag_bits & 0x8 for info in z.infolist() if not info.is_dir())
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    feed_all(unzip, blob, 333)
+    assert unzip.finish(zip_path), unzip.error
+    assert_extracted(unzip.dest, FILES)
+
+
+def test_stored_entry_with_descriptor_falls_back(tmp_path):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = build_zip(zip_path, FILES, stored={'main.py'}, seekable=False)
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    feed_all(unzip, blob, 4096)
+    assert unzip.error and 'data descriptor' in unzip.error
+    assert not unzip.finish(zip_path)
+
+
+def test_rejects_paths_outside_the_staging_dir(tmp_path):
+    zip_path = str(tmp_path / 'evil.zip')
+    blob = build_zip(zip_path, {'../evil.txt': b'x'})
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    unzip.feed(blob)
+    assert unzip.error and '不安全的路徑' in unzip.error
+    assert not os.path.exists(tmp_path / 'evil.txt')
+
+
+def test_corrupted_data_is_detected(tmp_path):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = bytearray(build_zip(zip_path, {'a.txt': b'abcdefgh' * 100}, stored={'a.txt'}))
+    blob[blob.index(b'abcdefgh') + 3] ^= 0xFF
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    unzip.feed(bytes(blob))
+    assert unzip.error and 'CRC' in unzip.error
+    # 出錯後不再處理後續資料
+    unzip.feed(b'PK\x03\x04')
+    assert not unzip.finish(zip_path)
+
+
+def test_incomplete_stream_or_other_zip_fails_finish(tmp_path):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = build_zip(zip_path, FILES)
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    unzip.feed(blob[:len(blob) // 2])
+    assert unzip.error is None and not unzip.done
+    assert not unzip.finish(zip_path) and unzip.error
+
+    other = str(tmp_path / 'other.zip')
+    build_zip(other, dict(FILES, extra=b'more'))
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    unzip.feed(blob)
+    assert not unzip.finish(other)
+
+
+def test_discard_removes_staging(tmp_path):
+    zip_path = str(tmp_path / 'game.zip')
+    blob = build_zip(zip_path, FILES)
+    unzip = StreamingUnzipper(str(tmp_path / 'staging'))
+    unzip.feed(blob[:1000])
+    unzip.discard()
+    assert not os.path.exists(unzip.dest)
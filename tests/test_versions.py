@@ -0,0 +1,104 @@
+import pytest
+
+import server_main as sm
+from server_main import parse_version, version_matches
+
+
+def ordered(*versions):
+    return [v.raw for v in sorted(parse_version(v) for v in versions)]
+
+
+def test_numeric_segments_sort_as_numbers():
+    assert ordered('1.10', '1.2', '1.9') == ['1.2', '1.9', '1.10']
+    assert ordered('10.0', '2.0', '9.9.9') == ['2.0', '9.9.9', '10.0']
+
+
+def test_trailing_zeros_share_a_position():
+    assert parse_version('1.0').key[1:3] == parse_version('1.0.0').key[1:3]
+    assert parse_version('1') < parse_version('1.0.1')
+
+
+def test_prerelease_sorts_before_release():
+    assert ordered('1.0.0', '1.0.0-rc.1', '1.0.0-alpha', '1.0.0-alpha.2', '1.0.0-alpha.10', '1.0.0-beta') == \
+        ['1.0.0-alpha', '1.0.0-alpha.2', '1.0.0-alpha.10', '1.0.0-beta', '1.0.0-rc.1', '1.0.0']
+    # 數字識別字排在英數字識別字前面
+    assert parse_version('1.0.0-1') < parse_version('1.0.0-a')
+
+
+def test_build_metadata_does_not_change_precedence():
+    assert parse_version('1.2.0+build.5').key[1:3] == parse_version('1.2.0').key[1:3]
+    assert parse_version('1.2.0+build.9') < parse_version('1.2.1')
+
+
+def test_v_prefix_and_invalid_versions():
+    assert parse_version('v2.0').valid and parse_version('v2.0').core == (2, 0)
+    assert not parse_version('latest').valid
+    assert not parse_version('1.0-').valid
+    # 無法解析的版本排在所有合法版本之後
+    assert ordered('beta', '99.0', 'alpha', '1.0') == ['1.0', '99.0', 'alpha', 'beta']
+
+
+@pytest.mark.parametrize('spec', ['1.x', '1.*', '1', '1.X'])
+def test_major_wildcard_specs(spec):
+    assert version_matches(parse_version('1.0'), spec)
+    assert version_matches(parse_version('1.9.3'), spec)
+    assert not version_matches(parse_version('2.0'), spec)
+    assert not version_matches(parse_version('10.0'), spec)
+
+
+def test_minor_wildcard_and_short_versions():
+    assert version_matches(parse_version('1.2.7'), '1.2.x')
+    assert not version_matches(parse_version('1.3.0'), '1.2.x')
+    # 1 視為 1.0.0
+    assert not version_matches(parse_version('1'), '1.2.x')
+    assert version_matches(parse_version('1'), '1.0.x')
+
+
+def test_comparison_specs():
+    v = parse_version('1.5')
+    assert version_matches(v, '>=1.0 <2.0')
+    assert version_matches(v, '>1.4.9')
+    assert not version_matches(v, '<1.5')
+    assert version_matches(v, '<=1.5.0')
+    assert version_matches(v, '=1.5.0')
+    assert not version_matches(v, '>=2')
+    assert not version_matches(v, '>=abc')
+
+
+def test_prerelease_only_matches_when_spec_mentions_one():
+    beta = parse_version('2.0.0-beta.1')
+    assert not version_matches(beta, '2.x')
+    assert not version_matches(beta, '>=1.0')
+    assert version_matches(beta, '>=2.0.0-alpha')
+    assert not version_matches(parse_version('junk'), '1.x')
+
+
+def test_latest_version_matching(tmp_path):
+    db = sm.GameDB(str(tmp_path / 'games.json'))
+    for v in ('1.0', '1.10', '1.9', '2.0.0-rc.1', '2.0', '2.1-beta'):
+        db.add_game_version('Snake', 'dev', v, 'desc', f'snake_{v}.zip')
+    assert db.latest_version_matching('Snake', '1.x') == '1.10'
+    assert db.latest_version_matching('Snake', '2.x') == '2.0'
+    assert db.latest_version_matching('Snake', '<2.0') == '1.10'
+    assert db.latest_version_matching('Snake', '>=2.0.0-a') == '2.1-beta'
+    assert db.latest_version_matching('Snake', '3.x') is None
+    assert db.latest_version_matching('Missing', '1.x') is None
+    assert db.sorted_versions('Snake') == ['1.0', '1.9', '1.10', '2.0.0-rc.1', '2.0', '2.1-beta']
+
+
+def test_legacy_version_hash_is_recorded_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(sm, 'STORAGE_DIR', str(tmp_path))
+    (tmp_path / 'snake_1.0.zip').write_bytes(b'zip bytes')
+    db = sm.GameDB(str(tmp_path / 'games.json'))
+    db.add_game_version('Snake', 'dev', '1.0', 'desc', 'snake_1.0.zip')
+    path = db.resolve_zip_path('Snake', '1.0')
+    sig = sm.file_signature(path)
+
+    # 算 hash 的期間檔案被換掉：不寫入
+    assert not db.record_version_hash('Snake', '1.0', 'a' * 64, (sig[0] - 1, sig[1]))
+    assert 'sha256' not in db.version_info('Snake', '1.0')
+
+    assert db.record_version_hash('Snake', '1.0', sm.file_sha256(path), sig)
+    assert sm.GameDB(str(tmp_path / 'games.json')).version_info('Snake', '1.0')['sha256'] == sm.file_sha256(path)
+    # 已經有 sha256 的版本不會被覆寫
+    assert not db.record_version_hash('Snake', '1.0', 'b' * 64, sig)